@@ -0,0 +1,277 @@
+"""Stand-ins for APNS and FCM to run the service against offline.
+
+APNS is served over HTTP/2 with TLS like the real one, the certificate is self-signed
+and clients have to trust it via SSL_CERT_FILE. FCM and the Google OAuth token
+endpoint are served over plain HTTP/1.1.
+
+Run: python -m benchmarks.fake_providers [--latency-ms MS] [--error-rate RATE]
+"""
+
+import argparse
+import asyncio
+import ipaddress
+import json
+import random
+import socket
+import ssl
+import tempfile
+import threading
+import uuid
+from dataclasses import dataclass
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
+
+import h2.config
+import h2.connection
+import h2.events
+import h2.exceptions
+import uvicorn
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+# Failures making up the error mix, picked with equal chances
+APNS_ERRORS = [(400, 'BadDeviceToken'), (410, 'Unregistered'), (429, 'TooManyRequests'), (503, 'ServiceUnavailable')]
+FCM_ERRORS = [(404, 'NOT_FOUND'), (429, 'RESOURCE_EXHAUSTED'), (503, 'UNAVAILABLE')]
+
+
+@dataclass(frozen=True)
+class Behavior:
+    """How a stand-in answers requests."""
+
+    latency: timedelta = timedelta()
+    # Latency varies uniformly by up to this much in both directions
+    jitter: timedelta = timedelta()
+    # Share of requests answered with an error from the mix
+    error_rate: float = 0
+
+    def get_delay(self) -> float:
+        """Return seconds to wait before answering a request."""
+        jitter = self.jitter.total_seconds()
+        return max(self.latency.total_seconds() + random.uniform(-jitter, jitter), 0)
+
+    def fails(self) -> bool:
+        """Return whether to answer the next request with an error."""
+        return random.random() < self.error_rate
+
+
+class APNSProtocol(asyncio.Protocol):
+    """HTTP/2 connection answering APNS push requests."""
+
+    def __init__(self, behavior: Behavior) -> None:
+        self._behavior = behavior
+        self._conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False))
+        self._transport: asyncio.Transport | None = None
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        """Send the server preface."""
+        self._transport = transport  # type: ignore[assignment]
+        self._conn.initiate_connection()
+        self._flush()
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        """Drop answers still waiting for their delay."""
+        self._transport = None
+
+    def data_received(self, data: bytes) -> None:
+        """Answer each request once its body is received."""
+        try:
+            events = self._conn.receive_data(data)
+        except h2.exceptions.ProtocolError:
+            self._flush()
+            if self._transport is not None:
+                self._transport.close()
+            return
+
+        loop = asyncio.get_running_loop()
+        for event in events:
+            if isinstance(event, h2.events.DataReceived):
+                self._conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, h2.events.StreamEnded):
+                loop.call_later(self._behavior.get_delay(), self._respond, event.stream_id)
+        self._flush()
+
+    def _respond(self, stream_id: int) -> None:
+        """Send a success or an error from the mix."""
+        if self._transport is None:
+            return
+
+        headers = [('apns-id', str(uuid.uuid4()))]
+        body = b''
+        if self._behavior.fails():
+            status, reason = random.choice(APNS_ERRORS)
+            body = json.dumps({'reason': reason}).encode()
+            headers += [('content-type', 'application/json'), ('content-length', str(len(body)))]
+        else:
+            status = 200
+
+        try:
+            self._conn.send_headers(stream_id, [(':status', str(status)), *headers], end_stream=not body)
+            if body:
+                self._conn.send_data(stream_id, body, end_stream=True)
+        except h2.exceptions.StreamClosedError:  # The client gave up on the request
+            return
+        self._flush()
+
+    def _flush(self) -> None:
+        """Write pending frames to the socket."""
+        if self._transport is not None:
+            self._transport.write(self._conn.data_to_send())
+
+
+def create_fcm_app(behavior: Behavior) -> FastAPI:
+    """Return an app answering FCM v1 sends and Google OAuth token requests."""
+    app = FastAPI()
+
+    @app.post('/v1/projects/{project_id}/messages:send')
+    async def send(project_id: str, request: Request) -> JSONResponse:
+        await request.body()
+        await asyncio.sleep(behavior.get_delay())
+        if behavior.fails():
+            status, reason = random.choice(FCM_ERRORS)
+            return JSONResponse({'error': {'code': status, 'status': reason}}, status_code=status)
+        return JSONResponse({'name': f'projects/{project_id}/messages/{uuid.uuid4()}'})
+
+    @app.post('/token')
+    async def token() -> JSONResponse:
+        return JSONResponse({'access_token': str(uuid.uuid4()), 'expires_in': 3600, 'token_type': 'Bearer'})
+
+    return app
+
+
+def generate_certificate(directory: Path) -> tuple[Path, Path]:
+    """Write a self-signed certificate for localhost, return paths to it and its key."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+    now = datetime.now(UTC)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(minutes=1))
+        .not_valid_after(now + timedelta(days=1))
+        .add_extension(
+            x509.SubjectAlternativeName([x509.DNSName('localhost'), x509.IPAddress(ipaddress.ip_address('127.0.0.1'))]),
+            critical=False,
+        )
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+        .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(key.public_key()), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+
+    cert_path, key_path = directory / 'cert.pem', directory / 'key.pem'
+    cert_path.write_bytes(certificate.public_bytes(serialization.Encoding.PEM))
+    key_path.write_bytes(
+        key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    )
+    return cert_path, key_path
+
+
+def get_free_port(host: str) -> int:
+    """Return a port nothing listens on."""
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+class FakeProviders:
+    """Both stand-ins served by an event loop of a background thread."""
+
+    def __init__(self, behavior: Behavior, *, host: str = '127.0.0.1') -> None:
+        self.behavior = behavior
+        self.host = host
+        self.apns_port = get_free_port(host)
+        self.fcm_port = get_free_port(host)
+        self._directory = tempfile.TemporaryDirectory()
+        self.ca_file, self._key_file = generate_certificate(Path(self._directory.name))
+        self._fcm_server = uvicorn.Server(
+            uvicorn.Config(create_fcm_app(behavior), host=host, port=self.fcm_port, log_level='warning')
+        )
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=asyncio.run, args=(self._serve(),), daemon=True)
+
+    @property
+    def apns_server(self) -> str:
+        """URL of the APNS stand-in."""
+        return f'https://localhost:{self.apns_port}'
+
+    @property
+    def fcm_server(self) -> str:
+        """URL of the FCM stand-in."""
+        return f'http://{self.host}:{self.fcm_port}'
+
+    @property
+    def token_uri(self) -> str:
+        """URL of the Google OAuth token stand-in."""
+        return f'{self.fcm_server}/token'
+
+    def start(self) -> None:
+        """Start serving and wait until both stand-ins accept connections."""
+        self._thread.start()
+        if not self._started.wait(timeout=10):
+            msg = "Stand-in providers didn't start"
+            raise RuntimeError(msg)
+
+    def stop(self) -> None:
+        """Stop serving."""
+        self._fcm_server.should_exit = True
+        self._thread.join(timeout=10)
+        self._directory.cleanup()
+
+    async def _serve(self) -> None:
+        """Serve both stand-ins until stopped."""
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(self.ca_file, self._key_file)
+        ssl_context.set_alpn_protocols(['h2'])
+
+        loop = asyncio.get_running_loop()
+        apns_server = await loop.create_server(
+            lambda: APNSProtocol(self.behavior), self.host, self.apns_port, ssl=ssl_context
+        )
+        fcm_task = asyncio.create_task(self._fcm_server.serve())
+        # uvicorn only exposes a flag
+        while not self._fcm_server.started and not fcm_task.done():  # noqa: ASYNC110
+            await asyncio.sleep(0.01)
+        self._started.set()
+
+        try:
+            await fcm_task
+        finally:
+            apns_server.close()
+
+
+def main() -> None:
+    """Serve the stand-ins until interrupted."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    args = parser.parse_args()
+
+    behavior = Behavior(
+        latency=timedelta(milliseconds=args.latency_ms),
+        jitter=timedelta(milliseconds=args.jitter_ms),
+        error_rate=args.error_rate,
+    )
+    providers = FakeProviders(behavior)
+    providers.start()
+    print(f'APNS_PRODUCTION_SERVER={providers.apns_server}')  # noqa: T201
+    print(f'FCM_SERVER={providers.fcm_server}')  # noqa: T201
+    print(f'FIREBASE_TOKEN_URI={providers.token_uri}')  # noqa: T201
+    print(f'SSL_CERT_FILE={providers.ca_file}')  # noqa: T201
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        providers.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Cold start import time of the app, fails if it exceeds the budget.
+
+The app is imported in a fresh interpreter each run, like on a serverless cold start.
+Provider libraries must not be imported at all, they load on the first push.
+
+Run: python -m benchmarks.import_time [--budget-ms MS] [--runs N]
+The test suite runs both checks with the default budget as well.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+from project_base.config import Settings
+
+APP_MODULE = 'project_base.main'
+BUDGET_MS = 800
+# Heavy libraries used only once a push is sent to the provider
+LAZY_MODULES = ('cryptography.hazmat.primitives.asymmetric.ec', 'google.auth', 'google.oauth2', 'jwt', 'requests')
+
+
+def get_environment() -> dict[str, str]:
+    """Return the environment with placeholders for missing required settings."""
+    placeholders = {name: 'placeholder' for name, field in Settings.model_fields.items() if field.is_required()}
+    return {**placeholders, **os.environ}
+
+
+def measure_import(environment: dict[str, str]) -> tuple[float, dict[str, float]]:
+    """Import the app in a fresh interpreter.
+
+    Return the import time in ms and the cumulative time of each top-level import.
+    """
+    result = subprocess.run(  # noqa: S603
+        [sys.executable, '-X', 'importtime', '-c', f'import {APP_MODULE}'],
+        env=environment,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    total, top_level = 0.0, {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        # Imports made by the app module itself are indented by two spaces
+        if name.startswith('   ') and not name.startswith('    '):
+            top_level[name.strip()] = int(cumulative) / 1000
+        elif name.strip() == APP_MODULE:
+            total = int(cumulative) / 1000
+    return total, top_level
+
+
+def find_eager_imports(environment: dict[str, str]) -> list[str]:
+    """Return modules from LAZY_MODULES imported together with the app."""
+    code = f'import sys, {APP_MODULE}; print(*(m for m in {LAZY_MODULES!r} if m in sys.modules))'
+    result = subprocess.run(  # noqa: S603
+        [sys.executable, '-c', code], env=environment, capture_output=True, text=True, check=True
+    )
+    return result.stdout.split()
+
+
+def main() -> None:
+    """Run the check."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget-ms', type=float, default=BUDGET_MS)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    environment = get_environment()
+    measurements = [measure_import(environment) for _ in range(args.runs)]
+    total = statistics.median(total for total, _ in measurements)
+
+    print(f'{APP_MODULE} import: median {total:.0f} ms over {args.runs} runs, budget {args.budget_ms:.0f} ms')  # noqa: T201
+    for name, cumulative in sorted(measurements[-1][1].items(), key=lambda item: -item[1])[:10]:
+        print(f'  {name:<40} {cumulative:>8.1f} ms')  # noqa: T201
+
+    failures = []
+    if total > args.budget_ms:
+        failures.append(f'import time is over the budget by {total - args.budget_ms:.0f} ms')
+    if eager_imports := find_eager_imports(environment):
+        failures.append(f'provider modules imported eagerly: {", ".join(eager_imports)}')
+    if failures:
+        sys.exit('FAIL: ' + '; '.join(failures))
+    print('OK')  # noqa: T201
+
+
+if __name__ == '__main__':
+    main()
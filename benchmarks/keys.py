@@ -0,0 +1,11 @@
+"""Throwaway provider keys for the benchmarks."""
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+
+def generate_pem(private_key: ec.EllipticCurvePrivateKey | rsa.RSAPrivateKey) -> str:
+    """Return the key serialized as PEM."""
+    return private_key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode()
@@ -0,0 +1,242 @@
+"""Throughput, latency and allocations of the API sending to stand-in providers.
+
+Requests go to the app in-process, providers are answered by benchmarks.fake_providers.
+The stand-ins share the process and its CPU, so compare runs with each other rather
+than with production numbers.
+Scenarios sending to a user's tokens need REDIS_URL and are skipped without it.
+Invalid-token errors in the mix prune the benchmark user's tokens like in production.
+
+Run: python -m benchmarks.load [--requests N] [--concurrency N] [--tokens N] [--help]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Any
+
+import httpx
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+from fastapi import FastAPI
+
+from .fake_providers import Behavior, FakeProviders
+from .keys import generate_pem
+
+AUTH_TOKEN = 'benchmark'  # noqa: S105
+
+
+@dataclass(frozen=True)
+class Scenario:
+    """A request sent over and over."""
+
+    name: str
+    path: str
+    body: dict[str, Any]
+    # Pushes sent upstream per request
+    pushes: int
+    # Tokens to register for the user before the run
+    user_tokens: dict[str, list[str]] = field(default_factory=dict)
+
+
+@dataclass(frozen=True)
+class Result:
+    """Measurements of a scenario."""
+
+    requests_per_sec: float
+    pushes_per_sec: float
+    p50: timedelta
+    p99: timedelta
+    statuses: Counter[int]
+    # Peak of memory allocated while serving a request, traced separately
+    peak_bytes: int
+
+
+def configure_environment(providers: FakeProviders) -> None:
+    """Point the settings at the stand-ins, must run before the app is imported."""
+    os.environ.update(
+        {
+            'APNS_AUTH_KEY': generate_pem(ec.generate_private_key(ec.SECP256R1())),
+            'APNS_AUTH_KEY_ID': 'BENCHMARK',
+            'APNS_PRODUCTION_SERVER': providers.apns_server,
+            'APNS_TEAM_ID': 'BENCHMARK',
+            'APNS_USE_SANDBOX': 'false',
+            'AUTH_REQUEST_TOKEN': AUTH_TOKEN,
+            # The same push is sent to the same tokens over and over, measure the sends
+            # rather than dropped duplicates, held back or throttled pushes
+            'COALESCE_WINDOW_SECS': '0',
+            'DEVICE_RATE_LIMIT_ENABLED': 'false',
+            'DISPATCH_QUEUED': 'false',
+            'FCM_SERVER': providers.fcm_server,
+            'FIREBASE_AUTH_PROVIDER_X509_CERT_URL': 'https://www.googleapis.com/oauth2/v1/certs',
+            'FIREBASE_AUTH_URI': 'https://accounts.google.com/o/oauth2/auth',
+            'FIREBASE_CLIENT_EMAIL': 'benchmark@benchmark.iam.gserviceaccount.com',
+            'FIREBASE_CLIENT_ID': 'benchmark',
+            'FIREBASE_CLIENT_X509_CERT_URL': 'https://www.googleapis.com/robot/v1/metadata/x509/benchmark',
+            'FIREBASE_PRIVATE_KEY': generate_pem(rsa.generate_private_key(public_exponent=65537, key_size=2048)),
+            'FIREBASE_PRIVATE_KEY_ID': 'benchmark',
+            'FIREBASE_PROJECT_ID': 'benchmark',
+            'FIREBASE_TOKEN_URI': providers.token_uri,
+            'FIREBASE_TYPE': 'service_account',
+            'FIREBASE_UNIVERSE_DOMAIN': 'googleapis.com',
+            'IDEMPOTENCY_ENABLED': 'false',
+            'SSL_CERT_FILE': str(providers.ca_file),
+        }
+    )
+
+
+def build_scenarios(*, tokens: int, with_redis: bool) -> list[Scenario]:
+    """Return single-token, user's tokens and bulk scenarios for both platforms."""
+    scenarios = []
+    for platform in ('apns', 'fcm'):
+        user_id = f'benchmark-{uuid.uuid4()}'
+        user_tokens = [f'{platform}-user-token-{i}' for i in range(tokens)]
+        bulk_tokens = [f'{platform}-bulk-token-{i}' for i in range(tokens)]
+
+        scenarios.append(
+            Scenario(f'{platform} single token', f'/{platform}/send-by-token', {'token': f'{platform}-token'}, 1)
+        )
+        if with_redis:
+            scenarios.append(
+                Scenario(
+                    f'{platform} {tokens} user tokens',
+                    f'/{platform}/send-by-user-id',
+                    {'user_id': user_id},
+                    tokens,
+                    {user_id: user_tokens},
+                )
+            )
+        scenarios.append(
+            Scenario(f'{platform} bulk {tokens} tokens', f'/{platform}/send-bulk', {'tokens': bulk_tokens}, tokens)
+        )
+    return scenarios
+
+
+async def register_tokens(client: httpx.AsyncClient, scenario: Scenario, *, delete: bool = False) -> None:
+    """Add or delete the scenario's user tokens through the API."""
+    platform = scenario.path.split('/')[1]
+    action = 'delete-token' if delete else 'add-token'
+    for user_id, tokens in scenario.user_tokens.items():
+        for token in tokens:
+            await client.post(f'/{platform}/{action}', json={'user_id': user_id, 'token': token})
+
+
+async def run(client: httpx.AsyncClient, scenario: Scenario, *, requests: int, concurrency: int) -> Result:
+    """Send the scenario's request repeatedly, concurrency at a time."""
+    body = {'guid': str(uuid.uuid4()), 'status': 'ringing', **scenario.body}
+    latencies: list[float] = []
+    statuses: Counter[int] = Counter()
+    remaining = iter(range(requests))
+
+    async def send() -> None:
+        start = time.perf_counter()
+        response = await client.post(scenario.path, json=body)
+        latencies.append(time.perf_counter() - start)
+        statuses[response.status_code] += 1
+
+    async def worker() -> None:
+        for _ in remaining:
+            await send()
+
+    # Warm up connections and provider tokens
+    for _ in range(min(concurrency, requests)):
+        await send()
+    latencies.clear()
+    statuses.clear()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    measured_statuses = statuses.copy()
+
+    tracemalloc.start()
+    await send()
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return Result(
+        requests_per_sec=requests / elapsed,
+        pushes_per_sec=requests * scenario.pushes / elapsed,
+        p50=timedelta(seconds=percentiles[49]),
+        p99=timedelta(seconds=percentiles[98]),
+        statuses=measured_statuses,
+        peak_bytes=peak_bytes,
+    )
+
+
+def report_header() -> None:
+    """Print column names."""
+    print(  # noqa: T201
+        f'{"scenario":<28} {"req/s":>9} {"pushes/s":>10} {"p50 ms":>8} {"p99 ms":>8} {"peak KiB":>9}  statuses'
+    )
+
+
+def report(name: str, result: Result) -> None:
+    """Print a row of measurements."""
+    statuses = ' '.join(f'{status}:{count}' for status, count in sorted(result.statuses.items()))
+    print(  # noqa: T201
+        f'{name:<28} {result.requests_per_sec:>9.1f} {result.pushes_per_sec:>10.1f}'
+        f' {result.p50 / timedelta(milliseconds=1):>8.2f} {result.p99 / timedelta(milliseconds=1):>8.2f}'
+        f' {result.peak_bytes / 1024:>9.1f}  {statuses}'
+    )
+
+
+async def run_all(app: FastAPI, scenarios: list[Scenario], *, requests: int, concurrency: int) -> None:
+    """Run scenarios against the app with its lifespan."""
+    async with (
+        app.router.lifespan_context(app),
+        httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app),
+            base_url='http://benchmark/api/v1/pushes',
+            headers={'authorization': AUTH_TOKEN},
+            timeout=60,
+        ) as client,
+    ):
+        report_header()
+        for scenario in scenarios:
+            await register_tokens(client, scenario)
+            try:
+                result = await run(client, scenario, requests=requests, concurrency=concurrency)
+            finally:
+                await register_tokens(client, scenario, delete=True)
+            report(scenario.name, result)
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--tokens', type=int, default=10, help='tokens per user and per bulk request')
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--jitter-ms', type=float, default=5)
+    parser.add_argument('--error-rate', type=float, default=0)
+    args = parser.parse_args()
+
+    behavior = Behavior(
+        latency=timedelta(milliseconds=args.latency_ms),
+        jitter=timedelta(milliseconds=args.jitter_ms),
+        error_rate=args.error_rate,
+    )
+    providers = FakeProviders(behavior)
+    providers.start()
+    configure_environment(providers)
+
+    from project_base.main import app  # Settings are read on import
+
+    scenarios = build_scenarios(tokens=args.tokens, with_redis=bool(os.environ.get('REDIS_URL')))
+    try:
+        asyncio.run(run_all(app, scenarios, requests=args.requests, concurrency=args.concurrency))
+    finally:
+        providers.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Throughput of the in-process cache under concurrent access from threads.
+
+Threads read and write keys picked at random, like sync routes served by the
+threadpool. With more keys than max entries, part of the reads miss and the writes
+evict. The GIL serializes the work, so more threads measure the cost of contention
+for the lock and switching between threads rather than parallel speedup.
+
+Run: python -m benchmarks.local_cache [--operations N] [--keys N] [--max-entries N]
+"""
+
+import argparse
+import random
+import threading
+import time
+from datetime import UTC, datetime, timedelta
+
+from integrations.cache import LocalCacheRepository
+
+THREAD_COUNTS = (1, 4, 16, 64)
+
+
+def run(cache: LocalCacheRepository, *, threads: int, operations: int, keys: int, write_ratio: float) -> float:
+    """Spread operations over threads, return seconds it took all of them."""
+    expires_at = datetime.now(UTC) + timedelta(hours=1)
+    per_thread = operations // threads
+    barrier = threading.Barrier(threads + 1)
+
+    def work(seed: int) -> None:
+        rng = random.Random(seed)
+        picks = [(f'key-{rng.randrange(keys)}', rng.random() < write_ratio) for _ in range(per_thread)]
+        barrier.wait()
+        for key, is_write in picks:
+            if is_write:
+                cache.set(key, 'value', expires_at)
+            else:
+                cache.get(key)
+
+    workers = [threading.Thread(target=work, args=(seed,)) for seed in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--operations', type=int, default=400_000)
+    parser.add_argument('--keys', type=int, default=20_000)
+    parser.add_argument('--max-entries', type=int, default=10_000)
+    parser.add_argument('--write-ratio', type=float, default=0.1)
+    args = parser.parse_args()
+
+    print(f'{"threads":>7} {"ops/s":>12} {"hit rate":>9} {"evictions":>10} {"size":>7}')  # noqa: T201
+    for threads in THREAD_COUNTS:
+        cache = LocalCacheRepository(max_entries=args.max_entries)
+        seconds = run(cache, threads=threads, operations=args.operations, keys=args.keys, write_ratio=args.write_ratio)
+        stats = cache.stats()
+        hit_rate = stats.hits / max(stats.hits + stats.misses, 1)
+        print(  # noqa: T201
+            f'{threads:>7} {args.operations / seconds:>12.0f} {hit_rate:>9.1%} {stats.evictions:>10} {stats.size:>7}'
+        )
+
+
+if __name__ == '__main__':
+    main()
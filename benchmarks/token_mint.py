@@ -0,0 +1,77 @@
+"""Cost of minting provider tokens with and without cached keys.
+
+Run: python -m benchmarks.token_mint [--number N]
+"""
+
+import argparse
+import os
+import time
+import timeit
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from google.oauth2.service_account import Credentials
+
+from .import_time import get_environment
+from .keys import generate_pem
+
+SCOPES = ['https://www.googleapis.com/auth/firebase.messaging']
+
+
+def service_account_info(private_key: str) -> dict[str, str]:
+    """Return a fake service account."""
+    return {
+        'client_email': 'bench@example.iam.gserviceaccount.com',
+        'private_key': private_key,
+        'private_key_id': 'bench',
+        'project_id': 'bench',
+        'token_uri': 'https://oauth2.googleapis.com/token',
+        'type': 'service_account',
+    }
+
+
+def report(name: str, seconds: float, number: int) -> None:
+    """Print time per operation."""
+    print(f'{name:<45} {seconds / number * 1e6:>10.1f} us/op')  # noqa: T201
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=2000)
+    number = parser.parse_args().number
+
+    # Provider settings aren't used, but the package reads them on import
+    os.environ.update(get_environment())
+    from integrations.apns.credentials import load_signing_key
+
+    apns_pem = generate_pem(ec.generate_private_key(ec.SECP256R1()))
+    payload = {'iss': 'TEAM', 'iat': int(time.time())}
+    headers = {'alg': 'ES256', 'kid': 'KEY'}
+
+    def mint_from_pem() -> None:
+        jwt.encode(payload, apns_pem, algorithm='ES256', headers=headers)
+
+    def mint_from_cached_key() -> None:
+        jwt.encode(payload, load_signing_key(apns_pem), algorithm='ES256', headers=headers)
+
+    report('APNS JWT, PEM parsed on each mint', timeit.timeit(mint_from_pem, number=number), number)
+    report('APNS JWT, cached key', timeit.timeit(mint_from_cached_key, number=number), number)
+
+    info = service_account_info(generate_pem(rsa.generate_private_key(public_exponent=65537, key_size=2048)))
+    cached_creds = Credentials.from_service_account_info(info, scopes=SCOPES)
+
+    # The OAuth round trip itself is left out: only the local work before it is measured
+    def assertion_from_info() -> None:
+        creds = Credentials.from_service_account_info(info, scopes=SCOPES)
+        creds._make_authorization_grant_assertion()  # noqa: SLF001
+
+    def assertion_from_cached_creds() -> None:
+        cached_creds._make_authorization_grant_assertion()  # noqa: SLF001
+
+    report('Google assertion, credentials built each time', timeit.timeit(assertion_from_info, number=number), number)
+    report('Google assertion, cached credentials', timeit.timeit(assertion_from_cached_creds, number=number), number)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import asyncio
+import threading
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager, suppress
+from datetime import UTC, datetime, timedelta
+from logging import Logger
+
+from redis import Redis
+from redis.exceptions import LockError
+
+from .cache import CacheRepository
+from .metrics import access_token_lookups
+
+
+class SingleFlightLock:
+    """A process-local lock optionally combined with a Redis lock shared by instances.
+
+    If the Redis lock can't be acquired in time, the holder proceeds anyway: a duplicate
+    token mint is better than a failed push.
+    """
+
+    def __init__(
+        self, name: str, connection: Redis | None, *, timeout: float = 30, blocking_timeout: float = 10
+    ) -> None:
+        self._name = f'lock:{name}'
+        self._con = connection
+        self._timeout = timeout
+        self._blocking_timeout = blocking_timeout
+        self._local_lock = threading.Lock()
+
+    @contextmanager
+    def hold(self) -> Iterator[None]:
+        """Hold the lock for the duration of the block."""
+        with self._local_lock:
+            if self._con is None:
+                yield
+                return
+
+            lock = self._con.lock(self._name, timeout=self._timeout, blocking_timeout=self._blocking_timeout)
+            acquired = lock.acquire()
+            try:
+                yield
+            finally:
+                if acquired:
+                    with suppress(LockError):  # The lock has expired
+                        lock.release()
+
+
+class AccessTokenCache:
+    """Provider access token kept in a cache and minted by a single caller at a time."""
+
+    def __init__(
+        self,
+        cache_storage: CacheRepository,
+        key: str,
+        mint: Callable[[], tuple[str, datetime]],
+        *,
+        lock: SingleFlightLock | None = None,
+    ) -> None:
+        self._cache_storage = cache_storage
+        self._key = key
+        self._expires_at_key = f'{key}:expires_at'
+        self._mint = mint
+        self._lock = lock or SingleFlightLock(key, None)
+
+    def get(self) -> str:
+        """Retrieve the token from the cache or mint it."""
+        if cached_token := self._cache_storage.get(self._key):
+            access_token_lookups.labels(self._key, 'hit').inc()
+            return cached_token
+
+        with self._lock.hold():
+            # Another caller might have minted the token while we were waiting
+            if cached_token := self._cache_storage.get(self._key):
+                access_token_lookups.labels(self._key, 'hit').inc()
+                return cached_token
+            access_token_lookups.labels(self._key, 'miss').inc()
+            return self._mint_and_store()[0]
+
+    def refresh(self, margin: timedelta) -> datetime:
+        """Mint a new token unless the cached one is valid for longer than margin.
+
+        Return the expiration time of the cached token.
+        """
+        with self._lock.hold():
+            cached_token = self._cache_storage.get(self._key)
+            expires_at = self._cache_storage.get(self._expires_at_key)
+            if cached_token and expires_at and datetime.fromisoformat(expires_at) - margin > datetime.now(UTC):
+                return datetime.fromisoformat(expires_at)
+            return self._mint_and_store()[1]
+
+    def delete(self) -> None:
+        """Delete the cached token."""
+        self._cache_storage.delete(self._key)
+        self._cache_storage.delete(self._expires_at_key)
+
+    def _mint_and_store(self) -> tuple[str, datetime]:
+        """Mint a token and put it into the cache."""
+        token, expires_at = self._mint()
+        self._cache_storage.set(self._key, token, expires_at=expires_at)
+        self._cache_storage.set(self._expires_at_key, expires_at.isoformat(), expires_at=expires_at)
+        return token, expires_at
+
+
+class AccessTokenRefresher:
+    """Renews provider access tokens in the background shortly before they expire."""
+
+    def __init__(
+        self,
+        logger: Logger,
+        tokens: Iterable[AccessTokenCache],
+        *,
+        margin: timedelta,
+        retry_delay: timedelta = timedelta(seconds=30),
+    ) -> None:
+        self._logger = logger
+        self._tokens = list(tokens)
+        self._margin = margin
+        self._retry_delay = retry_delay
+
+    async def run(self) -> None:
+        """Keep refreshing all tokens until cancelled."""
+        await asyncio.gather(*(self._refresh_forever(token) for token in self._tokens))
+
+    async def _refresh_forever(self, token: AccessTokenCache) -> None:
+        """Refresh a token each time it gets close to the expiration."""
+        while True:
+            try:
+                expires_at = await asyncio.to_thread(token.refresh, self._margin)
+            except Exception:
+                self._logger.exception('Access token refresh error')
+                delay = self._retry_delay
+            else:
+                delay = max(expires_at - self._margin - datetime.now(UTC), self._retry_delay)
+            await asyncio.sleep(delay.total_seconds())
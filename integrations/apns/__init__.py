@@ -1,10 +1,12 @@
-from .client import APNSClient as APNSClient
+from .client import AsyncAPNSClient as AsyncAPNSClient
+from .client import PreparedNotification as PreparedNotification
 from .credentials import TokenCredentials as TokenCredentials
 from .errors import AnotherError as AnotherError
 from .errors import APNSServiceError as APNSServiceError
 from .errors import BadDeviceTokenError as BadDeviceTokenError
 from .errors import ExpiredProviderTokenError as ExpiredProviderTokenError
 from .errors import ExpiredTokenError as ExpiredTokenError
+from .errors import ServiceUnavailableError as ServiceUnavailableError
 from .errors import TooManyRequestsError as TooManyRequestsError
 from .errors import UnregisteredError as UnregisteredError
 from .payload import Payload as Payload
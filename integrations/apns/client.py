@@ -1,4 +1,6 @@
+import asyncio
 import json
+from dataclasses import dataclass
 from enum import StrEnum
 from logging import Logger
 
@@ -6,6 +8,11 @@ import httpx
 
 from fastapi import status
 
+from project_base.config import get_settings
+
+from ..circuit_breaker import CircuitBreaker
+from ..http import AsyncConnectionManager, parse_retry_after
+from ..metrics import current_route, stage_seconds, upstream_responses
 from .credentials import TokenCredentials
 from .errors import (
     AnotherError,
@@ -13,11 +20,14 @@ from .errors import (
     BadDeviceTokenError,
     ExpiredProviderTokenError,
     ExpiredTokenError,
+    ServiceUnavailableError,
     TooManyRequestsError,
     UnregisteredError,
 )
 from .payload import Payload
 
+settings = get_settings()
+
 
 class NotificationType(StrEnum):
     """Push types."""
@@ -25,46 +35,73 @@ class NotificationType(StrEnum):
     VOIP = 'voip'
 
 
-class APNSClient:
-    """Client class for Apple Push Notification service."""
+@dataclass(frozen=True, slots=True)
+class PreparedNotification:
+    """Push body and headers built once and sent to any number of devices."""
 
-    SANDBOX_SERVER = 'https://api.sandbox.push.apple.com:443'
-    PRODUCTION_SERVER = 'https://api.push.apple.com:443'
+    body: bytes
+    headers: dict[str, str]
 
-    def __init__(self, logger: Logger, credentials: TokenCredentials, *, use_sandbox: bool = False) -> None:
-        self._logger = logger
-        self._credentials = credentials
-        self._use_sandbox = use_sandbox
 
-    def send_notification(
-        self, device_token: str, payload: Payload, *, topic: str | None = None, expiration: int | None = None
-    ) -> None:
-        """Send push.
+class BaseAPNSClient:
+    """Request building and response handling of APNS clients."""
 
-        docs: https://developer.apple.com/documentation/usernotifications
-        /sending-notification-requests-to-apns
-        """
-        payload_json = json.dumps(payload.as_dict(), separators=(',', ':')).encode()
-        headers = self._get_headers(topic, expiration)
-
-        url = (self.SANDBOX_SERVER if self._use_sandbox else self.PRODUCTION_SERVER) + f'/3/device/{device_token}'
-
-        with httpx.Client(http2=True) as c:
-            try:
-                resp = c.post(url, json=payload_json, headers=headers)
-            except httpx.HTTPError as err:
-                self._logger.exception('APNS error')
-                raise APNSServiceError from err
+    SANDBOX_SERVER = settings.APNS_SANDBOX_SERVER
+    PRODUCTION_SERVER = settings.APNS_PRODUCTION_SERVER
 
+    def __init__(
+        self,
+        logger: Logger,
+        credentials: TokenCredentials,
+        *,
+        use_sandbox: bool = False,
+        breaker: CircuitBreaker | None = None,
+    ) -> None:
+        self._logger = logger
+        self._credentials = credentials
+        self._use_sandbox = use_sandbox
+        self._breaker = breaker
+
+    @property
+    def server(self) -> str:
+        """APNS host the client sends pushes to."""
+        return self.SANDBOX_SERVER if self._use_sandbox else self.PRODUCTION_SERVER
+
+    @property
+    def credentials(self) -> TokenCredentials:
+        """Provider token credentials."""
+        return self._credentials
+
+    def delete_access_token(self) -> None:
+        """Delete the cached provider token."""
+        self._credentials.delete_access_token()
+
+    def _check_circuit(self) -> None:
+        """Fail without a request while APNS is considered down."""
+        if self._breaker is not None and (blocked_for := self._breaker.blocked_for()):
+            reason = 'CircuitOpen'
+            raise ServiceUnavailableError(reason, retry_after=blocked_for)
+
+    def _record_call(self, *, succeeded: bool) -> None:
+        """Count the outcome of a request for the circuit breaker."""
+        if self._breaker is not None:
+            self._breaker.record(succeeded=succeeded)
+
+    def _handle_response(self, resp: httpx.Response) -> None:
+        """Raise an error matching the APNS failure reason."""
         if resp.status_code == status.HTTP_200_OK:
+            upstream_responses.labels('apns', current_route.get(), 'ok').inc()
             return
 
         try:
             reason = resp.json()['reason']
         except (json.JSONDecodeError, KeyError) as err:
+            upstream_responses.labels('apns', current_route.get(), str(resp.status_code)).inc()
             self._logger.exception(f'APNS error with response: {resp.text}')
             raise APNSServiceError from err
 
+        upstream_responses.labels('apns', current_route.get(), reason).inc()
+
         if reason == 'BadDeviceToken':
             raise BadDeviceTokenError
         if reason == 'ExpiredProviderToken':
@@ -74,12 +111,22 @@ class APNSClient:
         if reason == 'Unregistered':
             raise UnregisteredError
         if reason == 'TooManyRequests':
-            raise TooManyRequestsError
+            raise TooManyRequestsError(retry_after=parse_retry_after(resp))
+        if reason in {'InternalServerError', 'ServiceUnavailable', 'Shutdown'}:
+            raise ServiceUnavailableError(reason, retry_after=parse_retry_after(resp))
         raise AnotherError(reason)
 
-    def _get_headers(self, topic: str | None = None, expiration: int | None = None) -> dict:
-        """Return headers for a request."""
-        headers = {}
+    def prepare(
+        self,
+        payload: Payload,
+        *,
+        topic: str | None = None,
+        expiration: int | None = None,
+        priority: int | None = None,
+        collapse_id: str | None = None,
+    ) -> PreparedNotification:
+        """Build the parts of a request that are the same for all devices."""
+        headers = {'content-type': 'application/json'}
 
         if topic:
             inferred_push_type = None
@@ -94,5 +141,60 @@ class APNSClient:
         if expiration is not None:
             headers['apns-expiration'] = str(expiration)
 
-        headers['authorization'] = 'bearer ' + self._credentials.get_token()
-        return headers
+        if priority is not None:
+            headers['apns-priority'] = str(priority)
+
+        # Devices keep only the latest of the notifications with the same collapse id
+        if collapse_id:
+            headers['apns-collapse-id'] = collapse_id
+
+        return PreparedNotification(payload.encode(), headers)
+
+    def _get_headers(self, notification: PreparedNotification) -> dict[str, str]:
+        """Return headers for a request."""
+        return {**notification.headers, 'authorization': 'bearer ' + self._credentials.get_token()}
+
+
+class AsyncAPNSClient(BaseAPNSClient):
+    """Asyncio client class for Apple Push Notification service."""
+
+    def __init__(
+        self,
+        logger: Logger,
+        credentials: TokenCredentials,
+        *,
+        connections: AsyncConnectionManager,
+        use_sandbox: bool = False,
+        breaker: CircuitBreaker | None = None,
+    ) -> None:
+        super().__init__(logger, credentials, use_sandbox=use_sandbox, breaker=breaker)
+        self._connections = connections
+
+    async def send_notification(
+        self, device_token: str, payload: Payload, *, topic: str | None = None, expiration: int | None = None
+    ) -> None:
+        """Send push.
+
+        docs: https://developer.apple.com/documentation/usernotifications
+        /sending-notification-requests-to-apns
+        """
+        await self.send_prepared(device_token, self.prepare(payload, topic=topic, expiration=expiration))
+
+    async def send_prepared(self, device_token: str, notification: PreparedNotification) -> None:
+        """Send a prepared push to a device."""
+        self._check_circuit()
+        # A provider token might need to be minted or fetched from Redis
+        with stage_seconds.labels('apns', 'credentials').time():
+            headers = await asyncio.to_thread(self._get_headers, notification)
+
+        connection = self._connections.get(self.server)
+
+        try:
+            resp = await connection.post(f'/3/device/{device_token}', content=notification.body, headers=headers)
+        except httpx.HTTPError as err:
+            self._record_call(succeeded=False)
+            self._logger.exception('APNS error')
+            raise APNSServiceError from err
+
+        self._record_call(succeeded=resp.status_code < status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self._handle_response(resp)
@@ -1,10 +1,28 @@
 import time
 from datetime import UTC, datetime, timedelta
+from functools import lru_cache
+from typing import TYPE_CHECKING
 
-import jwt
-
+from ..access_tokens import AccessTokenCache, SingleFlightLock
 from ..cache import CacheRepository
 
+if TYPE_CHECKING:
+    from cryptography.hazmat.primitives.asymmetric.ec import EllipticCurvePrivateKey
+
+
+@lru_cache
+def load_signing_key(auth_key: str) -> 'EllipticCurvePrivateKey':
+    """Parse the PEM encoded APNS auth key once."""
+    # Crypto libraries are imported on the first mint to keep cold starts fast
+    from cryptography.hazmat.primitives.asymmetric.ec import EllipticCurvePrivateKey
+    from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+    key = load_pem_private_key(auth_key.encode(), password=None)
+    if not isinstance(key, EllipticCurvePrivateKey):
+        msg = 'APNS auth key must be an EC private key'
+        raise TypeError(msg)
+    return key
+
 
 class TokenCredentials:
     """JWT based authentication.
@@ -17,30 +35,43 @@ class TokenCredentials:
     ENCRYPTION_ALGORITHM = 'ES256'
     DEFAULT_TOKEN_LIFETIME_MINS = 55
 
-    def __init__(self, cache_storage: CacheRepository, auth_key: str, auth_key_id: str, team_id: str) -> None:
-        self._cache_storage = cache_storage
+    def __init__(
+        self,
+        cache_storage: CacheRepository,
+        auth_key: str,
+        auth_key_id: str,
+        team_id: str,
+        *,
+        lock: SingleFlightLock | None = None,
+    ) -> None:
         self._auth_key = auth_key
         self._auth_key_id = auth_key_id
         self._team_id = team_id
+        self.access_token = AccessTokenCache(cache_storage, self.ACCESS_TOKEN_CACHE_KEY, self._mint_token, lock=lock)
 
     def get_token(self) -> str:
         """Retrieve an access token from the cache or create it."""
-        if cached_token := self._cache_storage.get(self.ACCESS_TOKEN_CACHE_KEY):
-            return cached_token
-
-        token = self._create_token()
-        expires_at = datetime.now(UTC) + timedelta(minutes=self.DEFAULT_TOKEN_LIFETIME_MINS)
-        self._cache_storage.set(self.ACCESS_TOKEN_CACHE_KEY, token, expires_at=expires_at)
-        return token
+        return self.access_token.get()
 
     def delete_access_token(self) -> None:
         """Delete the cached access token."""
-        self._cache_storage.delete(self.ACCESS_TOKEN_CACHE_KEY)
+        self.access_token.delete()
+
+    def _mint_token(self) -> tuple[str, datetime]:
+        """Create JWT token and return it with its expiration time."""
+        expires_at = datetime.now(UTC) + timedelta(minutes=self.DEFAULT_TOKEN_LIFETIME_MINS)
+        return self._create_token(), expires_at
 
     def _create_token(self) -> str:
         """Create JWT token."""
+        import jwt
+
         payload = {'iss': self._team_id, 'iat': int(time.time())}
         headers = {'alg': self.ENCRYPTION_ALGORITHM, 'kid': self._auth_key_id}
         return jwt.encode(
-            payload, self._auth_key, algorithm=self.ENCRYPTION_ALGORITHM, headers=headers, sort_headers=False
+            payload,
+            load_signing_key(self._auth_key),
+            algorithm=self.ENCRYPTION_ALGORITHM,
+            headers=headers,
+            sort_headers=False,
         )
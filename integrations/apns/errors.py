@@ -1,6 +1,11 @@
 class APNSServiceError(Exception):
     """Exception for APNS service errors."""
 
+    def __init__(self, *args: object, retry_after: float | None = None) -> None:
+        super().__init__(*args)
+        # Seconds to wait before the next attempt, if the server told so
+        self.retry_after = retry_after
+
 
 class BadDeviceTokenError(APNSServiceError):
     """The specified device token is invalid.
@@ -29,8 +34,13 @@ class TooManyRequestsError(APNSServiceError):
     """Too many requests were made consecutively to the same device token."""
 
 
+class ServiceUnavailableError(APNSServiceError):
+    """APNS is down or shutting down, the request should be retried later."""
+
+
 class AnotherError(APNSServiceError):
     """Another reason."""
 
     def __init__(self, reason: str) -> None:
+        super().__init__(reason)
         self.reason = reason
@@ -1,8 +1,29 @@
+import json
 from typing import Any
 
 
 class PayloadAlert:
-    """A class for alert body initializing."""
+    """A class for alert body initializing.
+
+    The body is built once and reused until an attribute is reassigned, so that a
+    payload with the alert can tell whether its encoded body is still current.
+    """
+
+    __slots__ = (
+        '_dict',
+        'body',
+        'body_localized_args',
+        'body_localized_key',
+        'launch_image',
+        'subtitle',
+        'subtitle_localized_args',
+        'subtitle_localized_key',
+        'title',
+        'title_localized_args',
+        'title_localized_key',
+    )
+
+    _dict: dict[str, Any] | None
 
     def __init__(  # noqa: PLR0913
         self,
@@ -29,8 +50,20 @@ class PayloadAlert:
         self.body_localized_args = body_localized_args
         self.launch_image = launch_image
 
-    def as_dict(self) -> dict[str, Any]:  # noqa: C901
-        """Return body."""
+    def __setattr__(self, name: str, value: object) -> None:
+        """Set an attribute, dropping the built body."""
+        super().__setattr__(name, value)
+        if name != '_dict':
+            super().__setattr__('_dict', None)
+
+    def as_dict(self) -> dict[str, Any]:
+        """Return body, the same object until an attribute is reassigned."""
+        if self._dict is None:
+            self._dict = self._build_dict()
+        return self._dict
+
+    def _build_dict(self) -> dict[str, Any]:  # noqa: C901
+        """Build body."""
         result: dict[str, Any] = {}
 
         if self.title:
@@ -61,7 +94,31 @@ class PayloadAlert:
 
 
 class Payload:
-    """A class for payload initializing."""
+    """A class for payload initializing.
+
+    The JSON body is encoded once and reused until an attribute of the payload or of
+    its alert is reassigned, changes made inside the custom object in place aren't
+    noticed.
+    """
+
+    # Attributes of the encoded body cache, setting them keeps the body
+    _CACHE_SLOTS = frozenset({'_alert_dict', '_encoded'})
+
+    __slots__ = (
+        '_alert_dict',
+        '_encoded',
+        'alert',
+        'badge',
+        'category',
+        'content_available',
+        'custom',
+        'mutable_content',
+        'sound',
+        'thread_id',
+    )
+
+    _alert_dict: dict[str, Any] | None
+    _encoded: bytes | None
 
     def __init__(  # noqa: PLR0913
         self,
@@ -75,6 +132,8 @@ class Payload:
         content_available: bool = False,
         mutable_content: bool = False,
     ) -> None:
+        # Body of the alert the payload was encoded with
+        self._alert_dict = None
         self.alert = alert
         self.badge = badge
         self.sound = sound
@@ -84,6 +143,12 @@ class Payload:
         self.mutable_content = mutable_content
         self.thread_id = thread_id
 
+    def __setattr__(self, name: str, value: object) -> None:
+        """Set an attribute, dropping the encoded body."""
+        super().__setattr__(name, value)
+        if name not in self._CACHE_SLOTS:
+            super().__setattr__('_encoded', None)
+
     def as_dict(self) -> dict[str, Any]:
         """Return body."""
         result: dict[str, dict[str, Any]] = {'aps': {}}
@@ -106,3 +171,11 @@ class Payload:
             result.update(self.custom)
 
         return result
+
+    def encode(self) -> bytes:
+        """Return compact JSON body."""
+        alert_dict = self.alert.as_dict() if isinstance(self.alert, PayloadAlert) else None
+        if self._encoded is None or alert_dict is not self._alert_dict:
+            self._encoded = json.dumps(self.as_dict(), separators=(',', ':')).encode()
+            self._alert_dict = alert_dict
+        return self._encoded
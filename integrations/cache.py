@@ -1,8 +1,14 @@
-from datetime import UTC, datetime
-from typing import Protocol, Self
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import UTC, datetime, timedelta
+from typing import Protocol
 
 from redis import Redis
 
+from .metrics import near_cache_lookups
+
 
 class CacheRepository(Protocol):
     """A protocol for cache storing."""
@@ -13,40 +19,97 @@ class CacheRepository(Protocol):
     def get(self, key: str) -> str | None:
         """Get value by key."""
 
+    def get_with_expiry(self, key: str) -> tuple[str | None, datetime | None]:
+        """Get value by key and the time it expires at, None if it doesn't expire."""
+
     def set(self, key: str, value: str, expires_at: datetime) -> None:
         """Set value by key with expiration time."""
 
 
-class LocalCacheRepository:
-    """Local singletone implementation of CacheRepository protocol based on dict."""
+@dataclass(frozen=True)
+class CacheStats:
+    """Counters of an in-process cache since it was created."""
 
-    _instance = None
+    hits: int
+    misses: int
+    # Values dropped to make room for new ones
+    evictions: int
+    # Values dropped because they expired, on access or by a sweep
+    expirations: int
+    size: int
 
-    def __new__(cls) -> Self:
-        """Singletone class."""
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-        return cls._instance
 
-    def __init__(self) -> None:
-        self._data: dict[str, tuple[str, datetime]] = {}
+class LocalCacheRepository:
+    """In-process implementation of CacheRepository protocol, safe to share by threads.
+
+    At most max_entries values are kept, the least recently used ones are evicted
+    first. Expiry is tracked on the monotonic clock, expired values are dropped when
+    read and by a sweep made on a write at most every sweep_interval.
+    """
+
+    def __init__(self, *, max_entries: int = 10_000, sweep_interval: timedelta = timedelta(minutes=1)) -> None:
+        self._max_entries = max_entries
+        self._sweep_interval = sweep_interval.total_seconds()
+        # Key -> value and monotonic time it expires at, the most recently used last
+        self._data: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + self._sweep_interval
+        self._hits = self._misses = self._evictions = self._expirations = 0
 
     def delete(self, key: str) -> None:
         """Delete value by key."""
-        self._data.pop(key, None)
+        with self._lock:
+            self._data.pop(key, None)
 
     def get(self, key: str) -> str | None:
         """Get value by key."""
-        value, expires_at = self._data.get(key, (None, None))
-
-        if value is not None and expires_at and expires_at < datetime.now(UTC):
-            self._data.pop(key, None)
-            return None
-        return value
+        return self.get_with_expiry(key)[0]
+
+    def get_with_expiry(self, key: str) -> tuple[str | None, datetime | None]:
+        """Get value by key and the time it expires at."""
+        now = time.monotonic()
+        with self._lock:
+            if (item := self._data.get(key)) is None:
+                self._misses += 1
+                return None, None
+
+            value, expires_at = item
+            if expires_at <= now:
+                del self._data[key]
+                self._expirations += 1
+                self._misses += 1
+                return None, None
+
+            self._data.move_to_end(key)
+            self._hits += 1
+        return value, datetime.now(UTC) + timedelta(seconds=expires_at - now)
 
     def set(self, key: str, value: str, expires_at: datetime) -> None:
         """Set value by key with expiration time."""
-        self._data[key] = (value, expires_at)
+        now = time.monotonic()
+        # The wall clock may be adjusted, the value lives for the time left until then
+        monotonic_expires_at = now + (expires_at - datetime.now(UTC)).total_seconds()
+        with self._lock:
+            self._data[key] = (value, monotonic_expires_at)
+            self._data.move_to_end(key)
+            if now >= self._next_sweep:
+                self._sweep(now)
+            while len(self._data) > self._max_entries:
+                self._data.popitem(last=False)
+                self._evictions += 1
+
+    def stats(self) -> CacheStats:
+        """Return the counters of the cache."""
+        with self._lock:
+            return CacheStats(self._hits, self._misses, self._evictions, self._expirations, len(self._data))
+
+    def _sweep(self, now: float) -> None:
+        """Drop all expired values, the lock must be held."""
+        expired = [key for key, (_, expires_at) in self._data.items() if expires_at <= now]
+        for key in expired:
+            del self._data[key]
+        self._expirations += len(expired)
+        self._next_sweep = now + self._sweep_interval
 
 
 class RedisCacheRepository:
@@ -63,6 +126,61 @@ class RedisCacheRepository:
         """Get value by key."""
         return self._con.get(key)  # type: ignore[return-value]
 
+    def get_with_expiry(self, key: str) -> tuple[str | None, datetime | None]:
+        """Get value by key and the time it expires at, None if it doesn't expire."""
+        pipe = self._con.pipeline()
+        pipe.get(key)
+        pipe.pttl(key)
+        value, ttl_ms = pipe.execute()
+        # PTTL is negative for keys without an expiration time or gone meanwhile
+        expires_at = datetime.now(UTC) + timedelta(milliseconds=ttl_ms) if ttl_ms >= 0 else None
+        return value, expires_at
+
     def set(self, key: str, value: str, expires_at: datetime) -> None:
         """Set value by key with expiration time."""
         self._con.set(key, value, exat=expires_at)
+
+
+class LayeredCacheRepository:
+    """Two-tier implementation of CacheRepository protocol.
+
+    Values are read through a short-lived in-process copy in front of a shared cache,
+    so hot keys need no round trip to the shared cache. A local copy lives no longer
+    than local_ttl, which bounds how stale it can get after another process changes it,
+    nor than the value in the shared cache.
+    """
+
+    def __init__(self, local: CacheRepository, remote: CacheRepository, *, local_ttl: timedelta) -> None:
+        self._local = local
+        self._remote = remote
+        self._local_ttl = local_ttl
+
+    def delete(self, key: str) -> None:
+        """Delete value by key from both tiers."""
+        self._local.delete(key)
+        self._remote.delete(key)
+
+    def get(self, key: str) -> str | None:
+        """Get value by key from the local tier or fall back to the shared one."""
+        return self.get_with_expiry(key)[0]
+
+    def get_with_expiry(self, key: str) -> tuple[str | None, datetime | None]:
+        """Get value by key and the time it expires at from the local or shared tier."""
+        value, expires_at = self._local.get_with_expiry(key)
+        if value is not None:
+            near_cache_lookups.labels('hit').inc()
+            return value, expires_at
+
+        near_cache_lookups.labels('miss').inc()
+        value, expires_at = self._remote.get_with_expiry(key)
+        if value is not None:
+            local_expires_at = datetime.now(UTC) + self._local_ttl
+            if expires_at is not None:
+                local_expires_at = min(local_expires_at, expires_at)
+            self._local.set(key, value, expires_at=local_expires_at)
+        return value, expires_at
+
+    def set(self, key: str, value: str, expires_at: datetime) -> None:
+        """Set value by key with expiration time in both tiers."""
+        self._remote.set(key, value, expires_at=expires_at)
+        self._local.set(key, value, expires_at=min(expires_at, datetime.now(UTC) + self._local_ttl))
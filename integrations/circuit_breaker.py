@@ -0,0 +1,196 @@
+import asyncio
+import threading
+import time
+from collections.abc import Iterable
+from datetime import timedelta
+from enum import StrEnum
+from logging import Logger
+
+from redis import Redis
+
+from .metrics import circuit_transitions
+
+
+class CircuitState(StrEnum):
+    """States of a circuit breaker."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    # A few probe calls are let through to find out whether the provider is back
+    HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """Fails calls to a provider fast while too many of its recent calls failed.
+
+    Outcomes are counted in a rolling window of buckets. Once the failure rate in the
+    window reaches failure_rate, calls are blocked for open_for, then probes calls are
+    let through: the circuit closes once all of them succeed and opens again on the
+    first failure.
+    """
+
+    # Buckets the window is split into, the oldest one is dropped as a whole
+    BUCKETS = 10
+
+    def __init__(  # noqa: PLR0913
+        self,
+        name: str,
+        logger: Logger,
+        *,
+        window: timedelta,
+        min_calls: int,
+        failure_rate: float,
+        open_for: timedelta,
+        probes: int,
+    ) -> None:
+        self.name = name
+        self._logger = logger
+        self._min_calls = min_calls
+        self._failure_rate = failure_rate
+        self._open_for = open_for.total_seconds()
+        self._probes = probes
+        self._bucket_width = window.total_seconds() / self.BUCKETS
+        # [number, calls, failures] per bucket, numbered by time divided by the width
+        self._buckets = [[0, 0, 0] for _ in range(self.BUCKETS)]
+        self._state = CircuitState.CLOSED
+        # Wall clock time, so that it can be shared with other instances
+        self._opened_until = 0.0
+        self._probes_left = 0
+        self._probes_succeeded = 0
+        self._lock = threading.Lock()
+
+    @property
+    def opened_until(self) -> float:
+        """Time until which calls are blocked, 0 if they aren't."""
+        return self._opened_until if self._state == CircuitState.OPEN else 0
+
+    def blocked_for(self) -> float:
+        """Return seconds until calls are let through again, 0 if this call may go."""
+        now = time.time()
+        with self._lock:
+            if self._state == CircuitState.OPEN:
+                if now < self._opened_until:
+                    return self._opened_until - now
+                self._transition(CircuitState.HALF_OPEN)
+                self._start_probing(now)
+
+            if self._state == CircuitState.HALF_OPEN:
+                # Probes never recorded, e.g. cancelled, are handed out again
+                if not self._probes_left and now >= self._opened_until:
+                    self._start_probing(now)
+                if not self._probes_left:
+                    return self._opened_until - now
+                self._probes_left -= 1
+        return 0
+
+    def record(self, *, succeeded: bool) -> None:
+        """Count the outcome of a call let through."""
+        now = time.time()
+        with self._lock:
+            if self._state == CircuitState.HALF_OPEN:
+                self._probes_succeeded += succeeded
+                if not succeeded:
+                    self._open(now + self._open_for)
+                elif self._probes_succeeded >= self._probes:
+                    self._close()
+                return
+
+            calls, failures = self._count(now, failed=not succeeded)
+            if (
+                self._state == CircuitState.CLOSED
+                and calls >= self._min_calls
+                and failures >= calls * self._failure_rate
+            ):
+                self._open(now + self._open_for)
+
+    def open_until(self, until: float) -> None:
+        """Block calls until the given time, e.g. because another instance did so."""
+        with self._lock:
+            if until > self.opened_until:
+                self._open(until)
+
+    def _count(self, now: float, *, failed: bool) -> tuple[int, int]:
+        """Add the outcome to its bucket, return calls and failures in the window."""
+        number = int(now / self._bucket_width)
+        bucket = self._buckets[number % len(self._buckets)]
+        if bucket[0] != number:
+            bucket[:] = [number, 0, 0]
+        bucket[1] += 1
+        bucket[2] += failed
+
+        oldest = number - len(self._buckets)
+        in_window = [bucket for bucket in self._buckets if bucket[0] > oldest]
+        return sum(bucket[1] for bucket in in_window), sum(bucket[2] for bucket in in_window)
+
+    def _open(self, until: float) -> None:
+        """Block calls until the given time."""
+        if self._state != CircuitState.OPEN:
+            self._logger.warning('Circuit of %s is open for %.1fs', self.name, until - time.time())
+            self._transition(CircuitState.OPEN)
+        self._opened_until = until
+
+    def _close(self) -> None:
+        """Let all calls through and start counting from scratch."""
+        self._logger.info('Circuit of %s is closed', self.name)
+        self._transition(CircuitState.CLOSED)
+        for bucket in self._buckets:
+            bucket[:] = [0, 0, 0]
+
+    def _start_probing(self, now: float) -> None:
+        """Hand out probes, the next ones are due after another open_for."""
+        self._probes_left, self._probes_succeeded = self._probes, 0
+        self._opened_until = now + self._open_for
+
+    def _transition(self, state: CircuitState) -> None:
+        """Change the state and count the change for the metrics."""
+        self._state = state
+        circuit_transitions.labels(self.name, state).inc()
+
+
+class RedisCircuitSync:
+    """Loop sharing open circuits of breakers with other instances through Redis.
+
+    Breakers only count calls of their own instance, a circuit opened by any instance
+    is opened by all the others within interval.
+    """
+
+    def __init__(
+        self,
+        connection: Redis,
+        key_prefix: str,
+        breakers: Iterable[CircuitBreaker],
+        logger: Logger,
+        *,
+        interval: timedelta,
+    ) -> None:
+        self._con = connection
+        self._key_prefix = key_prefix
+        self._breakers = list(breakers)
+        self._logger = logger
+        self._interval = interval
+        # Breaker name -> time until which its circuit was published as open
+        self._published: dict[str, float] = {}
+
+    async def run(self) -> None:
+        """Share the circuits every interval until cancelled."""
+        while True:
+            for breaker in self._breakers:
+                try:
+                    await asyncio.to_thread(self.sync, breaker)
+                except Exception:
+                    self._logger.exception('Circuit breaker sync error')
+            await asyncio.sleep(self._interval.total_seconds())
+
+    def sync(self, breaker: CircuitBreaker) -> None:
+        """Publish the circuit if this instance opened it, adopt it if another did."""
+        key = f'{self._key_prefix}:{breaker.name}'
+        opened_until = breaker.opened_until
+        if opened_until > self._published.get(breaker.name, 0):
+            self._con.set(key, opened_until, pxat=int(opened_until * 1000))
+            self._published[breaker.name] = opened_until
+            return
+
+        shared_until = self._con.get(key)
+        if shared_until is not None and float(shared_until) > time.time():  # type: ignore[arg-type]
+            breaker.open_until(float(shared_until))  # type: ignore[arg-type]
+            self._published[breaker.name] = float(shared_until)  # type: ignore[arg-type]
@@ -1,17 +1,26 @@
+import asyncio
+import json
+from dataclasses import dataclass
 from datetime import UTC, datetime, timedelta
+from functools import lru_cache
 from logging import Logger
-from typing import ClassVar
+from typing import TYPE_CHECKING, ClassVar
 
 import httpx
-from google.auth.exceptions import GoogleAuthError
-from google.auth.transport import requests as google_requests
-from google.oauth2.service_account import Credentials
 
 from fastapi import status
 
 from project_base.config import get_settings
 
+from .access_tokens import AccessTokenCache, SingleFlightLock
 from .cache import CacheRepository
+from .circuit_breaker import CircuitBreaker
+from .http import AsyncConnectionManager, parse_retry_after
+from .metrics import current_route, stage_seconds, upstream_responses
+
+if TYPE_CHECKING:
+    from google.auth.transport.requests import Request as AuthRequest
+    from google.oauth2.service_account import Credentials
 
 settings = get_settings()
 
@@ -20,6 +29,19 @@ class FireBaseServiceError(Exception):
     """Exception for FireBase service errors."""
 
 
+class FireBaseUnavailableError(FireBaseServiceError):
+    """FCM is overloaded or unavailable, the request should be retried later."""
+
+    def __init__(self, retry_after: float | None = None) -> None:
+        super().__init__()
+        # Seconds to wait before the next attempt, if the server told so
+        self.retry_after = retry_after
+
+
+class FireBaseTooManyRequestsError(FireBaseUnavailableError):
+    """FCM rejected the request over a quota, e.g. of messages to the same device."""
+
+
 class FireBaseInvalidRequestError(Exception):
     """Exception for FireBase FCM token not found errors."""
 
@@ -32,34 +54,82 @@ class FireBaseTokenError(Exception):
     """Exception for FireBase token errors."""
 
 
-class FireBase:
-    """Class for sending FireBase messages."""
+@dataclass(frozen=True, slots=True)
+class PreparedMessage:
+    """Message body built once, only the device token is filled in per recipient."""
+
+    # Encoded message fields following the token
+    tail: bytes
+
+    def encode(self, fcm_token: str) -> bytes:
+        """Return the request body for a device."""
+        return b'{"message":{"token":' + json.dumps(fcm_token).encode() + b',' + self.tail + b'}'
+
+
+@lru_cache
+def load_service_account_credentials() -> 'Credentials':
+    """Build the service account credentials once, parsing the private key."""
+    # google-auth pulls in requests, import it on the first mint for fast cold starts
+    from google.oauth2.service_account import Credentials
+
+    google_credentials = {
+        'auth_provider_x509_cert_url': settings.FIREBASE_AUTH_PROVIDER_X509_CERT_URL,
+        'auth_uri': settings.FIREBASE_AUTH_URI,
+        'client_email': settings.FIREBASE_CLIENT_EMAIL,
+        'client_id': settings.FIREBASE_CLIENT_ID,
+        'client_x509_cert_url': settings.FIREBASE_CLIENT_X509_CERT_URL,
+        'private_key': settings.FIREBASE_PRIVATE_KEY,
+        'private_key_id': settings.FIREBASE_PRIVATE_KEY_ID,
+        'project_id': settings.FIREBASE_PROJECT_ID,
+        'token_uri': settings.FIREBASE_TOKEN_URI,
+        'type': settings.FIREBASE_TYPE,
+        'universe_domain': settings.FIREBASE_UNIVERSE_DOMAIN,
+    }
+    return Credentials.from_service_account_info(google_credentials, scopes=BaseFireBase.SCOPES)
+
+
+@lru_cache
+def get_auth_request() -> 'AuthRequest':
+    """Return a transport for Google token requests that keeps its session alive."""
+    from google.auth.transport.requests import Request as AuthRequest
+
+    return AuthRequest()
+
+
+class BaseFireBase:
+    """Message building and response handling of FireBase clients."""
 
     ACCESS_TOKEN_KEY = 'firebase_access_token'  # noqa: S105
-    FCM_URL = f'https://fcm.googleapis.com/v1/projects/{settings.FIREBASE_PROJECT_ID}/messages:send'
+    FCM_SERVER = settings.FCM_SERVER
+    FCM_URL = f'/v1/projects/{settings.FIREBASE_PROJECT_ID}/messages:send'
     SCOPES: ClassVar[list[str]] = ['https://www.googleapis.com/auth/firebase.messaging']
 
-    def __init__(self, cache_storage: CacheRepository, logger: Logger) -> None:
-        self._cache_storage = cache_storage
+    def __init__(
+        self,
+        cache_storage: CacheRepository,
+        logger: Logger,
+        *,
+        lock: SingleFlightLock | None = None,
+        breaker: CircuitBreaker | None = None,
+    ) -> None:
         self._logger = logger
+        self._breaker = breaker
+        self.access_token = AccessTokenCache(cache_storage, self.ACCESS_TOKEN_KEY, self._mint_access_token, lock=lock)
 
-    def send_message(
-        self, *, fcm_token: str, title: str | None, message: str | None, extra_data: dict[str, str | None] | None = None
-    ) -> None:
-        """Send an HTTP request to FireBase with given message."""
-        common_message = self._build_common_message(fcm_token, title, message, extra_data)
+    def _check_circuit(self) -> None:
+        """Fail without a request while FCM is considered down."""
+        if self._breaker is not None and (blocked_for := self._breaker.blocked_for()):
+            raise FireBaseUnavailableError(blocked_for)
 
-        headers = {
-            'Authorization': 'Bearer ' + self._get_access_token(),
-            'Content-Type': 'application/json; UTF-8',
-        }
+    def _record_call(self, *, succeeded: bool) -> None:
+        """Count the outcome of a request for the circuit breaker."""
+        if self._breaker is not None:
+            self._breaker.record(succeeded=succeeded)
 
-        with httpx.Client() as c:
-            try:
-                response = c.post(self.FCM_URL, json=common_message, headers=headers)
-            except httpx.HTTPError as err:
-                self._logger.exception('Firebase error')
-                raise FireBaseServiceError from err
+    def _handle_response(self, response: httpx.Response) -> None:
+        """Raise an error matching the FCM response status."""
+        result = 'ok' if response.status_code == status.HTTP_200_OK else str(response.status_code)
+        upstream_responses.labels('fcm', current_route.get(), result).inc()
 
         if response.status_code == status.HTTP_400_BAD_REQUEST:
             self._logger.error(f'Firebase error with response: {response.text}')
@@ -67,34 +137,37 @@ class FireBase:
         if response.status_code == status.HTTP_404_NOT_FOUND:
             self._logger.error(f'Firebase error with response: {response.text}')
             raise FireBaseFCMTokenNotFoundError
+        if response.status_code == status.HTTP_429_TOO_MANY_REQUESTS:
+            self._logger.error(f'Firebase error with response: {response.text}')
+            raise FireBaseTooManyRequestsError(parse_retry_after(response))
+        if response.status_code >= status.HTTP_500_INTERNAL_SERVER_ERROR:
+            self._logger.error(f'Firebase error with response: {response.text}')
+            raise FireBaseUnavailableError(parse_retry_after(response))
         if response.status_code != status.HTTP_200_OK:
             self._logger.error(f'Firebase error with response: {response.text}')
             raise FireBaseTokenError
 
+    def _get_headers(self) -> dict:
+        """Return headers for a request."""
+        return {
+            'Authorization': 'Bearer ' + self._get_access_token(),
+            'Content-Type': 'application/json; UTF-8',
+        }
+
     def delete_access_token(self) -> None:
         """Delete the cached access token."""
-        self._cache_storage.delete(self.ACCESS_TOKEN_KEY)
+        self.access_token.delete()
 
     def _get_access_token(self) -> str:
-        """Retrieve an access token and put it into the cache."""
-        if cached_token := self._cache_storage.get(self.ACCESS_TOKEN_KEY):
-            return cached_token
-
-        google_credentials = {
-            'auth_provider_x509_cert_url': settings.FIREBASE_AUTH_PROVIDER_X509_CERT_URL,
-            'auth_uri': settings.FIREBASE_AUTH_URI,
-            'client_email': settings.FIREBASE_CLIENT_EMAIL,
-            'client_id': settings.FIREBASE_CLIENT_ID,
-            'client_x509_cert_url': settings.FIREBASE_CLIENT_X509_CERT_URL,
-            'private_key': settings.FIREBASE_PRIVATE_KEY,
-            'private_key_id': settings.FIREBASE_PRIVATE_KEY_ID,
-            'project_id': settings.FIREBASE_PROJECT_ID,
-            'token_uri': settings.FIREBASE_TOKEN_URI,
-            'type': settings.FIREBASE_TYPE,
-            'universe_domain': settings.FIREBASE_UNIVERSE_DOMAIN,
-        }
-        creds = Credentials.from_service_account_info(google_credentials, scopes=self.SCOPES)
-        request = google_requests.Request()
+        """Retrieve an access token from the cache or request it."""
+        return self.access_token.get()
+
+    def _mint_access_token(self) -> tuple[str, datetime]:
+        """Request an access token from Google, return it with its expiration time."""
+        from google.auth.exceptions import GoogleAuthError
+
+        creds = load_service_account_credentials()
+        request = get_auth_request()
 
         try:
             creds.refresh(request)
@@ -103,24 +176,65 @@ class FireBase:
             raise FireBaseServiceError from err
 
         expires_at = (
-            creds.expiry
+            creds.expiry.replace(tzinfo=UTC)  # google-auth returns naive UTC datetimes
             if creds.expiry
             else datetime.now(UTC) + timedelta(minutes=settings.FIREBASE_BEARER_TOKEN_TIMEOUT_MINS)
         )
         expires_at -= timedelta(minutes=1)
-        self._cache_storage.set(self.ACCESS_TOKEN_KEY, creds.token, expires_at=expires_at)
-        return creds.token
+        return creds.token, expires_at
 
-    def _build_common_message(
-        self, fcm_token: str, title: str | None, message: str | None, extra_data: dict[str, str | None] | None = None
-    ) -> dict:
+    def prepare_message(
+        self, *, title: str | None, message: str | None, extra_data: dict[str, str | None] | None = None
+    ) -> PreparedMessage:
         """Construct common notification message."""
-        msg = {'token': fcm_token, 'notification': {}}
+        msg: dict[str, dict] = {'notification': {}}
 
         if title:
-            msg['notification']['title'] = title  # type: ignore[index]
+            msg['notification']['title'] = title
         if message:
-            msg['notification']['body'] = message  # type: ignore[index]
+            msg['notification']['body'] = message
         if extra_data:
             msg['data'] = extra_data
-        return {'message': msg}
+        # Drop the opening brace, the token goes first
+        return PreparedMessage(json.dumps(msg, separators=(',', ':')).encode()[1:])
+
+
+class AsyncFireBase(BaseFireBase):
+    """Asyncio class for sending FireBase messages."""
+
+    def __init__(
+        self,
+        cache_storage: CacheRepository,
+        logger: Logger,
+        *,
+        connections: AsyncConnectionManager,
+        lock: SingleFlightLock | None = None,
+        breaker: CircuitBreaker | None = None,
+    ) -> None:
+        super().__init__(cache_storage, logger, lock=lock, breaker=breaker)
+        self._connections = connections
+
+    async def send_message(
+        self, *, fcm_token: str, title: str | None, message: str | None, extra_data: dict[str, str | None] | None = None
+    ) -> None:
+        """Send an HTTP request to FireBase with given message."""
+        await self.send_prepared(fcm_token, self.prepare_message(title=title, message=message, extra_data=extra_data))
+
+    async def send_prepared(self, fcm_token: str, message: PreparedMessage) -> None:
+        """Send a prepared message to a device."""
+        self._check_circuit()
+        # An access token might need to be fetched from Redis or refreshed with Google
+        with stage_seconds.labels('fcm', 'credentials').time():
+            headers = await asyncio.to_thread(self._get_headers)
+
+        connection = self._connections.get(self.FCM_SERVER)
+
+        try:
+            response = await connection.post(self.FCM_URL, content=message.encode(fcm_token), headers=headers)
+        except httpx.HTTPError as err:
+            self._record_call(succeeded=False)
+            self._logger.exception('Firebase error')
+            raise FireBaseServiceError from err
+
+        self._record_call(succeeded=response.status_code < status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self._handle_response(response)
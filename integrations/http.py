@@ -0,0 +1,181 @@
+import time
+from datetime import UTC, datetime
+from email.utils import parsedate_to_datetime
+from typing import Any
+
+import h2.errors
+import h2.events
+import httpx
+
+from project_base.config import get_settings
+
+from .metrics import stage_seconds
+
+settings = get_settings()
+
+
+def parse_retry_after(response: httpx.Response) -> float | None:
+    """Return the delay in seconds from the Retry-After header."""
+    value = response.headers.get('retry-after')
+    if value is None:
+        return None
+
+    if value.isdigit():
+        return float(value)
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(UTC)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_unprocessed(err: httpx.TransportError) -> bool:
+    """Return whether the request surely wasn't processed by the server.
+
+    That is if it couldn't connect, couldn't write the request, or the HTTP/2 stream
+    was refused. A GOAWAY for streams above the last processed one is already retried
+    on another connection by httpcore.
+    """
+    if isinstance(err, httpx.ConnectError | httpx.ConnectTimeout | httpx.WriteError):
+        return True
+    if isinstance(err, httpx.RemoteProtocolError) and err.__cause__ is not None and err.__cause__.args:
+        event = err.__cause__.args[0]
+        return isinstance(event, h2.events.StreamReset) and event.error_code == h2.errors.ErrorCodes.REFUSED_STREAM
+    return False
+
+
+class RequestTimer:
+    """Splits the time of a request into waiting for a connection and the exchange.
+
+    Fed by httpx trace events, the exchange starts once request headers are being sent.
+    """
+
+    def __init__(self, provider: str) -> None:
+        self._provider = provider
+        self._started_at = time.perf_counter()
+        self._sent_at: float | None = None
+
+    def trace(self, event_name: str, info: dict[str, Any]) -> None:
+        """Note the moment the request got a connection."""
+        if event_name.endswith('.send_request_headers.started'):
+            self._sent_at = time.perf_counter()
+
+    async def atrace(self, event_name: str, info: dict[str, Any]) -> None:
+        """Asyncio counterpart of trace."""
+        self.trace(event_name, info)
+
+    def observe(self) -> None:
+        """Record the stages of the finished request."""
+        now = time.perf_counter()
+        stage_seconds.labels(self._provider, 'connection').observe((self._sent_at or now) - self._started_at)
+        if self._sent_at is not None:
+            stage_seconds.labels(self._provider, 'upstream').observe(now - self._sent_at)
+
+
+class AsyncPersistentClient:
+    """A long-lived httpx client bound to a single host.
+
+    Connections are kept warm between requests. A request that fails before the server
+    could process it, e.g. on a connection it dropped, is retried once on another
+    connection. Failures after the request was sent, e.g. the connection closing before
+    a response, are raised as the push may have been delivered already.
+    """
+
+    def __init__(self, base_url: str, *, name: str, http2: bool, limits: httpx.Limits, timeout: httpx.Timeout) -> None:
+        self.base_url = base_url
+        self.name = name
+        self._http2 = http2
+        self._limits = limits
+        self._timeout = timeout
+        self._client: httpx.AsyncClient | None = None
+
+    def open(self) -> httpx.AsyncClient:
+        """Return the underlying client, creating it if needed."""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url, http2=self._http2, limits=self._limits, timeout=self._timeout
+            )
+        return self._client
+
+    async def connect(self) -> None:
+        """Open a connection to the host ahead of the first request.
+
+        httpx has no explicit connect, a HEAD request makes the pool open a connection
+        and keep it alive.
+        """
+        await self.open().head('/')
+
+    async def close(self) -> None:
+        """Close the underlying client and all its connections."""
+        client, self._client = self._client, None
+        if client is not None:
+            await client.aclose()
+
+    async def post(self, url: str, **kwargs: Any) -> httpx.Response:
+        """Send a POST request, reconnecting once if it surely wasn't processed."""
+        client = self.open()
+        try:
+            return await self._timed_post(client, url, **kwargs)
+        except httpx.TransportError as err:
+            if not is_unprocessed(err):
+                raise
+            # The pool has dropped the broken connection, closing the client would abort
+            # requests in flight on its other connections
+            return await self._timed_post(client, url, **kwargs)
+
+    async def _timed_post(self, client: httpx.AsyncClient, url: str, **kwargs: Any) -> httpx.Response:
+        """Send a POST request, recording how long its stages took."""
+        timer = RequestTimer(self.name)
+        try:
+            return await client.post(url, extensions={'trace': timer.atrace}, **kwargs)
+        finally:
+            timer.observe()
+
+
+class AsyncConnectionManager:
+    """Process-wide registry of persistent clients, one per host."""
+
+    def __init__(self, *, name: str, http2: bool, limits: httpx.Limits, timeout: httpx.Timeout) -> None:
+        # Provider the hosts belong to, used as a metrics label
+        self._name = name
+        self._http2 = http2
+        self._limits = limits
+        self._timeout = timeout
+        self._clients: dict[str, AsyncPersistentClient] = {}
+
+    def get(self, base_url: str) -> AsyncPersistentClient:
+        """Return the persistent client for the given host."""
+        if base_url not in self._clients:
+            self._clients[base_url] = AsyncPersistentClient(
+                base_url, name=self._name, http2=self._http2, limits=self._limits, timeout=self._timeout
+            )
+        return self._clients[base_url]
+
+    def open(self, *base_urls: str) -> None:
+        """Create clients for the given hosts ahead of the first request."""
+        for base_url in base_urls:
+            self.get(base_url).open()
+
+    async def close(self) -> None:
+        """Close all clients."""
+        clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            await client.close()
+
+
+apns_connections = AsyncConnectionManager(
+    name='apns',
+    http2=True,
+    limits=httpx.Limits(keepalive_expiry=settings.APNS_CONNECTION_IDLE_TIMEOUT_SECS),
+    timeout=httpx.Timeout(settings.APNS_TIMEOUT_SECS),
+)
+fcm_connections = AsyncConnectionManager(
+    name='fcm',
+    http2=settings.FCM_HTTP2,
+    limits=httpx.Limits(
+        max_connections=settings.FCM_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.FCM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=settings.FCM_KEEPALIVE_EXPIRY_SECS,
+    ),
+    timeout=httpx.Timeout(settings.FCM_TIMEOUT_SECS, connect=settings.FCM_CONNECT_TIMEOUT_SECS),
+)
+connections = [apns_connections, fcm_connections]  # For closing connections in lifespan (main.py)
@@ -0,0 +1,78 @@
+import threading
+import time
+from collections.abc import Iterable, Sequence
+from datetime import timedelta
+from typing import Protocol
+
+from redis import Redis
+
+
+class IdempotencyKeys(Protocol):
+    """A protocol for remembering recently made requests."""
+
+    def claim_many(self, keys: Sequence[str]) -> list[bool]:
+        """Mark keys as seen, return for each whether it wasn't seen within the TTL."""
+
+    def release_many(self, keys: Iterable[str]) -> None:
+        """Forget keys, so that their requests may be made again."""
+
+
+class LocalIdempotencyKeys:
+    """In-process implementation of IdempotencyKeys protocol."""
+
+    def __init__(self, ttl: timedelta, *, max_keys: int = 100_000) -> None:
+        self._ttl = ttl.total_seconds()
+        self._max_keys = max_keys
+        # Key -> monotonic time it expires at, in the order of claiming
+        self._expires_at: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def claim_many(self, keys: Sequence[str]) -> list[bool]:
+        """Mark keys as seen, return for each whether it wasn't seen within the TTL."""
+        now = time.monotonic()
+        claimed = []
+        with self._lock:
+            for key in keys:
+                is_new = self._expires_at.get(key, 0) <= now
+                if is_new:
+                    # Keep the order of claiming, so that the oldest keys come first
+                    self._expires_at.pop(key, None)
+                    self._expires_at[key] = now + self._ttl
+                claimed.append(is_new)
+            if len(self._expires_at) > self._max_keys:
+                self._drop_oldest(now)
+        return claimed
+
+    def release_many(self, keys: Iterable[str]) -> None:
+        """Forget keys, so that their requests may be made again."""
+        with self._lock:
+            for key in keys:
+                self._expires_at.pop(key, None)
+
+    def _drop_oldest(self, now: float) -> None:
+        """Drop expired keys, then the oldest ones if there are still too many."""
+        for key, expires_at in list(self._expires_at.items()):
+            if expires_at > now and len(self._expires_at) <= self._max_keys:
+                break
+            del self._expires_at[key]
+
+
+class RedisIdempotencyKeys:
+    """Redis implementation of IdempotencyKeys protocol shared by all instances."""
+
+    def __init__(self, connection: Redis, key_prefix: str, ttl: timedelta) -> None:
+        self._con = connection
+        self._key_prefix = key_prefix
+        self._ttl = ttl
+
+    def claim_many(self, keys: Sequence[str]) -> list[bool]:
+        """Mark keys as seen in a single round trip, return whether each one is new."""
+        pipe = self._con.pipeline(transaction=False)
+        for key in keys:
+            pipe.set(f'{self._key_prefix}:{key}', 1, nx=True, px=self._ttl)
+        return [bool(claimed) for claimed in pipe.execute()]
+
+    def release_many(self, keys: Iterable[str]) -> None:
+        """Forget keys, so that their requests may be made again."""
+        if keys := [f'{self._key_prefix}:{key}' for key in keys]:
+            self._con.delete(*keys)
@@ -0,0 +1,78 @@
+import time
+from contextvars import ContextVar
+
+from prometheus_client import Counter, Histogram
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from fastapi import Request
+
+# From sub-millisecond cache reads up to provider timeouts
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Route template of the API request being served, pushes sent by workers have none
+current_route: ContextVar[str] = ContextVar('current_route', default='worker')
+
+request_seconds = Histogram(
+    'http_request_duration_seconds',
+    'Time to serve an API request',
+    ['route', 'method', 'status'],
+    buckets=LATENCY_BUCKETS,
+)
+stage_seconds = Histogram(
+    'push_stage_seconds',
+    'Time spent in a stage of sending pushes: token_lookup, credentials, connection, upstream, cleanup',
+    ['provider', 'stage'],
+    buckets=LATENCY_BUCKETS,
+)
+pushes = Counter('pushes', 'Pushes sent to devices by outcome', ['provider', 'route', 'outcome'])
+upstream_responses = Counter(
+    'upstream_responses', 'Provider responses by result, the reason of an error', ['provider', 'route', 'result']
+)
+access_token_lookups = Counter(
+    'access_token_lookups', 'Provider access token lookups, a miss means a mint', ['token', 'result']
+)
+circuit_transitions = Counter(
+    'circuit_breaker_transitions', 'Changes of provider circuit breaker states', ['provider', 'state']
+)
+superseded_pushes = Counter(
+    'superseded_pushes',
+    'Upstream requests saved by dropping pushes superseded by a newer call status',
+    ['provider', 'stage'],
+)
+near_cache_lookups = Counter('near_cache_lookups', 'Lookups in the in-process cache in front of Redis', ['result'])
+
+
+async def track_route(request: Request) -> None:
+    """Label pushes sent while serving the request with its route."""
+    current_route.set(request.scope['route'].path)
+
+
+class RequestMetricsMiddleware:
+    """ASGI middleware timing API requests by route template.
+
+    Requests not matching any route aren't observed to keep the label set bounded.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Serve the request and observe its duration."""
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            if (route := scope.get('route')) is not None:
+                request_seconds.labels(route.path, scope['method'], status_code).observe(time.perf_counter() - start)
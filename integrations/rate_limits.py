@@ -0,0 +1,122 @@
+import threading
+import time
+from typing import Protocol
+
+from redis import Redis
+
+
+class RateLimiter(Protocol):
+    """A protocol for token bucket rate limiting."""
+
+    def reserve(self, key: str, max_delay: float) -> float:
+        """Take a slot for the key, return the seconds to wait before using it.
+
+        No slot is taken if it's more than max_delay seconds away.
+        """
+
+    def release(self, key: str) -> None:
+        """Give back a slot taken for a request that won't be made."""
+
+
+class LocalRateLimiter:
+    """In-process implementation of RateLimiter protocol.
+
+    Slots are reserved even when the bucket is empty, so callers queue up behind each
+    other instead of competing for the next free slot.
+    """
+
+    def __init__(self, rate: float, burst: int, *, max_keys: int = 10_000) -> None:
+        self._rate = rate
+        self._burst = burst
+        self._max_keys = max_keys
+        # Key -> (available slots, monotonic time they were counted at)
+        self._buckets: dict[str, tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, key: str, max_delay: float) -> float:
+        """Take a slot for the key, return the seconds to wait before using it.
+
+        No slot is taken if it's more than max_delay seconds away.
+        """
+        now = time.monotonic()
+        with self._lock:
+            slots = self._refill(key, now)
+            delay = max((1 - slots) / self._rate, 0)
+            if delay <= max_delay:
+                self._buckets[key] = (slots - 1, now)
+                if len(self._buckets) > self._max_keys:
+                    self._drop_full(now)
+        return delay
+
+    def release(self, key: str) -> None:
+        """Give back a slot taken for a request that won't be made."""
+        now = time.monotonic()
+        with self._lock:
+            self._buckets[key] = (min(self._burst, self._refill(key, now) + 1), now)
+
+    def _refill(self, key: str, now: float) -> float:
+        """Return the slots available for the key now."""
+        slots, counted_at = self._buckets.get(key, (self._burst, now))
+        return min(self._burst, slots + (now - counted_at) * self._rate)
+
+    def _drop_full(self, now: float) -> None:
+        """Forget buckets refilled to the burst, they are the same as missing ones."""
+        for key, (slots, counted_at) in list(self._buckets.items()):
+            if slots + (now - counted_at) * self._rate >= self._burst:
+                del self._buckets[key]
+
+
+class RedisRateLimiter:
+    """Redis implementation of RateLimiter protocol shared by all instances."""
+
+    # Refill and take a slot atomically, the Redis clock is shared by all instances
+    # KEYS: bucket; ARGV: rate, burst, max_delay
+    RESERVE_SCRIPT = """
+        local rate, burst, max_delay = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+        local bucket = redis.call('HMGET', KEYS[1], 'slots', 'counted_at')
+        local slots = tonumber(bucket[1]) or burst
+        local counted_at = tonumber(bucket[2]) or now
+        slots = math.min(burst, slots + (now - counted_at) * rate)
+        local delay = math.max((1 - slots) / rate, 0)
+        if delay <= max_delay then
+            slots = slots - 1
+            redis.call('HSET', KEYS[1], 'slots', slots, 'counted_at', now)
+            redis.call('PEXPIRE', KEYS[1], math.ceil((burst - slots) / rate * 1000))
+        end
+        return tostring(delay)
+    """
+    # KEYS: bucket; ARGV: rate, burst
+    RELEASE_SCRIPT = """
+        local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+        local bucket = redis.call('HMGET', KEYS[1], 'slots', 'counted_at')
+        if not bucket[1] then
+            return
+        end
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+        local slots = math.min(burst, tonumber(bucket[1]) + (now - tonumber(bucket[2])) * rate + 1)
+        redis.call('HSET', KEYS[1], 'slots', slots, 'counted_at', now)
+        redis.call('PEXPIRE', KEYS[1], math.ceil((burst - slots) / rate * 1000))
+    """
+
+    def __init__(self, connection: Redis, key_prefix: str, rate: float, burst: int) -> None:
+        self._key_prefix = key_prefix
+        self._rate = rate
+        self._burst = burst
+        self._reserve = connection.register_script(self.RESERVE_SCRIPT)
+        self._release = connection.register_script(self.RELEASE_SCRIPT)
+
+    def reserve(self, key: str, max_delay: float) -> float:
+        """Take a slot for the key, return the seconds to wait before using it.
+
+        No slot is taken if it's more than max_delay seconds away.
+        """
+        args = [self._rate, self._burst, max_delay]
+        delay = self._reserve(keys=[f'{self._key_prefix}:{key}'], args=args)
+        return float(delay)
+
+    def release(self, key: str) -> None:
+        """Give back a slot taken for a request that won't be made."""
+        self._release(keys=[f'{self._key_prefix}:{key}'], args=[self._rate, self._burst])
@@ -6,12 +6,67 @@ from pydantic_settings import BaseSettings
 class Settings(BaseSettings):
     """Envs."""
 
+    # Set to False where background tasks can't run, e.g. in serverless functions
+    ACCESS_TOKEN_REFRESH_IN_BACKGROUND: bool = True
+    # Renew provider access tokens in the background this long before they expire
+    ACCESS_TOKEN_REFRESH_MARGIN_SECS: int = 300
     APNS_AUTH_KEY: str
     APNS_AUTH_KEY_ID: str
+    # Connections idle for longer are closed and reopened on the next push
+    APNS_CONNECTION_IDLE_TIMEOUT_SECS: float = 300
+    # Overridable to point the service at stand-in servers, e.g. in benchmarks
+    APNS_PRODUCTION_SERVER: str = 'https://api.push.apple.com:443'
+    APNS_SANDBOX_SERVER: str = 'https://api.sandbox.push.apple.com:443'
     APNS_TEAM_ID: str
+    APNS_TIMEOUT_SECS: float = 5
     APNS_USE_SANDBOX: bool = False
     # If present, each request's compared to this value
     AUTH_REQUEST_TOKEN: str | None = None
+    # Pushes to a provider fail fast and are retried later while most of its recent
+    # requests in the window failed
+    CIRCUIT_BREAKER_ENABLED: bool = True
+    CIRCUIT_BREAKER_FAILURE_RATE: float = 0.5
+    # Fewer requests in the window never open the circuit
+    CIRCUIT_BREAKER_MIN_CALLS: int = 20
+    CIRCUIT_BREAKER_OPEN_SECS: float = 30
+    # Requests let through after the open period, all must succeed to close the circuit
+    CIRCUIT_BREAKER_PROBES: int = 3
+    # Share open circuits with other instances through Redis
+    CIRCUIT_BREAKER_SHARED: bool = True
+    CIRCUIT_BREAKER_SYNC_INTERVAL_SECS: float = 1
+    CIRCUIT_BREAKER_WINDOW_SECS: float = 30
+    # Pushes to users are held back this long, only the latest status of a call is sent,
+    # 0 disables as it delays every push to a user
+    COALESCE_WINDOW_SECS: float = 0
+    # Claimed retries and scheduled pushes not done in this time, e.g. by a crashed
+    # instance, are claimed again
+    DELAYED_LEASE_SECS: float = 60
+    # Token bucket per device, providers reject bursts of pushes to a device
+    DEVICE_RATE_LIMIT_BURST: int = 3
+    DEVICE_RATE_LIMIT_ENABLED: bool = True
+    # Longer waits are handed over to the retry queue
+    DEVICE_RATE_LIMIT_MAX_DELAY_SECS: float = 5
+    DEVICE_RATE_LIMIT_PER_SEC: float = 1
+    # Pending queued pushes are taken over by another worker after this idle time
+    DISPATCH_CLAIM_IDLE_SECS: int = 60
+    DISPATCH_CONSUMER_GROUP: str = 'push-senders'
+    # Queued pushes failing DISPATCH_MAX_DELIVERIES times are moved there for inspection
+    DISPATCH_DEAD_LETTER_STREAM: str = 'pushes:dispatch:dead-letters'
+    DISPATCH_MAX_DELIVERIES: int = 5
+    # If set, send-by-* requests are queued to a Redis Stream and sent by pushes.worker
+    DISPATCH_QUEUED: bool = False
+    DISPATCH_STREAM: str = 'pushes:dispatch'
+    DISPATCH_STREAM_MAX_LEN: int = 100_000
+    # Number of concurrent consumers per worker process
+    DISPATCH_WORKERS: int = 10
+    FCM_CONNECT_TIMEOUT_SECS: float = 3
+    # Multiplexes concurrent FCM requests over a single connection
+    FCM_HTTP2: bool = True
+    FCM_KEEPALIVE_EXPIRY_SECS: float = 300
+    FCM_MAX_CONNECTIONS: int = 100
+    FCM_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    FCM_SERVER: str = 'https://fcm.googleapis.com'
+    FCM_TIMEOUT_SECS: float = 5
     FIREBASE_AUTH_PROVIDER_X509_CERT_URL: str
     FIREBASE_AUTH_URI: str
     FIREBASE_BEARER_TOKEN_TIMEOUT_MINS: int = 60
@@ -24,7 +79,44 @@ class Settings(BaseSettings):
     FIREBASE_TOKEN_URI: str
     FIREBASE_TYPE: str
     FIREBASE_UNIVERSE_DOMAIN: str
+    # Repeated requests to send the same call status to the same recipient are dropped
+    IDEMPOTENCY_ENABLED: bool = True
+    IDEMPOTENCY_TTL_SECS: float = 300
+    # How long provider access tokens stay in the in-process cache in front of Redis
+    NEAR_CACHE_TTL_SECS: int = 60
+    # Time budget of push requests without an X-Push-Deadline-Ms header, 0 disables
+    PUSH_DEADLINE_SECS: float = 10
+    # Queued pushes and retries still unsent this long after they were due are dropped
+    PUSH_MAX_AGE_SECS: float = 300
+    # PUSH_MAX_AGE_SECS of some call statuses, e.g. {"ringing": 30}
+    PUSH_MAX_AGE_SECS_BY_STATUS: dict[str, float] = {}
+    # Max number of concurrent upstream requests while sending to all user's devices
+    PUSH_SEND_CONCURRENCY: int = 10
     REDIS_URL: str | None = None
+    # Max number of due retries sent at once
+    RETRY_BATCH_SIZE: int = 100
+    RETRY_POLL_INTERVAL_SECS: float = 1
+    RETRY_QUEUE_KEY: str = 'pushes:retries'
+    # Send due retries from the API process, disable if only workers should do it
+    RETRY_SCHEDULER_ENABLED: bool = True
+    # Max number of due scheduled pushes claimed at once
+    SCHEDULED_BATCH_SIZE: int = 100
+    SCHEDULED_POLL_INTERVAL_SECS: float = 1
+    # Scheduled pushes due at once are spread out at this rate per instance, 0 disables
+    SCHEDULED_PUSHES_PER_SEC: float = 200
+    SCHEDULED_QUEUE_KEY: str = 'pushes:scheduled'
+    # Send due scheduled pushes from the API process, disable if only workers should
+    SCHEDULER_ENABLED: bool = True
+    # Keep tokens with their metadata, enable once pushes.migrations has copied them
+    TOKEN_METADATA_ENABLED: bool = False
+    # Also write tokens to the store with metadata, enable before pushes.migrations
+    TOKEN_METADATA_MIGRATING: bool = False
+    TOKEN_PRUNE_BATCH_SIZE: int = 500
+    TOKEN_PRUNE_INTERVAL_SECS: float = 3600
+    # Tokens without a registration or a successful push for this long are deleted
+    TOKEN_STALE_AFTER_DAYS: float = 60
+    # Mint provider tokens and connect to providers before serving the first request
+    WARM_UP_ON_STARTUP: bool = False
 
     class Config:
         case_sensitive = True
@@ -1,23 +1,78 @@
+import asyncio
 from collections.abc import AsyncGenerator
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, suppress
+from datetime import timedelta
+
+from prometheus_client import make_asgi_app
 
 from fastapi import FastAPI
 
+from integrations.access_tokens import AccessTokenRefresher
+from integrations.apns import AsyncAPNSClient
+from integrations.firebase import AsyncFireBase
+from integrations.http import apns_connections, fcm_connections
+from integrations.http import connections as http_connections
+from integrations.metrics import RequestMetricsMiddleware
 from integrations.redis import connections as redis_connections
+from pushes import services
 
+from .config import get_settings
+from .loggers import logger
 from .routes import router
 
+settings = get_settings()
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     """Lifespan actions:
-    - Close Redis connections.
+    - Open the APNS and FCM connections.
+    - Warm up provider tokens and connections if enabled.
+    - Refresh provider access tokens in the background.
+    - Send pushes whose retry is due.
+    - Send scheduled pushes that are due.
+    - Prune stale device tokens if their metadata is kept.
+    - Share open provider circuits with other instances.
+    - Close HTTP and Redis connections.
     """
+    apns_connections.open(
+        AsyncAPNSClient.SANDBOX_SERVER if settings.APNS_USE_SANDBOX else AsyncAPNSClient.PRODUCTION_SERVER
+    )
+    fcm_connections.open(AsyncFireBase.FCM_SERVER)
+    if settings.WARM_UP_ON_STARTUP:
+        await services.warm_up()
+
+    background_tasks = []
+    if settings.ACCESS_TOKEN_REFRESH_IN_BACKGROUND:
+        refresher = AccessTokenRefresher(
+            logger,
+            [services.get_apns_client().credentials.access_token, services.get_firebase().access_token],
+            margin=timedelta(seconds=settings.ACCESS_TOKEN_REFRESH_MARGIN_SECS),
+        )
+        background_tasks.append(asyncio.create_task(refresher.run()))
+    if settings.RETRY_SCHEDULER_ENABLED and settings.REDIS_URL is not None:
+        background_tasks.append(asyncio.create_task(services.build_retry_scheduler().run()))
+    if settings.SCHEDULER_ENABLED and settings.REDIS_URL is not None:
+        background_tasks.append(asyncio.create_task(services.build_push_scheduler().run()))
+    if settings.TOKEN_METADATA_ENABLED and settings.REDIS_URL is not None:
+        background_tasks.append(asyncio.create_task(services.build_token_pruner().run()))
+    if settings.CIRCUIT_BREAKER_ENABLED and settings.CIRCUIT_BREAKER_SHARED and settings.REDIS_URL is not None:
+        background_tasks.append(asyncio.create_task(services.build_circuit_sync().run()))
+
     yield
 
+    for task in background_tasks:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+
+    for http_con in http_connections:
+        await http_con.close()
     for con in redis_connections:
         con.close()
 
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(RequestMetricsMiddleware)
 app.include_router(router, prefix='/api')
+app.mount('/metrics', make_asgi_app())
@@ -0,0 +1,273 @@
+"""Send a push to every user having tokens of a platform, or to every user of a segment.
+
+Users are streamed a page at a time with SCAN over the token keys, optionally only
+those whose id starts with a prefix, or with SSCAN over a segment set of user ids.
+Each page is sent like a bulk request while the next ones are fetched, with at most
+--pages-in-flight pages held at once however many users there are. The cursor is
+stored in Redis once all pages before it are sent, running the broadcast again with
+the same id resumes it from there.
+
+Run: python -m pushes.broadcast BROADCAST_ID --platform {apns,fcm} --guid GUID
+    [--status STATUS] [--segment KEY | --prefix PREFIX] [--page-size N]
+    [--pages-in-flight N]
+"""
+
+import argparse
+import asyncio
+import time
+from collections import deque
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from datetime import timedelta
+from functools import partial
+from logging import Logger
+
+from redis import Redis
+
+from integrations.http import connections as http_connections
+from integrations.metrics import current_route
+from integrations.redis import connection as redis_con
+from project_base.loggers import logger
+
+from . import services
+from .repositories import UserId
+from .schemas import BULK_SEND_MAX_RECIPIENTS, Platform, PushJobSchema, SendPushBulkSchema, SendPushSchema
+
+# Cursor to continue scanning from and users of the page it was returned with
+Page = tuple[int, list[UserId]]
+# Cursor after a page, its users and the task sending to them
+PageInFlight = tuple[int, list[UserId], 'asyncio.Task[tuple[int, int]]']
+
+
+@dataclass
+class BroadcastProgress:
+    """Where a broadcast stands, stored to resume it."""
+
+    # Cursor of the first page not sent yet
+    cursor: int = 0
+    users: int = 0
+    # Pushes sent to devices and those that weren't, e.g. invalid or failed
+    sent: int = 0
+    unsent: int = 0
+    done: bool = False
+
+
+class RedisBroadcastProgress:
+    """Progress of a broadcast kept in a Redis hash."""
+
+    def __init__(self, connection: Redis, key: str) -> None:
+        self._con = connection
+        self._key = key
+
+    def load(self) -> BroadcastProgress:
+        """Return the stored progress, a fresh one if the broadcast didn't start."""
+        fields = self._con.hgetall(self._key)
+        return BroadcastProgress(
+            cursor=int(fields.get('cursor', 0)),  # type: ignore[union-attr]
+            users=int(fields.get('users', 0)),  # type: ignore[union-attr]
+            sent=int(fields.get('sent', 0)),  # type: ignore[union-attr]
+            unsent=int(fields.get('unsent', 0)),  # type: ignore[union-attr]
+            done=fields.get('done') == '1',  # type: ignore[union-attr]
+        )
+
+    def save(self, progress: BroadcastProgress) -> None:
+        """Store the progress."""
+        mapping = {
+            'cursor': progress.cursor,
+            'users': progress.users,
+            'sent': progress.sent,
+            'unsent': progress.unsent,
+            'done': int(progress.done),
+        }
+        self._con.hset(self._key, mapping=mapping)
+
+
+def scan_pages(fetch_page: Callable[[int], Page], cursor: int) -> Iterator[Page]:
+    """Fetch pages starting at the cursor until the scan comes back to cursor 0."""
+    while True:
+        cursor, user_ids = fetch_page(cursor)
+        yield cursor, user_ids
+        if cursor == 0:
+            return
+
+
+def segment_page_fetcher(connection: Redis, segment_key: str, count: int) -> Callable[[int], Page]:
+    """Return a fetcher of pages of user ids in the segment set."""
+
+    def fetch_page(cursor: int) -> Page:
+        cursor, user_ids = connection.sscan(segment_key, cursor, count=count)  # type: ignore[misc]
+        return cursor, [UserId(user_id) for user_id in user_ids]
+
+    return fetch_page
+
+
+class _ThroughputReporter:
+    """Logs progress of a broadcast and pushes per second of this run every interval."""
+
+    def __init__(self, logger: Logger, progress: BroadcastProgress, interval: float) -> None:
+        self._logger = logger
+        self._progress = progress
+        self._interval = interval
+        self._start = self._last_report = time.monotonic()
+        # Pushes made by earlier runs of a resumed broadcast don't count for throughput
+        self._pushes_before = progress.sent + progress.unsent
+
+    def report(self, *, final: bool = False) -> None:
+        """Log progress if the interval passed since the last report or it's the end."""
+        now = time.monotonic()
+        if not final and now - self._last_report < self._interval:
+            return
+
+        self._last_report = now
+        pushes = self._progress.sent + self._progress.unsent - self._pushes_before
+        self._logger.info(
+            'Broadcast %s: %d users, %d pushes sent, %d unsent, %.0f pushes/s',
+            'completed' if final else 'running',
+            self._progress.users,
+            self._progress.sent,
+            self._progress.unsent,
+            pushes / max(now - self._start, 1e-9),
+        )
+
+
+class Broadcaster:
+    """Sends a push to users streamed a page at a time, several pages concurrently.
+
+    Progress is stored once every page up to a cursor is sent, so pages sent
+    concurrently and finished out of order are never skipped on resume, while some may
+    be sent again. Recipients that got the push recently are skipped like in bulk sends,
+    except for those of pages in flight when the broadcast stops.
+    """
+
+    def __init__(
+        self,
+        platform: Platform,
+        data: SendPushSchema,
+        progress: RedisBroadcastProgress,
+        logger: Logger,
+        *,
+        pages_in_flight: int,
+        report_interval: timedelta,
+    ) -> None:
+        self._platform = platform
+        self._data = data
+        self._progress = progress
+        self._logger = logger
+        self._pages_in_flight = pages_in_flight
+        self._report_interval = report_interval.total_seconds()
+
+    async def run(self, fetch_page: Callable[[int], Page]) -> BroadcastProgress:
+        """Send the push to all pages, resuming from the stored cursor."""
+        progress = await asyncio.to_thread(self._progress.load)
+        if progress.done:
+            self._logger.info('Broadcast was already completed for %d users', progress.users)
+            return progress
+
+        pages = scan_pages(fetch_page, progress.cursor)
+        in_flight: deque[PageInFlight] = deque()
+        reporter = _ThroughputReporter(self._logger, progress, self._report_interval)
+        try:
+            while (page := await asyncio.to_thread(next, pages, None)) is not None:
+                cursor, user_ids = page
+                in_flight.append((cursor, user_ids, asyncio.create_task(self.send_page(user_ids))))
+                if len(in_flight) >= self._pages_in_flight:
+                    await self._complete(in_flight, progress, reporter)
+            while in_flight:
+                await self._complete(in_flight, progress, reporter)
+        except BaseException:
+            await self._abandon(in_flight)
+            raise
+
+        progress.done = True
+        await asyncio.to_thread(self._progress.save, progress)
+        reporter.report(final=True)
+        return progress
+
+    async def send_page(self, user_ids: list[UserId]) -> tuple[int, int]:
+        """Send the push to all tokens of the users, return numbers sent and unsent."""
+        sent = unsent = 0
+        tokens_repo = services.get_tokens_repository(self._platform)
+        on_error = services.retry_later(PushJobSchema(platform=self._platform, **self._data.model_dump()))
+        send_to_tokens = partial(services.send_to_tokens, self._platform, data=self._data, on_error=on_error)
+        # Scans return about the page size asked for, bulk sends take a bounded number
+        for start in range(0, len(user_ids), BULK_SEND_MAX_RECIPIENTS):
+            data = SendPushBulkSchema(
+                user_ids=user_ids[start : start + BULK_SEND_MAX_RECIPIENTS], **self._data.model_dump()
+            )
+            result = await services.send_bulk(self._platform, tokens_repo, data, send_to_tokens)
+            for counts in result.users.values():
+                sent += counts.sent
+                unsent += counts.invalid + counts.skipped + counts.retrying + counts.failed + counts.expired
+        return sent, unsent
+
+    async def _complete(
+        self, in_flight: deque[PageInFlight], progress: BroadcastProgress, reporter: _ThroughputReporter
+    ) -> None:
+        """Wait for the oldest page in flight, then store the cursor after it."""
+        cursor, user_ids, task = in_flight[0]
+        sent, unsent = await task
+        progress.cursor = cursor
+        progress.users += len(user_ids)
+        progress.sent += sent
+        progress.unsent += unsent
+        await asyncio.to_thread(self._progress.save, progress)
+        in_flight.popleft()
+        reporter.report()
+
+    async def _abandon(self, in_flight: deque[PageInFlight]) -> None:
+        """Cancel pages in flight and release their users for a resumed run."""
+        for *_, task in in_flight:
+            task.cancel()
+        await asyncio.gather(*(task for *_, task in in_flight), return_exceptions=True)
+        for _, user_ids, _ in in_flight:
+            await services.release_sends(self._platform, self._data, user_ids=user_ids)
+
+
+async def broadcast(args: argparse.Namespace) -> None:
+    """Run the broadcast described by the command line arguments."""
+    if redis_con is None:
+        msg = 'REDIS_URL is required to broadcast'
+        raise RuntimeError(msg)
+
+    platform = Platform(args.platform)
+    if args.segment:
+        fetch_page = segment_page_fetcher(redis_con, args.segment, args.page_size)
+    else:
+        fetch_page = partial(
+            services.get_tokens_repository(platform).scan_user_ids_page, count=args.page_size, prefix=args.prefix
+        )
+
+    current_route.set('broadcast')
+    broadcaster = Broadcaster(
+        platform,
+        SendPushSchema(guid=args.guid, status=args.status),
+        RedisBroadcastProgress(redis_con, f'pushes:broadcast:{args.broadcast_id}'),
+        logger,
+        pages_in_flight=args.pages_in_flight,
+        report_interval=timedelta(seconds=args.report_interval),
+    )
+    try:
+        await broadcaster.run(fetch_page)
+    finally:
+        for http_con in http_connections:
+            await http_con.close()
+
+
+def main() -> None:
+    """Broadcast a push."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('broadcast_id', help='run again with the same id to resume')
+    parser.add_argument('--platform', choices=list(Platform), required=True)
+    parser.add_argument('--guid', required=True)
+    parser.add_argument('--status')
+    recipients = parser.add_mutually_exclusive_group()
+    recipients.add_argument('--segment', help='key of a Redis set of user ids')
+    recipients.add_argument('--prefix', default='', help='only users whose id starts with it')
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--pages-in-flight', type=int, default=4)
+    parser.add_argument('--report-interval', type=float, default=10, help='seconds between progress reports')
+    asyncio.run(broadcast(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import asyncio
+import itertools
+from datetime import timedelta
+
+from redis import Redis
+
+
+class Debouncer:
+    """Holds back updates for a short window and drops those superseded meanwhile.
+
+    Updates are superseded by a newer one with the same key made in this process or,
+    with a Redis connection, in any instance.
+    """
+
+    def __init__(self, window: timedelta, connection: Redis | None = None, *, key_prefix: str = 'debounce') -> None:
+        self._window = window
+        self._con = connection
+        self._key_prefix = key_prefix
+        # Key -> sequence number of the latest update
+        self._latest: dict[str, int] = {}
+        self._sequence = itertools.count()
+
+    async def settle(self, key: str) -> bool:
+        """Wait for the window, return False if a newer update with the key came in."""
+        if self._con is not None:
+            return await self._settle_shared(key)
+
+        number = next(self._sequence)
+        self._latest[key] = number
+        await asyncio.sleep(self._window.total_seconds())
+
+        is_latest = self._latest.get(key) == number
+        if is_latest:
+            del self._latest[key]
+        return is_latest
+
+    async def _settle_shared(self, key: str) -> bool:
+        """Wait for the window, counting updates with the key in Redis."""
+        redis_key = f'{self._key_prefix}:{key}'
+        number = await asyncio.to_thread(self._increment, redis_key)
+        await asyncio.sleep(self._window.total_seconds())
+        return int(await asyncio.to_thread(self._con.get, redis_key) or 0) == number  # type: ignore[union-attr]
+
+    def _increment(self, redis_key: str) -> int:
+        """Count an update with the key, return its sequence number."""
+        pipe = self._con.pipeline(transaction=False)  # type: ignore[union-attr]
+        pipe.incr(redis_key)
+        # Counters outlive any window they are compared in
+        pipe.pexpire(redis_key, self._window * 10)
+        number, _ = pipe.execute()
+        return number
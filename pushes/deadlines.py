@@ -0,0 +1,58 @@
+import asyncio
+from collections.abc import AsyncIterator, Iterator
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+
+# Event loop time by which the push being sent has to be done, None for no limit
+current_deadline: ContextVar[float | None] = ContextVar('current_deadline', default=None)
+
+
+class DeadlineExceededError(Exception):
+    """The push ran out of its time budget."""
+
+
+def start_deadline(budget: timedelta | None) -> None:
+    """Give the push being sent a time budget from now, None or zero for no limit."""
+    current_deadline.set(_get_deadline(budget))
+
+
+def get_remaining() -> float | None:
+    """Return seconds left until the deadline, None if there's no limit."""
+    deadline = current_deadline.get()
+    return None if deadline is None else deadline - asyncio.get_running_loop().time()
+
+
+@contextmanager
+def deadline_budget(budget: timedelta | None) -> Iterator[None]:
+    """Give the pushes sent within the block a time budget from now."""
+    token = current_deadline.set(_get_deadline(budget))
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+
+@asynccontextmanager
+async def within_deadline() -> AsyncIterator[None]:
+    """Cancel the block once the deadline passes, raise DeadlineExceededError then.
+
+    The block is skipped if the deadline already passed.
+    """
+    deadline = current_deadline.get()
+    if deadline is not None and deadline <= asyncio.get_running_loop().time():
+        raise DeadlineExceededError
+
+    timeout = asyncio.timeout_at(deadline)
+    try:
+        async with timeout:
+            yield
+    except TimeoutError as err:
+        if timeout.expired():
+            raise DeadlineExceededError from err
+        raise
+
+
+def _get_deadline(budget: timedelta | None) -> float | None:
+    """Return the loop time the budget runs out at, None or zero budget for no limit."""
+    return asyncio.get_running_loop().time() + budget.total_seconds() if budget else None
@@ -0,0 +1,45 @@
+"""Keep each device token only with the user who registered it last.
+
+Tokens registered before the owner index existed may be shared by several users. Those
+registered again since are kept with the user who did, the others don't tell who
+registered them last and are only counted, they stay with every user sharing them.
+Run once after deploying the index: python -m pushes.deduplication [--batch-size N]
+"""
+
+import argparse
+
+from project_base.loggers import logger
+
+from . import services
+from .repositories import TokenRepository
+from .schemas import Platform
+
+
+def deduplicate_tokens(tokens_repo: TokenRepository, *, batch_size: int) -> tuple[int, int]:
+    """Delete tokens of all users that others registered later.
+
+    Return how many were deleted and how many shared ones were left in place.
+    """
+    removed = shared = 0
+    for user_ids in tokens_repo.scan_user_ids(batch_size):
+        batch_removed, batch_shared = tokens_repo.reconcile_owners(user_ids)
+        removed += batch_removed
+        shared += batch_shared
+    return removed, shared
+
+
+def main() -> None:
+    """Deduplicate tokens of both platforms."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    for platform in Platform:
+        removed, shared = deduplicate_tokens(services.get_tokens_repository(platform), batch_size=args.batch_size)
+        logger.info('Removed %d %s tokens registered by other users', removed, platform)
+        if shared:
+            logger.warning('%d %s tokens are shared by users and were never registered again', shared, platform)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import asyncio
+import json
+from collections.abc import Awaitable, Callable, Iterable
+from datetime import UTC, datetime, timedelta
+from logging import Logger
+
+from redis import Redis
+
+from .schemas import PushJobSchema
+
+# Job as stored in the queue, needed to complete it, and the job
+ClaimedJob = tuple[str, PushJobSchema]
+
+
+class DelayedQueue:
+    """Push jobs kept in a Redis sorted set scored by the time they are due.
+
+    Claimed jobs are leased: they are moved to a processing sorted set scored by the
+    end of the lease and deleted once completed. Jobs whose lease ended, e.g. because
+    the instance handling them crashed, are put back in the queue by the next claim.
+    """
+
+    # Move due jobs to the processing set atomically, so that each job is claimed by a
+    # single instance, after putting back those whose lease ended
+    CLAIM_SCRIPT = """
+        local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+        for _, job in ipairs(expired) do
+            redis.call('ZADD', KEYS[1], ARGV[1], job)
+        end
+        if #expired > 0 then
+            redis.call('ZREM', KEYS[2], unpack(expired))
+        end
+        local jobs = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+        for _, job in ipairs(jobs) do
+            redis.call('ZADD', KEYS[2], ARGV[3], job)
+        end
+        if #jobs > 0 then
+            redis.call('ZREM', KEYS[1], unpack(jobs))
+        end
+        return jobs
+    """
+
+    def __init__(self, connection: Redis, key: str) -> None:
+        self._con = connection
+        self._key = key
+        self._processing_key = f'{key}:processing'
+        self._claim = connection.register_script(self.CLAIM_SCRIPT)
+
+    def add(self, job: PushJobSchema, due_at: datetime) -> None:
+        """Put a job to be sent at due_at."""
+        self._con.zadd(self._key, {job.model_dump_json(): due_at.timestamp()})
+
+    def add_many(self, jobs: Iterable[PushJobSchema], due_at: datetime) -> None:
+        """Put jobs to be sent at due_at in a single round trip."""
+        if members := {job.model_dump_json(): due_at.timestamp() for job in jobs}:
+            self._con.zadd(self._key, members)
+
+    def claim_due(self, limit: int, lease: timedelta) -> list[ClaimedJob]:
+        """Lease up to limit jobs that are due and return them."""
+        now = datetime.now(UTC)
+        jobs = self._claim(
+            keys=[self._key, self._processing_key], args=[now.timestamp(), limit, (now + lease).timestamp()]
+        )
+        return [(job, PushJobSchema.model_validate(json.loads(job))) for job in jobs]
+
+    def complete(self, member: str) -> None:
+        """Delete a claimed job once it's handled."""
+        self._con.zrem(self._processing_key, member)
+
+    def release(self, members: list[str]) -> None:
+        """Put claimed jobs that weren't handled back in the queue, due now."""
+        if not members:
+            return
+
+        pipeline = self._con.pipeline()
+        pipeline.zadd(self._key, dict.fromkeys(members, datetime.now(UTC).timestamp()))
+        pipeline.zrem(self._processing_key, *members)
+        pipeline.execute()
+
+
+class DelayedJobScheduler:
+    """Loop that claims due jobs in batches and hands them over for sending.
+
+    With max_rate, jobs are started evenly at that rate, so that many jobs due at the
+    same time are spread out instead of sent in a burst. Jobs are completed once
+    handled, failed ones are handled again when their lease ends, and those not
+    handled when the loop is cancelled are put back in the queue.
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        queue: DelayedQueue,
+        logger: Logger,
+        handle: Callable[[PushJobSchema], Awaitable[object]],
+        *,
+        batch_size: int,
+        poll_interval: timedelta,
+        lease: timedelta,
+        max_rate: float | None = None,
+    ) -> None:
+        self._queue = queue
+        self._logger = logger
+        self._handle = handle
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._max_rate = max_rate
+        # Paced jobs of a batch start up to batch_size / max_rate after the claim
+        self._lease = lease + timedelta(seconds=batch_size / max_rate) if max_rate else lease
+
+    async def run(self) -> None:
+        """Dispatch due jobs until cancelled."""
+        while True:
+            try:
+                jobs = await asyncio.to_thread(self._queue.claim_due, self._batch_size, self._lease)
+            except Exception:
+                self._logger.exception('Delayed jobs claim error')
+                jobs = []
+
+            await self._dispatch(jobs)
+            # A full batch means more jobs might be due already
+            if len(jobs) < self._batch_size:
+                await asyncio.sleep(self._poll_interval.total_seconds())
+
+    async def _dispatch(self, jobs: list[ClaimedJob]) -> None:
+        """Handle jobs concurrently, starting at most max_rate of them per second."""
+        tasks: list[asyncio.Task[None]] = []
+        try:
+            for member, job in jobs:
+                tasks.append(asyncio.create_task(self._process(member, job)))
+                if self._max_rate:
+                    await asyncio.sleep(1 / self._max_rate)
+            await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            unfinished = [member for i, (member, _) in enumerate(jobs) if i >= len(tasks) or tasks[i].cancelled()]
+            await asyncio.to_thread(self._queue.release, unfinished)
+            raise
+
+    async def _process(self, member: str, job: PushJobSchema) -> None:
+        """Handle a job and complete it, logging its failure."""
+        try:
+            await self._handle(job)
+        except Exception:
+            self._logger.exception('Delayed push failed')
+            return
+
+        try:
+            await asyncio.to_thread(self._queue.complete, member)
+        except Exception:
+            self._logger.exception('Delayed job completion error')
@@ -0,0 +1,139 @@
+import asyncio
+import json
+from collections.abc import Awaitable, Callable
+from datetime import timedelta
+from logging import Logger
+from typing import TYPE_CHECKING
+
+from redis import Redis
+from redis.exceptions import ResponseError
+
+from .schemas import PushJobSchema
+
+if TYPE_CHECKING:
+    from redis import asyncio as aioredis
+
+
+class DispatchQueue:
+    """Producer side of the Redis Stream with queued pushes."""
+
+    def __init__(self, connection: Redis, stream: str, *, max_len: int) -> None:
+        self._con = connection
+        self._stream = stream
+        self._max_len = max_len
+
+    def enqueue(self, job: PushJobSchema) -> str:
+        """Append a job to the stream and return its id."""
+        return self._con.xadd(  # type: ignore[return-value]
+            self._stream, {'job': job.model_dump_json()}, maxlen=self._max_len, approximate=True
+        )
+
+
+class DispatchWorker:
+    """Consumer side of the Redis Stream with queued pushes.
+
+    Runs several consumers of a consumer group in one process. Jobs are acknowledged
+    once handled, or if they can't be parsed; jobs whose handling failed or that were
+    left pending by a crashed worker are claimed and handled again after claim_idle.
+    Jobs delivered max_deliveries times are moved to the dead letter stream instead.
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        connection: 'aioredis.Redis',
+        logger: Logger,
+        handle: Callable[[PushJobSchema], Awaitable[object]],
+        *,
+        stream: str,
+        group: str,
+        consumer: str,
+        concurrency: int,
+        claim_idle: timedelta,
+        max_deliveries: int,
+        dead_letter_stream: str,
+        block: timedelta = timedelta(seconds=5),
+        idle_backoff: timedelta = timedelta(milliseconds=100),
+    ) -> None:
+        self._con = connection
+        self._logger = logger
+        self._handle = handle
+        self._stream = stream
+        self._group = group
+        self._consumer = consumer
+        self._concurrency = concurrency
+        self._claim_idle = claim_idle
+        self._max_deliveries = max_deliveries
+        self._dead_letter_stream = dead_letter_stream
+        self._block = block
+        self._idle_backoff = idle_backoff
+
+    async def run(self) -> None:
+        """Consume jobs until cancelled."""
+        await self.create_group()
+        consumers = (self._consume(f'{self._consumer}-{i}') for i in range(self._concurrency))
+        await asyncio.gather(*consumers, self._claim_stuck())
+
+    async def create_group(self) -> None:
+        """Create the stream and the consumer group if they don't exist."""
+        try:
+            await self._con.xgroup_create(self._stream, self._group, id='0', mkstream=True)
+        except ResponseError as err:
+            if 'BUSYGROUP' not in str(err):
+                raise
+
+    async def _consume(self, consumer: str) -> None:
+        """Read new jobs one by one and handle them."""
+        block_ms = int(self._block.total_seconds() * 1000)
+        while True:
+            response = await self._con.xreadgroup(self._group, consumer, {self._stream: '>'}, count=1, block=block_ms)
+            if not response:
+                # Stand-ins without blocking reads return at once, don't spin on them
+                await asyncio.sleep(self._idle_backoff.total_seconds())
+            for _, messages in response or []:
+                for message_id, fields in messages:
+                    await self._process(message_id, fields)
+
+    async def _claim_stuck(self) -> None:
+        """Periodically take over jobs other consumers haven't acknowledged in time."""
+        min_idle_ms = int(self._claim_idle.total_seconds() * 1000)
+        while True:
+            await asyncio.sleep(self._claim_idle.total_seconds() / 2)
+            start_id = '0-0'
+            while True:
+                start_id, messages, *_ = await self._con.xautoclaim(
+                    self._stream, self._group, f'{self._consumer}-claimer', min_idle_ms, start_id, count=100
+                )
+                for message_id, fields in messages:
+                    if await self._count_deliveries(message_id) > self._max_deliveries:
+                        await self._dead_letter(message_id, fields)
+                    else:
+                        await self._process(message_id, fields)
+                if start_id in {'0-0', b'0-0'}:
+                    break
+
+    async def _process(self, message_id: str, fields: dict[str, str]) -> None:
+        """Handle a job and acknowledge it, a failed one is left pending for a retry."""
+        try:
+            job = PushJobSchema.model_validate(json.loads(fields['job']))
+        except (KeyError, ValueError):
+            self._logger.exception(f'Queued push {message_id} is malformed')
+        else:
+            try:
+                await self._handle(job)
+            except Exception:
+                self._logger.exception(f'Queued push {message_id} failed')
+                return
+        await self._con.xack(self._stream, self._group, message_id)
+
+    async def _count_deliveries(self, message_id: str) -> int:
+        """Return how many times the job was delivered, the current claim included."""
+        pending = await self._con.xpending_range(self._stream, self._group, min=message_id, max=message_id, count=1)
+        return pending[0]['times_delivered'] if pending else 0
+
+    async def _dead_letter(self, message_id: str, fields: dict[str, str]) -> None:
+        """Move a job that keeps failing to the dead letter stream, acknowledge it."""
+        self._logger.error(f'Queued push {message_id} failed {self._max_deliveries} times, dead lettered')
+        async with self._con.pipeline(transaction=True) as pipe:
+            pipe.xadd(self._dead_letter_stream, {'job': fields.get('job', ''), 'id': message_id})
+            pipe.xack(self._stream, self._group, message_id)
+            await pipe.execute()
@@ -0,0 +1,62 @@
+"""Copy device tokens from the plain sets into the store keeping their metadata.
+
+Enable TOKEN_METADATA_MIGRATING first, so that tokens registered or deleted meanwhile
+reach both stores while pushes still read the sets, then run:
+python -m pushes.migrations [--batch-size N]
+and enable TOKEN_METADATA_ENABLED once it's done. Copying only adds tokens the new
+store doesn't have, so it's idempotent, and the sets are left in place to switch back.
+"""
+
+import argparse
+
+from integrations.redis import connection as redis_con
+from project_base.config import get_settings
+from project_base.loggers import logger
+
+from . import services
+from .repositories import (
+    APNS_OWNERS_KEY,
+    APNS_TOKENS_KEY_PATTERN,
+    FCM_OWNERS_KEY,
+    FCM_TOKENS_KEY_PATTERN,
+    RedisTokenMetadataRepository,
+    RedisTokenRepository,
+)
+from .schemas import Platform
+
+settings = get_settings()
+
+
+def copy_tokens(source: RedisTokenRepository, target: RedisTokenMetadataRepository, *, batch_size: int) -> int:
+    """Copy tokens of all users from source to target, return the number of tokens."""
+    copied = 0
+    for user_ids in source.scan_user_ids(batch_size):
+        copied += target.copy_from(source.key_pattern, user_ids)
+    return copied
+
+
+def main() -> None:
+    """Migrate tokens of both platforms."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    if redis_con is None:
+        msg = 'REDIS_URL is required to migrate tokens'
+        raise RuntimeError(msg)
+    if not settings.TOKEN_METADATA_MIGRATING or settings.TOKEN_METADATA_ENABLED:
+        msg = 'Enable TOKEN_METADATA_MIGRATING and not TOKEN_METADATA_ENABLED to migrate tokens'
+        raise RuntimeError(msg)
+
+    sources = {
+        Platform.APNS: RedisTokenRepository(redis_con, APNS_TOKENS_KEY_PATTERN, APNS_OWNERS_KEY),
+        Platform.FCM: RedisTokenRepository(redis_con, FCM_TOKENS_KEY_PATTERN, FCM_OWNERS_KEY),
+    }
+    for platform, source in sources.items():
+        target = services.get_token_metadata_repository(platform)
+        copied = copy_tokens(source, target, batch_size=args.batch_size)
+        logger.info('Migrated %d %s tokens', copied, platform)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import asyncio
+from collections.abc import Iterable
+from datetime import UTC, datetime, timedelta
+from logging import Logger
+
+from .repositories import RedisTokenMetadataRepository
+
+
+class StaleTokenPruner:
+    """Loop deleting tokens that weren't registered and got no push for max_age.
+
+    Devices gone for good don't always make the provider report their token invalid,
+    such tokens would be sent to forever otherwise.
+    """
+
+    def __init__(
+        self,
+        repositories: Iterable[RedisTokenMetadataRepository],
+        logger: Logger,
+        *,
+        max_age: timedelta,
+        batch_size: int,
+        interval: timedelta,
+    ) -> None:
+        self._repositories = list(repositories)
+        self._logger = logger
+        self._max_age = max_age
+        self._batch_size = batch_size
+        self._interval = interval
+
+    async def run(self) -> None:
+        """Prune stale tokens every interval until cancelled."""
+        while True:
+            for repo in self._repositories:
+                try:
+                    pruned = await self.prune(repo)
+                except Exception:
+                    self._logger.exception('Stale tokens pruning error')
+                else:
+                    if pruned:
+                        self._logger.info('Pruned %d stale tokens of %s', pruned, repo.key_pattern)
+            await asyncio.sleep(self._interval.total_seconds())
+
+    async def prune(self, repo: RedisTokenMetadataRepository) -> int:
+        """Delete all stale tokens of the repository in batches, return their number."""
+        seen_before = datetime.now(UTC) - self._max_age
+        total = 0
+        while True:
+            pruned = await asyncio.to_thread(repo.prune_stale, seen_before, self._batch_size)
+            total += pruned
+            if pruned < self._batch_size:
+                return total
@@ -1,10 +1,29 @@
+import time
+from collections.abc import Iterable, Iterator, Mapping
+from dataclasses import dataclass
+from datetime import UTC, datetime
+from itertools import islice
 from typing import NewType, Protocol
 
 from redis import Redis
+from redis.client import Pipeline
 
 Token = NewType('Token', str)
 UserId = NewType('UserId', str)
 
+APNS_TOKENS_KEY_PATTERN = 'user:{user_id}:apns-tokens'
+FCM_TOKENS_KEY_PATTERN = 'user:{user_id}:fcm-tokens'
+# Owner of each token
+APNS_OWNERS_KEY = 'apns-tokens:owners'
+FCM_OWNERS_KEY = 'fcm-tokens:owners'
+# User's tokens with their metadata, the index of all tokens by last activity, owners
+APNS_TOKEN_METADATA_KEYS = (
+    'user:{user_id}:apns-token-metadata',
+    'apns-tokens:last-seen',
+    'apns-token-metadata:owners',
+)
+FCM_TOKEN_METADATA_KEYS = ('user:{user_id}:fcm-token-metadata', 'fcm-tokens:last-seen', 'fcm-token-metadata:owners')
+
 
 class TokenRepository(Protocol):
     """A protocol for tokens storing."""
@@ -15,28 +34,547 @@ class TokenRepository(Protocol):
     def delete(self, user_id: UserId, token: Token) -> None:
         """Delete specified token."""
 
-    def get_all_by_user_id(self, user_id: UserId) -> list[Token]:
+    def get_all_by_user_id(self, user_id: UserId) -> set[Token]:
         """Get all user tokens by user_id."""
 
+    def get_all_by_user_ids(self, user_ids: Iterable[UserId]) -> dict[UserId, set[Token]]:
+        """Get tokens of several users at once."""
+
+    def queue_get_all_by_user_id(self, pipe: Pipeline, user_id: UserId) -> None:
+        """Queue getting user tokens in the pipeline, it replies with an iterable."""
+
+    def add_many(self, user_id: UserId, tokens: Iterable[Token]) -> None:
+        """Save several tokens of a user at once."""
+
+    def delete_many(self, user_id: UserId, tokens: Iterable[Token]) -> None:
+        """Delete several tokens of a user at once."""
+
+    def register_many(self, tokens_by_user: Mapping[UserId, Iterable[Token]]) -> None:
+        """Save tokens of several users at once."""
+
+    def unregister_many(self, tokens_by_user: Mapping[UserId, Iterable[Token]]) -> None:
+        """Delete tokens of several users at once."""
+
+    def record_outcomes(self, outcomes_by_user: Mapping[UserId, Mapping[Token, bool]]) -> None:
+        """Remember which tokens got a push and which failed."""
+
+    def scan_user_ids(self, batch_size: int) -> Iterator[list[UserId]]:
+        """Iterate over users having tokens in batches."""
+
+    def scan_user_ids_page(self, cursor: int, count: int, *, prefix: str = '') -> tuple[int, list[UserId]]:
+        """Return a page of users having tokens and the next cursor, 0 after the end."""
+
+    def reconcile_owners(self, user_ids: Iterable[UserId]) -> tuple[int, int]:
+        """Delete tokens of the users that others registered later.
+
+        Return how many were deleted and how many shared ones were left in place, as
+        it's unknown who registered them last.
+        """
+
 
 class RedisTokenRepository:
-    """Redis implementation of TokenRepository protocol."""
+    """Redis implementation of TokenRepository protocol.
+
+    A hash shared by all users maps each token to the user who registered it last, so
+    a device reused by another account moves to it instead of being shared.
+    """
+
+    # Keys of previous owners are only known to the script, so it needs a single node.
+    # KEYS: owners; ARGV: user_id, user key prefix and suffix, tokens
+    ADD_SCRIPT = """
+        local key = ARGV[2] .. ARGV[1] .. ARGV[3]
+        for i = 4, #ARGV do
+            local owner = redis.call('HGET', KEYS[1], ARGV[i])
+            if owner and owner ~= ARGV[1] then
+                redis.call('SREM', ARGV[2] .. owner .. ARGV[3], ARGV[i])
+            end
+            redis.call('HSET', KEYS[1], ARGV[i], ARGV[1])
+        end
+        redis.call('SADD', key, unpack(ARGV, 4))
+    """
+    # KEYS: user set, owners; ARGV: user_id, tokens
+    DELETE_SCRIPT = """
+        redis.call('SREM', KEYS[1], unpack(ARGV, 2))
+        for i = 2, #ARGV do
+            if redis.call('HGET', KEYS[2], ARGV[i]) == ARGV[1] then
+                redis.call('HDEL', KEYS[2], ARGV[i])
+            end
+        end
+    """
+    # The indexed owner keeps a shared token. Tokens not indexed yet don't tell who
+    # registered them last, so they are left to all users and only counted when shared.
+    # KEYS: user set, owners, users seen with tokens not indexed yet; ARGV: user_id,
+    # user key prefix and suffix
+    RECONCILE_SCRIPT = """
+        local removed, shared = 0, 0
+        for _, token in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+            local owner = redis.call('HGET', KEYS[2], token)
+            local seen = not owner and redis.call('HGET', KEYS[3], token)
+            if owner and owner ~= ARGV[1] and redis.call('SISMEMBER', ARGV[2] .. owner .. ARGV[3], token) == 1 then
+                redis.call('SREM', KEYS[1], token)
+                removed = removed + 1
+            elseif owner then
+                redis.call('HSET', KEYS[2], token, ARGV[1])
+            elseif seen and seen ~= ARGV[1] and redis.call('SISMEMBER', ARGV[2] .. seen .. ARGV[3], token) == 1 then
+                shared = shared + 1
+            else
+                redis.call('HSET', KEYS[3], token, ARGV[1])
+            end
+        end
+        redis.call('EXPIRE', KEYS[3], 86400)
+        return {removed, shared}
+    """
 
-    def __init__(self, connection: Redis, key_pattern: str) -> None:
+    def __init__(self, connection: Redis, key_pattern: str, owners_key: str) -> None:
         self.key_pattern = key_pattern
         self._con = connection
+        self._owners_key = owners_key
+        self._key_prefix, self._key_suffix = key_pattern.split('{user_id}')
+        self._add = connection.register_script(self.ADD_SCRIPT)
+        self._delete = connection.register_script(self.DELETE_SCRIPT)
+        self._reconcile = connection.register_script(self.RECONCILE_SCRIPT)
 
     def add(self, user_id: UserId, token: Token) -> None:
-        """Save token."""
-        key = self.key_pattern.format(user_id=user_id)
-        self._con.sadd(key, token)
+        """Save token, taking it away from its previous user."""
+        self.add_many(user_id, [token])
 
     def delete(self, user_id: UserId, token: Token) -> None:
         """Delete specified token."""
-        key = self.key_pattern.format(user_id=user_id)
-        self._con.srem(key, token)
+        self.delete_many(user_id, [token])
 
     def get_all_by_user_id(self, user_id: UserId) -> set[Token]:
         """Get all user tokens by user_id."""
         key = self.key_pattern.format(user_id=user_id)
         return self._con.smembers(key)  # type: ignore[return-value]
+
+    def get_all_by_user_ids(self, user_ids: Iterable[UserId]) -> dict[UserId, set[Token]]:
+        """Get tokens of several users in a single round trip."""
+        user_ids = list(dict.fromkeys(user_ids))
+        pipe = self._con.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.smembers(self.key_pattern.format(user_id=user_id))
+        return dict(zip(user_ids, pipe.execute(), strict=True))
+
+    def queue_get_all_by_user_id(self, pipe: Pipeline, user_id: UserId) -> None:
+        """Queue getting user tokens in the pipeline, its reply is a set of them."""
+        pipe.smembers(self.key_pattern.format(user_id=user_id))
+
+    def add_many(self, user_id: UserId, tokens: Iterable[Token]) -> None:
+        """Save several tokens of a user with a single command."""
+        if tokens := list(tokens):
+            self._add(keys=[self._owners_key], args=[user_id, self._key_prefix, self._key_suffix, *tokens])
+
+    def delete_many(self, user_id: UserId, tokens: Iterable[Token]) -> None:
+        """Delete several tokens of a user with a single command."""
+        if tokens := list(tokens):
+            self._delete(keys=[self.key_pattern.format(user_id=user_id), self._owners_key], args=[user_id, *tokens])
+
+    def register_many(self, tokens_by_user: Mapping[UserId, Iterable[Token]]) -> None:
+        """Save tokens of several users in a single round trip."""
+        pipe = self._con.pipeline(transaction=False)
+        for user_id, tokens in tokens_by_user.items():
+            if tokens := list(tokens):
+                args = [user_id, self._key_prefix, self._key_suffix, *tokens]
+                self._add(keys=[self._owners_key], args=args, client=pipe)
+        pipe.execute()
+
+    def unregister_many(self, tokens_by_user: Mapping[UserId, Iterable[Token]]) -> None:
+        """Delete tokens of several users in a single round trip."""
+        pipe = self._con.pipeline(transaction=False)
+        for user_id, tokens in tokens_by_user.items():
+            if tokens := list(tokens):
+                keys = [self.key_pattern.format(user_id=user_id), self._owners_key]
+                self._delete(keys=keys, args=[user_id, *tokens], client=pipe)
+        pipe.execute()
+
+    def record_outcomes(self, outcomes_by_user: Mapping[UserId, Mapping[Token, bool]]) -> None:
+        """Bare sets keep no metadata."""
+
+    def scan_user_ids(self, batch_size: int) -> Iterator[list[UserId]]:
+        """Iterate over users having tokens in batches, without blocking Redis."""
+        return _scan_user_ids(self._con, self.key_pattern, batch_size)
+
+    def scan_user_ids_page(self, cursor: int, count: int, *, prefix: str = '') -> tuple[int, list[UserId]]:
+        """Return a page of users whose id starts with prefix and the next cursor."""
+        return _scan_user_ids_page(self._con, self.key_pattern, cursor, count, prefix)
+
+    def reconcile_owners(self, user_ids: Iterable[UserId]) -> tuple[int, int]:
+        """Delete tokens of the users that others registered later.
+
+        Return how many were deleted and how many shared ones were left in place, as
+        it's unknown who registered them last.
+        """
+        pipe = self._con.pipeline(transaction=False)
+        for user_id in user_ids:
+            keys = [self.key_pattern.format(user_id=user_id), self._owners_key, f'{self._owners_key}:unindexed']
+            self._reconcile(keys=keys, args=[user_id, self._key_prefix, self._key_suffix], client=pipe)
+        results = pipe.execute()
+        return sum(removed for removed, _ in results), sum(shared for _, shared in results)
+
+
+@dataclass(frozen=True)
+class TokenMetadata:
+    """What is known about a device token."""
+
+    registered_at: datetime
+    last_success_at: datetime | None
+    # Failed sends since the last successful one
+    failure_count: int
+    # APNS environment the token belongs to, empty for FCM
+    environment: str
+
+
+class RedisTokenMetadataRepository:
+    """Redis implementation of TokenRepository protocol keeping metadata of each token.
+
+    Tokens of a user live in a hash with a compact value per token:
+    "registered_at:last_success_at:failure_count:environment". A sorted set shared by
+    all users scores each token with the last time it was registered or got a push,
+    so stale tokens are found without scanning users.
+    """
+
+    # KEYS: user hash, index, owners; ARGV: user_id, user key prefix and suffix, now,
+    # environment, tokens
+    ADD_SCRIPT = """
+        for i = 6, #ARGV do
+            local token = ARGV[i]
+            local owner = redis.call('HGET', KEYS[3], token)
+            if owner and owner ~= ARGV[1] then
+                redis.call('HDEL', ARGV[2] .. owner .. ARGV[3], token)
+                redis.call('ZREM', KEYS[2], owner .. '\\n' .. token)
+            end
+            local meta = redis.call('HGET', KEYS[1], token)
+            local last_success_at = meta and string.match(meta, '^%d+:(%d+):') or '0'
+            redis.call('HSET', KEYS[1], token, ARGV[4] .. ':' .. last_success_at .. ':0:' .. ARGV[5])
+            redis.call('ZADD', KEYS[2], ARGV[4], ARGV[1] .. '\\n' .. token)
+            redis.call('HSET', KEYS[3], token, ARGV[1])
+        end
+    """
+    # KEYS: user hash, index, owners; ARGV: user_id, tokens
+    DELETE_SCRIPT = """
+        for i = 2, #ARGV do
+            redis.call('HDEL', KEYS[1], ARGV[i])
+            redis.call('ZREM', KEYS[2], ARGV[1] .. '\\n' .. ARGV[i])
+            if redis.call('HGET', KEYS[3], ARGV[i]) == ARGV[1] then
+                redis.call('HDEL', KEYS[3], ARGV[i])
+            end
+        end
+    """
+    # KEYS: user hash, index; ARGV: now, then token, index member, 1 or 0 for each send
+    RECORD_SCRIPT = """
+        for i = 2, #ARGV, 3 do
+            local meta = redis.call('HGET', KEYS[1], ARGV[i])
+            if meta then
+                local registered_at, last_success_at, failures, environment =
+                    string.match(meta, '^(%d+):(%d+):(%d+):(.*)$')
+                if ARGV[i + 2] == '1' then
+                    last_success_at, failures = ARGV[1], 0
+                    redis.call('ZADD', KEYS[2], ARGV[1], ARGV[i + 1])
+                else
+                    failures = failures + 1
+                end
+                local value = registered_at .. ':' .. last_success_at .. ':' .. failures .. ':' .. environment
+                redis.call('HSET', KEYS[1], ARGV[i], value)
+            end
+        end
+    """
+    # Removes tokens atomically, so a token that just got a push isn't pruned.
+    # KEYS: index, owners; ARGV: cutoff, limit, user key prefix and suffix
+    PRUNE_SCRIPT = """
+        local members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+        for _, member in ipairs(members) do
+            local separator = string.find(member, '\\n', 1, true)
+            local user_id, token = string.sub(member, 1, separator - 1), string.sub(member, separator + 1)
+            redis.call('HDEL', ARGV[3] .. user_id .. ARGV[4], token)
+            if redis.call('HGET', KEYS[2], token) == user_id then
+                redis.call('HDEL', KEYS[2], token)
+            end
+        end
+        if #members > 0 then
+            redis.call('ZREM', KEYS[1], unpack(members))
+        end
+        return #members
+    """
+    # The user who registered a shared token last keeps it, as registration times are
+    # kept with the tokens.
+    # KEYS: user hash, index, owners; ARGV: user_id, user key prefix and suffix
+    RECONCILE_SCRIPT = """
+        local removed = 0
+        local tokens = redis.call('HGETALL', KEYS[1])
+        for i = 1, #tokens, 2 do
+            local token, registered_at = tokens[i], tonumber(string.match(tokens[i + 1], '^%d+'))
+            local owner = redis.call('HGET', KEYS[3], token)
+            local owner_meta = owner and owner ~= ARGV[1] and redis.call('HGET', ARGV[2] .. owner .. ARGV[3], token)
+            if owner_meta and tonumber(string.match(owner_meta, '^%d+')) >= registered_at then
+                redis.call('HDEL', KEYS[1], token)
+                redis.call('ZREM', KEYS[2], ARGV[1] .. '\\n' .. token)
+                removed = removed + 1
+            else
+                if owner_meta then
+                    redis.call('HDEL', ARGV[2] .. owner .. ARGV[3], token)
+                    redis.call('ZREM', KEYS[2], owner .. '\\n' .. token)
+                    removed = removed + 1
+                end
+                redis.call('HSET', KEYS[3], token, ARGV[1])
+            end
+        end
+        return removed
+    """
+
+    # Copies tokens the store has no owner for, so none registered or deleted since
+    # the copy started is overwritten or brought back.
+    # KEYS: plain user set, user hash, index, owners; ARGV: user_id, now, environment
+    COPY_SCRIPT = """
+        local copied = 0
+        for _, token in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+            if redis.call('HEXISTS', KEYS[4], token) == 0 then
+                redis.call('HSET', KEYS[2], token, ARGV[2] .. ':0:0:' .. ARGV[3])
+                redis.call('ZADD', KEYS[3], ARGV[2], ARGV[1] .. '\\n' .. token)
+                redis.call('HSET', KEYS[4], token, ARGV[1])
+                copied = copied + 1
+            end
+        end
+        return copied
+    """
+
+    def __init__(
+        self, connection: Redis, key_pattern: str, index_key: str, owners_key: str, *, environment: str = ''
+    ) -> None:
+        self.key_pattern = key_pattern
+        self._con = connection
+        self._index_key = index_key
+        self._owners_key = owners_key
+        self._environment = environment
+        self._key_prefix, self._key_suffix = key_pattern.split('{user_id}')
+        self._add = connection.register_script(self.ADD_SCRIPT)
+        self._delete = connection.register_script(self.DELETE_SCRIPT)
+        self._record = connection.register_script(self.RECORD_SCRIPT)
+        self._prune = connection.register_script(self.PRUNE_SCRIPT)
+        self._reconcile = connection.register_script(self.RECONCILE_SCRIPT)
+        self._copy = connection.register_script(self.COPY_SCRIPT)
+
+    def add(self, user_id: UserId, token: Token) -> None:
+        """Save token, taking it away from its previous user."""
+        self.add_many(user_id, [token])
+
+    def delete(self, user_id: UserId, token: Token) -> None:
+        """Delete specified token."""
+        self.delete_many(user_id, [token])
+
+    def get_all_by_user_id(self, user_id: UserId) -> set[Token]:
+        """Get all user tokens by user_id."""
+        return set(self._con.hkeys(self.key_pattern.format(user_id=user_id)))  # type: ignore[arg-type]
+
+    def get_all_by_user_ids(self, user_ids: Iterable[UserId]) -> dict[UserId, set[Token]]:
+        """Get tokens of several users in a single round trip."""
+        user_ids = list(dict.fromkeys(user_ids))
+        pipe = self._con.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.hkeys(self.key_pattern.format(user_id=user_id))
+        return {user_id: set(tokens) for user_id, tokens in zip(user_ids, pipe.execute(), strict=True)}
+
+    def queue_get_all_by_user_id(self, pipe: Pipeline, user_id: UserId) -> None:
+        """Queue getting user tokens in the pipeline, its reply is a list of them."""
+        pipe.hkeys(self.key_pattern.format(user_id=user_id))
+
+    def add_many(self, user_id: UserId, tokens: Iterable[Token]) -> None:
+        """Save several tokens of a user in a single round trip."""
+        self.register_many({user_id: tokens})
+
+    def delete_many(self, user_id: UserId, tokens: Iterable[Token]) -> None:
+        """Delete several tokens of a user in a single round trip."""
+        self.unregister_many({user_id: tokens})
+
+    def register_many(self, tokens_by_user: Mapping[UserId, Iterable[Token]]) -> None:
+        """Save tokens of several users in a single round trip."""
+        now = int(time.time())
+        pipe = self._con.pipeline(transaction=False)
+        for user_id, tokens in tokens_by_user.items():
+            if tokens := list(tokens):
+                keys = [self.key_pattern.format(user_id=user_id), self._index_key, self._owners_key]
+                args: list[str | int] = [user_id, self._key_prefix, self._key_suffix, now, self._environment, *tokens]
+                self._add(keys=keys, args=args, client=pipe)
+        pipe.execute()
+
+    def unregister_many(self, tokens_by_user: Mapping[UserId, Iterable[Token]]) -> None:
+        """Delete tokens of several users in a single round trip."""
+        pipe = self._con.pipeline(transaction=False)
+        for user_id, tokens in tokens_by_user.items():
+            if tokens := list(tokens):
+                keys = [self.key_pattern.format(user_id=user_id), self._index_key, self._owners_key]
+                self._delete(keys=keys, args=[user_id, *tokens], client=pipe)
+        pipe.execute()
+
+    def record_outcomes(self, outcomes_by_user: Mapping[UserId, Mapping[Token, bool]]) -> None:
+        """Remember which tokens got a push and which failed, in a single round trip."""
+        now = int(time.time())
+        pipe = self._con.pipeline(transaction=False)
+        for user_id, outcomes in outcomes_by_user.items():
+            args: list[str | int] = [now]
+            for token, succeeded in outcomes.items():
+                args += [token, self._member(user_id, token), int(succeeded)]
+            if len(args) > 1:
+                self._record(keys=[self.key_pattern.format(user_id=user_id), self._index_key], args=args, client=pipe)
+        pipe.execute()
+
+    def scan_user_ids(self, batch_size: int) -> Iterator[list[UserId]]:
+        """Iterate over users having tokens in batches, without blocking Redis."""
+        return _scan_user_ids(self._con, self.key_pattern, batch_size)
+
+    def scan_user_ids_page(self, cursor: int, count: int, *, prefix: str = '') -> tuple[int, list[UserId]]:
+        """Return a page of users whose id starts with prefix and the next cursor."""
+        return _scan_user_ids_page(self._con, self.key_pattern, cursor, count, prefix)
+
+    def reconcile_owners(self, user_ids: Iterable[UserId]) -> tuple[int, int]:
+        """Delete tokens of the users that others registered later.
+
+        Return how many were deleted and 0 shared ones left in place, the registration
+        time of every token is known.
+        """
+        pipe = self._con.pipeline(transaction=False)
+        for user_id in user_ids:
+            keys = [self.key_pattern.format(user_id=user_id), self._index_key, self._owners_key]
+            self._reconcile(keys=keys, args=[user_id, self._key_prefix, self._key_suffix], client=pipe)
+        return sum(pipe.execute()), 0
+
+    def copy_from(self, source_key_pattern: str, user_ids: Iterable[UserId]) -> int:
+        """Copy tokens of the users from their plain sets, return how many were copied.
+
+        Tokens the store already has an owner for are left as they are.
+        """
+        now = int(time.time())
+        pipe = self._con.pipeline(transaction=False)
+        for user_id in user_ids:
+            keys = [
+                source_key_pattern.format(user_id=user_id),
+                self.key_pattern.format(user_id=user_id),
+                self._index_key,
+                self._owners_key,
+            ]
+            self._copy(keys=keys, args=[user_id, now, self._environment], client=pipe)
+        return sum(pipe.execute())
+
+    def get_metadata(self, user_id: UserId) -> dict[Token, TokenMetadata]:
+        """Get all user tokens with their metadata."""
+        metadata = {}
+        for token, value in self._con.hgetall(self.key_pattern.format(user_id=user_id)).items():  # type: ignore[union-attr]
+            registered_at, last_success_at, failure_count, environment = value.split(':', 3)
+            metadata[token] = TokenMetadata(
+                registered_at=datetime.fromtimestamp(int(registered_at), UTC),
+                last_success_at=datetime.fromtimestamp(int(last_success_at), UTC) if int(last_success_at) else None,
+                failure_count=int(failure_count),
+                environment=environment,
+            )
+        return metadata
+
+    def prune_stale(self, seen_before: datetime, limit: int) -> int:
+        """Delete up to limit tokens without a registration or push since seen_before.
+
+        Return the number of deleted tokens.
+        """
+        args: list[str | int] = [int(seen_before.timestamp()), limit, self._key_prefix, self._key_suffix]
+        return self._prune(keys=[self._index_key, self._owners_key], args=args)
+
+    @staticmethod
+    def _member(user_id: UserId, token: Token) -> str:
+        """Return the index entry of a token, tokens never contain line breaks."""
+        return f'{user_id}\n{token}'
+
+
+class MirroredTokenRepository:
+    """TokenRepository reading from a store and writing to it and to a mirror.
+
+    Keeps the store tokens are being copied to up to date until reads switch to it.
+    The primary store is written first, so a copy running in between can't bring
+    back a token just deleted from it.
+    """
+
+    def __init__(self, primary: TokenRepository, mirror: TokenRepository) -> None:
+        self._primary = primary
+        self._mirror = mirror
+
+    def add(self, user_id: UserId, token: Token) -> None:
+        """Save token in both stores."""
+        self._primary.add(user_id, token)
+        self._mirror.add(user_id, token)
+
+    def delete(self, user_id: UserId, token: Token) -> None:
+        """Delete specified token from both stores."""
+        self._primary.delete(user_id, token)
+        self._mirror.delete(user_id, token)
+
+    def get_all_by_user_id(self, user_id: UserId) -> set[Token]:
+        """Get all user tokens by user_id."""
+        return self._primary.get_all_by_user_id(user_id)
+
+    def get_all_by_user_ids(self, user_ids: Iterable[UserId]) -> dict[UserId, set[Token]]:
+        """Get tokens of several users at once."""
+        return self._primary.get_all_by_user_ids(user_ids)
+
+    def queue_get_all_by_user_id(self, pipe: Pipeline, user_id: UserId) -> None:
+        """Queue getting user tokens in the pipeline, it replies with an iterable."""
+        self._primary.queue_get_all_by_user_id(pipe, user_id)
+
+    def add_many(self, user_id: UserId, tokens: Iterable[Token]) -> None:
+        """Save several tokens of a user in both stores."""
+        tokens = list(tokens)
+        self._primary.add_many(user_id, tokens)
+        self._mirror.add_many(user_id, tokens)
+
+    def delete_many(self, user_id: UserId, tokens: Iterable[Token]) -> None:
+        """Delete several tokens of a user from both stores."""
+        tokens = list(tokens)
+        self._primary.delete_many(user_id, tokens)
+        self._mirror.delete_many(user_id, tokens)
+
+    def register_many(self, tokens_by_user: Mapping[UserId, Iterable[Token]]) -> None:
+        """Save tokens of several users in both stores."""
+        tokens_by_user = {user_id: list(tokens) for user_id, tokens in tokens_by_user.items()}
+        self._primary.register_many(tokens_by_user)
+        self._mirror.register_many(tokens_by_user)
+
+    def unregister_many(self, tokens_by_user: Mapping[UserId, Iterable[Token]]) -> None:
+        """Delete tokens of several users from both stores."""
+        tokens_by_user = {user_id: list(tokens) for user_id, tokens in tokens_by_user.items()}
+        self._primary.unregister_many(tokens_by_user)
+        self._mirror.unregister_many(tokens_by_user)
+
+    def record_outcomes(self, outcomes_by_user: Mapping[UserId, Mapping[Token, bool]]) -> None:
+        """Remember which tokens got a push and which failed in both stores."""
+        self._primary.record_outcomes(outcomes_by_user)
+        self._mirror.record_outcomes(outcomes_by_user)
+
+    def scan_user_ids(self, batch_size: int) -> Iterator[list[UserId]]:
+        """Iterate over users having tokens in batches."""
+        return self._primary.scan_user_ids(batch_size)
+
+    def scan_user_ids_page(self, cursor: int, count: int, *, prefix: str = '') -> tuple[int, list[UserId]]:
+        """Return a page of users having tokens and the next cursor, 0 after the end."""
+        return self._primary.scan_user_ids_page(cursor, count, prefix=prefix)
+
+    def reconcile_owners(self, user_ids: Iterable[UserId]) -> tuple[int, int]:
+        """Delete tokens of the users that others registered later in both stores.
+
+        Return the counts of the primary store.
+        """
+        user_ids = list(user_ids)
+        counts = self._primary.reconcile_owners(user_ids)
+        self._mirror.reconcile_owners(user_ids)
+        return counts
+
+
+def _scan_user_ids(connection: Redis, key_pattern: str, batch_size: int) -> Iterator[list[UserId]]:
+    """Iterate over users having a key matching key_pattern in batches."""
+    prefix, suffix = key_pattern.split('{user_id}')
+    keys = connection.scan_iter(match=key_pattern.format(user_id='*'), count=batch_size)
+    while batch := list(islice(keys, batch_size)):
+        yield [UserId(key[len(prefix) : len(key) - len(suffix)]) for key in batch]
+
+
+def _scan_user_ids_page(
+    connection: Redis, key_pattern: str, cursor: int, count: int, prefix: str
+) -> tuple[int, list[UserId]]:
+    """Return a page of users having a key matching key_pattern and the next cursor."""
+    key_prefix, key_suffix = key_pattern.split('{user_id}')
+    cursor, keys = connection.scan(cursor, match=key_pattern.format(user_id=f'{prefix}*'), count=count)  # type: ignore[misc]
+    return cursor, [UserId(key[len(key_prefix) : len(key) - len(key_suffix)]) for key in keys]
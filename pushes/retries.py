@@ -0,0 +1,55 @@
+import random
+from dataclasses import dataclass
+from datetime import timedelta
+
+from integrations import apns
+from integrations import firebase as fb
+
+from .throttling import ThrottledError
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """Exponential backoff with jitter for a class of transient errors."""
+
+    max_attempts: int
+    base_delay: timedelta
+    max_delay: timedelta
+    # Share of the delay that is randomized to spread retries of many pushes
+    jitter: float = 0.5
+
+    def get_delay(self, attempt: int, retry_after: float | None = None) -> timedelta | None:
+        """Return the delay before the next attempt or None if no attempts are left.
+
+        attempt is the number of retries already made. The delay is never shorter than
+        the Retry-After value given by the provider.
+        """
+        if attempt >= self.max_attempts:
+            return None
+
+        backoff = min(self.base_delay * 2**attempt, self.max_delay)
+        delay = backoff * (1 - self.jitter * random.random())
+        if retry_after is not None:
+            delay = max(delay, timedelta(seconds=retry_after))
+        return delay
+
+
+# Errors missing here or mapped to None aren't retried
+RETRY_POLICIES: dict[type[Exception], RetryPolicy | None] = {
+    ThrottledError: RetryPolicy(3, timedelta(seconds=5), timedelta(minutes=1)),
+    apns.TooManyRequestsError: RetryPolicy(3, timedelta(seconds=5), timedelta(minutes=1)),
+    apns.ServiceUnavailableError: RetryPolicy(5, timedelta(seconds=1), timedelta(minutes=1)),
+    apns.AnotherError: None,
+    # Connection errors and timeouts, the push may have been delivered: at least once
+    apns.APNSServiceError: RetryPolicy(3, timedelta(seconds=1), timedelta(seconds=30)),
+    fb.FireBaseUnavailableError: RetryPolicy(5, timedelta(seconds=1), timedelta(minutes=1)),
+    fb.FireBaseServiceError: RetryPolicy(3, timedelta(seconds=1), timedelta(seconds=30)),
+}
+
+
+def get_retry_policy(err: Exception) -> RetryPolicy | None:
+    """Return the policy for the most specific class of the error."""
+    for cls in type(err).__mro__:
+        if cls in RETRY_POLICIES:
+            return RETRY_POLICIES[cls]
+    return None
@@ -1,20 +1,130 @@
+import asyncio
+import math
+from collections import Counter
+from collections.abc import AsyncIterator, Sequence
+from contextlib import AsyncExitStack, asynccontextmanager
+from datetime import UTC, datetime, timedelta
+from functools import partial
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Response, status
 
 from integrations import apns
 from integrations import firebase as fb
-from integrations.cache import LocalCacheRepository, RedisCacheRepository
+from integrations.metrics import track_route
 from integrations.redis import connection as redis_con
 from project_base.config import get_settings
-from project_base.loggers import logger
 
+from . import services
 from .authentication import authenticate_request
-from .repositories import RedisTokenRepository
-from .schemas import SendPushByTokenSchema, SendPushByUserIdSchema, TokenRequestSchema
+from .deadlines import DeadlineExceededError, start_deadline
+from .repositories import Token, UserId
+from .schemas import (
+    Platform,
+    PushJobSchema,
+    SendOutcome,
+    SendOutcomeCountsSchema,
+    SendPushBulkResultSchema,
+    SendPushBulkSchema,
+    SendPushByTokenSchema,
+    SendPushByUserIdResultSchema,
+    SendPushByUserIdSchema,
+    SendPushSchema,
+    TokenRequestSchema,
+)
+from .throttling import ThrottledError
 
 settings = get_settings()
-router = APIRouter()
+
+
+async def track_deadline(x_push_deadline_ms: Annotated[int | None, Header(gt=0)] = None) -> None:
+    """Give pushes sent while serving the request the time budget of its header."""
+    budget = timedelta(seconds=settings.PUSH_DEADLINE_SECS)
+    if x_push_deadline_ms is not None:
+        budget = timedelta(milliseconds=x_push_deadline_ms)
+    start_deadline(budget)
+
+
+router = APIRouter(dependencies=[Depends(track_route), Depends(track_deadline)])
+
+
+@asynccontextmanager
+async def releasing_unsent(
+    platform: Platform, data: SendPushSchema, *, user_ids: Sequence[UserId] = (), tokens: Sequence[Token] = ()
+) -> AsyncIterator[None]:
+    """Release the push unless it was sent, answer with 504 if it ran out of time.
+
+    A request failing for any reason, an error response included, can then be retried.
+    """
+    try:
+        yield
+    except DeadlineExceededError:
+        await services.release_sends(platform, data, user_ids=user_ids, tokens=tokens)
+        raise HTTPException(status.HTTP_504_GATEWAY_TIMEOUT, 'The push ran out of its deadline') from None
+    except BaseException:
+        await services.release_sends(platform, data, user_ids=user_ids, tokens=tokens)
+        raise
+
+
+def throttled(err: ThrottledError) -> HTTPException:
+    """Return the error answering a push to a device over its rate limit."""
+    retry_after = str(math.ceil(err.retry_after))
+    return HTTPException(status.HTTP_429_TOO_MANY_REQUESTS, 'Device rate limit exceeded', {'Retry-After': retry_after})
+
+
+def check_sent(provider: str, outcomes: dict[Token, SendOutcome]) -> None:
+    """Raise if some pushes failed or ran out of the deadline, listing the latter."""
+    expired = services.get_expired_tokens(outcomes)
+    expired_msg = f'Pushes to some tokens ran out of the deadline: {", ".join(expired)}'
+    if SendOutcome.FAILED in outcomes.values():
+        msg = f'An {provider} error occured. Some pushes were not sent'
+        raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, f'{msg}. {expired_msg}' if expired else msg)
+    if expired:
+        raise HTTPException(status.HTTP_504_GATEWAY_TIMEOUT, expired_msg)
+
+
+async def enqueue(job: PushJobSchema) -> Response:
+    """Queue a push for sending by a worker."""
+    await asyncio.to_thread(services.get_dispatch_queue().enqueue, services.with_expiry(job))
+    return Response(status_code=status.HTTP_202_ACCEPTED)
+
+
+def get_send_at(data: SendPushSchema) -> datetime | None:
+    """Return the time the push was requested for, None if it's to be sent now."""
+    if data.send_at is None or data.send_at <= datetime.now(UTC):
+        return None
+    return data.send_at
+
+
+async def schedule(jobs: list[PushJobSchema], send_at: datetime) -> Response:
+    """Keep pushes for sending at send_at by the scheduler."""
+    if redis_con is None:
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, 'No queue storage was initialized')
+
+    jobs = [services.with_expiry(job) for job in jobs]
+    await asyncio.to_thread(services.get_scheduled_queue().add_many, jobs, send_at)
+    return Response(status_code=status.HTTP_202_ACCEPTED)
+
+
+async def send_later(job: PushJobSchema) -> Response | None:
+    """Schedule or queue the push unless it's to be sent right away, None if it is."""
+    if (send_at := get_send_at(job)) is not None:
+        return await schedule([job], send_at)
+    if not settings.DISPATCH_QUEUED:
+        return None
+    if redis_con is None:
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, 'No queue storage was initialized')
+    return await enqueue(job)
+
+
+async def schedule_bulk(platform: Platform, data: SendPushBulkSchema, send_at: datetime) -> Response:
+    """Keep a push to many recipients as a job per recipient for sending at send_at."""
+    user_ids, tokens = await services.claim_sends(platform, data, user_ids=data.user_ids, tokens=data.tokens)
+    fields = data.model_dump(include={'guid', 'status', 'send_at'})
+    jobs = [PushJobSchema(platform=platform, user_id=user_id, **fields) for user_id in user_ids]
+    jobs += [PushJobSchema(platform=platform, token=token, **fields) for token in tokens]
+    async with releasing_unsent(platform, data, user_ids=user_ids, tokens=tokens):
+        return await schedule(jobs, send_at)
 
 
 @router.post('/fcm/add-token', status_code=status.HTTP_201_CREATED)
@@ -23,7 +133,7 @@ def add_fcm_token(auth: Annotated[None, Depends(authenticate_request)], data: To
     if redis_con is None:
         raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, 'No token storage was initialized')
 
-    repo = RedisTokenRepository(redis_con, 'user:{user_id}:fcm-tokens')
+    repo = services.get_tokens_repository(Platform.FCM)
     repo.add(data.user_id, data.token)
 
 
@@ -33,62 +143,88 @@ def delete_fcm_token(auth: Annotated[None, Depends(authenticate_request)], data:
     if redis_con is None:
         raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, 'No token storage was initialized')
 
-    repo = RedisTokenRepository(redis_con, 'user:{user_id}:fcm-tokens')
+    repo = services.get_tokens_repository(Platform.FCM)
     repo.delete(data.user_id, data.token)
 
 
-@router.post('/fcm/send-by-user-id', status_code=status.HTTP_204_NO_CONTENT)
-def send_fcm_push_by_user_id(
+@router.post('/fcm/send-by-user-id', status_code=status.HTTP_204_NO_CONTENT, response_model=None)
+async def send_fcm_push_by_user_id(
     auth: Annotated[None, Depends(authenticate_request)], data: SendPushByUserIdSchema
-) -> None:
+) -> Response | None:
     """Send an FCM push notification by user_id."""
     if redis_con is None:
         raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, 'No token storage was initialized')
 
-    tokens_repo = RedisTokenRepository(redis_con, 'user:{user_id}:fcm-tokens')
-    tokens = tokens_repo.get_all_by_user_id(data.user_id)
-
-    cache_storage = RedisCacheRepository(redis_con) if redis_con is not None else LocalCacheRepository()
-    firebase_service = fb.FireBase(cache_storage, logger)
+    if not (await services.claim_sends(Platform.FCM, data, user_ids=[data.user_id]))[0]:
+        return None
 
-    data_to_send = {'guid': data.guid, 'call_status': data.status, 'click_action': 'FLUTTER_NOTIFICATION_CLICK'}
+    async with releasing_unsent(Platform.FCM, data, user_ids=[data.user_id]):
+        job = PushJobSchema(
+            platform=Platform.FCM, user_id=data.user_id, guid=data.guid, status=data.status, send_at=data.send_at
+        )
+        if (response := await send_later(job)) is not None:
+            return response
 
-    err_occured = False
-    for token in tokens:
-        try:
-            firebase_service.send_message(fcm_token=token, title=None, message=None, extra_data=data_to_send)
-        except (fb.FireBaseInvalidRequestError, fb.FireBaseFCMTokenNotFoundError):
-            tokens_repo.delete(data.user_id, token)
-        except fb.FireBaseTokenError:
-            firebase_service.delete_access_token()
-            firebase_service.send_message(fcm_token=token, title=None, message=None, extra_data=data_to_send)
-        except fb.FireBaseServiceError:
-            err_occured = True
+        outcomes = await services.deliver(job)
+        check_sent('FCM', outcomes)
 
-    if err_occured:
-        msg = 'An FCM error occured. Some pushes were not sent'
-        raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, msg) from None
+    if SendOutcome.RETRYING in outcomes.values():
+        return Response(status_code=status.HTTP_202_ACCEPTED)
+    return None
 
 
-@router.post('/fcm/send-by-token', status_code=status.HTTP_204_NO_CONTENT)
-def send_fcm_push_by_token(auth: Annotated[None, Depends(authenticate_request)], data: SendPushByTokenSchema) -> None:
+@router.post('/fcm/send-by-token', status_code=status.HTTP_204_NO_CONTENT, response_model=None)
+async def send_fcm_push_by_token(
+    auth: Annotated[None, Depends(authenticate_request)], data: SendPushByTokenSchema
+) -> Response | None:
     """Send an FCM push notification by token."""
-    storage = RedisCacheRepository(redis_con) if redis_con is not None else LocalCacheRepository()
-    firebase_service = fb.FireBase(storage, logger)
-
-    data_to_send = {'guid': data.guid, 'call_status': data.status, 'click_action': 'FLUTTER_NOTIFICATION_CLICK'}
+    if not (await services.claim_sends(Platform.FCM, data, tokens=[data.token]))[1]:
+        return None
 
     try:
-        firebase_service.send_message(fcm_token=data.token, title=None, message=None, extra_data=data_to_send)
+        async with releasing_unsent(Platform.FCM, data, tokens=[data.token]):
+            job = PushJobSchema(
+                platform=Platform.FCM, token=data.token, guid=data.guid, status=data.status, send_at=data.send_at
+            )
+            if (response := await send_later(job)) is not None:
+                return response
+            await services.send_to_token(Platform.FCM, data.token, data)
+    except ThrottledError as err:
+        raise throttled(err) from None
     except fb.FireBaseFCMTokenNotFoundError:
         raise HTTPException(status.HTTP_400_BAD_REQUEST, 'FCM token is not registered') from None
-    except fb.FireBaseTokenError:
-        firebase_service.delete_access_token()
-        firebase_service.send_message(fcm_token=data.token, title=None, message=None, extra_data=data_to_send)
     except fb.FireBaseInvalidRequestError:
         raise HTTPException(status.HTTP_400_BAD_REQUEST, 'Invalid FCM request') from None
-    except fb.FireBaseServiceError:
+    except fb.FireBaseTooManyRequestsError as err:
+        headers = None if err.retry_after is None else {'Retry-After': str(math.ceil(err.retry_after))}
+        raise HTTPException(status.HTTP_429_TOO_MANY_REQUESTS, 'FCM error: TooManyRequests', headers) from None
+    except (fb.FireBaseServiceError, fb.FireBaseTokenError):
         raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, "FCM isn't available") from None
+    return None
+
+
+@router.post('/fcm/send-bulk', response_model=SendPushBulkResultSchema)
+async def send_fcm_push_bulk(
+    auth: Annotated[None, Depends(authenticate_request)], data: SendPushBulkSchema
+) -> SendPushBulkResultSchema | Response:
+    """Send an FCM push notification to many users and tokens at once."""
+    if data.user_ids and redis_con is None:
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, 'No token storage was initialized')
+
+    if (send_at := get_send_at(data)) is not None:
+        return await schedule_bulk(Platform.FCM, data, send_at)
+
+    tokens_repo = services.get_tokens_repository(Platform.FCM) if redis_con is not None else None
+    send_to_tokens = partial(
+        services.send_fcm_to_tokens,
+        services.get_firebase(),
+        message=services.prepare_fcm(data),
+        throttle=services.throttle_devices(Platform.FCM, data),
+        on_error=services.retry_later(PushJobSchema(platform=Platform.FCM, guid=data.guid, status=data.status)),
+    )
+    # Recipients the push wasn't sent to are released by send_bulk
+    async with releasing_unsent(Platform.FCM, data):
+        return await services.send_bulk(Platform.FCM, tokens_repo, data, send_to_tokens)
 
 
 @router.post('/apns/add-token', status_code=status.HTTP_201_CREATED)
@@ -97,7 +233,7 @@ def add_apns_token(auth: Annotated[None, Depends(authenticate_request)], data: T
     if redis_con is None:
         raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, 'No token storage was initialized')
 
-    repo = RedisTokenRepository(redis_con, 'user:{user_id}:apns-tokens')
+    repo = services.get_tokens_repository(Platform.APNS)
     repo.add(data.user_id, data.token)
 
 
@@ -107,66 +243,56 @@ def delete_apns_token(auth: Annotated[None, Depends(authenticate_request)], data
     if redis_con is None:
         raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, 'No token storage was initialized')
 
-    repo = RedisTokenRepository(redis_con, 'user:{user_id}:apns-tokens')
+    repo = services.get_tokens_repository(Platform.APNS)
     repo.delete(data.user_id, data.token)
 
 
-@router.post('/apns/send-by-user-id', status_code=status.HTTP_204_NO_CONTENT)
-def send_apns_push_by_user_id(
+@router.post('/apns/send-by-user-id', status_code=status.HTTP_204_NO_CONTENT, response_model=None)
+async def send_apns_push_by_user_id(
     auth: Annotated[None, Depends(authenticate_request)], data: SendPushByUserIdSchema
-) -> None:
+) -> Response | None:
     """Send an APNS push notification by user_id."""
     if redis_con is None:
         raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, 'No token storage was initialized')
 
-    tokens_repo = RedisTokenRepository(redis_con, 'user:{user_id}:apns-tokens')
-    tokens = tokens_repo.get_all_by_user_id(data.user_id)
+    if not (await services.claim_sends(Platform.APNS, data, user_ids=[data.user_id]))[0]:
+        return None
 
-    cache_storage = RedisCacheRepository(redis_con) if redis_con is not None else LocalCacheRepository()
-    apns_creds = apns.TokenCredentials(
-        cache_storage, settings.APNS_AUTH_KEY, settings.APNS_AUTH_KEY_ID, settings.APNS_TEAM_ID
-    )
-    apns_client = apns.APNSClient(logger, apns_creds, use_sandbox=settings.APNS_USE_SANDBOX)
-
-    payload = apns.Payload(badge=1, custom={'guid': data.guid}, content_available=True)
-
-    err_occured = False
-    for token in tokens:
-        try:
-            apns_client.send_notification(token, payload, topic='com.archetype.wellifize.dev.voip', expiration=0)
-        except (apns.BadDeviceTokenError, apns.ExpiredTokenError):
-            tokens_repo.delete(data.user_id, token)
-        except apns.ExpiredProviderTokenError:
-            apns_creds.delete_access_token()
-            apns_client.send_notification(token, payload, topic='com.archetype.wellifize.dev.voip', expiration=0)
-        except (apns.UnregisteredError, apns.TooManyRequestsError):
-            pass
-        except apns.APNSServiceError:
-            err_occured = True
-
-    if err_occured:
-        msg = 'An APNS error occured. Some pushes were not sent'
-        raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, msg) from None
-
-
-@router.post('/apns/send-by-token', status_code=status.HTTP_204_NO_CONTENT)
-def send_apns_push_by_token(auth: Annotated[None, Depends(authenticate_request)], data: SendPushByTokenSchema) -> None:
-    """Send an APNS push notification by token."""
-    cache_storage = RedisCacheRepository(redis_con) if redis_con is not None else LocalCacheRepository()
-    apns_creds = apns.TokenCredentials(
-        cache_storage, settings.APNS_AUTH_KEY, settings.APNS_AUTH_KEY_ID, settings.APNS_TEAM_ID
-    )
-    apns_client = apns.APNSClient(logger, apns_creds, use_sandbox=settings.APNS_USE_SANDBOX)
+    async with releasing_unsent(Platform.APNS, data, user_ids=[data.user_id]):
+        job = PushJobSchema(
+            platform=Platform.APNS, user_id=data.user_id, guid=data.guid, status=data.status, send_at=data.send_at
+        )
+        if (response := await send_later(job)) is not None:
+            return response
+
+        outcomes = await services.deliver(job)
+        check_sent('APNS', outcomes)
 
-    payload = apns.Payload(badge=1, custom={'guid': data.guid}, content_available=True)
+    if SendOutcome.RETRYING in outcomes.values():
+        return Response(status_code=status.HTTP_202_ACCEPTED)
+    return None
+
+
+@router.post('/apns/send-by-token', status_code=status.HTTP_204_NO_CONTENT, response_model=None)
+async def send_apns_push_by_token(
+    auth: Annotated[None, Depends(authenticate_request)], data: SendPushByTokenSchema
+) -> Response | None:
+    """Send an APNS push notification by token."""
+    if not (await services.claim_sends(Platform.APNS, data, tokens=[data.token]))[1]:
+        return None
 
     try:
-        apns_client.send_notification(data.token, payload, topic='com.archetype.wellifize.dev.voip', expiration=0)
+        async with releasing_unsent(Platform.APNS, data, tokens=[data.token]):
+            job = PushJobSchema(
+                platform=Platform.APNS, token=data.token, guid=data.guid, status=data.status, send_at=data.send_at
+            )
+            if (response := await send_later(job)) is not None:
+                return response
+            await services.send_to_token(Platform.APNS, data.token, data)
+    except ThrottledError as err:
+        raise throttled(err) from None
     except apns.BadDeviceTokenError:
         raise HTTPException(status.HTTP_400_BAD_REQUEST, 'APNS error: BadDeviceToken') from None
-    except apns.ExpiredProviderTokenError:
-        apns_creds.delete_access_token()
-        apns_client.send_notification(data.token, payload, topic='com.archetype.wellifize.dev.voip', expiration=0)
     except apns.ExpiredTokenError:
         raise HTTPException(status.HTTP_410_GONE, 'APNS error: ExpiredToken') from None
     except apns.UnregisteredError:
@@ -177,3 +303,71 @@ def send_apns_push_by_token(auth: Annotated[None, Depends(authenticate_request)]
         raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, err.reason) from None
     except apns.APNSServiceError:
         raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, "APNS isn't available") from None
+    return None
+
+
+@router.post('/apns/send-bulk', response_model=SendPushBulkResultSchema)
+async def send_apns_push_bulk(
+    auth: Annotated[None, Depends(authenticate_request)], data: SendPushBulkSchema
+) -> SendPushBulkResultSchema | Response:
+    """Send an APNS push notification to many users and tokens at once."""
+    if data.user_ids and redis_con is None:
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, 'No token storage was initialized')
+
+    if (send_at := get_send_at(data)) is not None:
+        return await schedule_bulk(Platform.APNS, data, send_at)
+
+    tokens_repo = services.get_tokens_repository(Platform.APNS) if redis_con is not None else None
+    send_to_tokens = partial(
+        services.send_apns_to_tokens,
+        services.get_apns_client(),
+        notification=services.prepare_apns(data),
+        throttle=services.throttle_devices(Platform.APNS, data),
+        on_error=services.retry_later(PushJobSchema(platform=Platform.APNS, guid=data.guid, status=data.status)),
+    )
+    # Recipients the push wasn't sent to are released by send_bulk
+    async with releasing_unsent(Platform.APNS, data):
+        return await services.send_bulk(Platform.APNS, tokens_repo, data, send_to_tokens)
+
+
+@router.post('/send-by-user-id', response_model=SendPushByUserIdResultSchema)
+async def send_push_by_user_id(
+    auth: Annotated[None, Depends(authenticate_request)], data: SendPushByUserIdSchema
+) -> SendPushByUserIdResultSchema | Response:
+    """Send a push notification to the user's devices of all platforms."""
+    if redis_con is None:
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, 'No token storage was initialized')
+
+    claims = {platform: services.claim_sends(platform, data, user_ids=[data.user_id]) for platform in Platform}
+    claimed = await asyncio.gather(*claims.values())
+    platforms = [platform for platform, (user_ids, _) in zip(claims, claimed, strict=True) if user_ids]
+
+    async with AsyncExitStack() as stack:
+        for platform in platforms:
+            await stack.enter_async_context(releasing_unsent(platform, data, user_ids=[data.user_id]))
+
+        if (send_at := get_send_at(data)) is not None:
+            fields = data.model_dump(include={'user_id', 'guid', 'status', 'send_at'})
+            return await schedule([PushJobSchema(platform=platform, **fields) for platform in platforms], send_at)
+        if settings.DISPATCH_QUEUED:
+            for platform in platforms:
+                job = PushJobSchema(platform=platform, user_id=data.user_id, guid=data.guid, status=data.status)
+                await enqueue(job)
+            return Response(status_code=status.HTTP_202_ACCEPTED)
+
+        outcomes = await services.deliver_to_user(data, platforms) if platforms else {}
+
+    expired_tokens = {}
+    for platform, platform_outcomes in outcomes.items():
+        if expired := services.get_expired_tokens(platform_outcomes):
+            expired_tokens[platform] = expired
+        if SendOutcome.FAILED in platform_outcomes.values() or expired:
+            await services.release_sends(platform, data, user_ids=[data.user_id])
+
+    return SendPushByUserIdResultSchema(
+        platforms={
+            platform: SendOutcomeCountsSchema.model_validate(Counter(outcomes.get(platform, {}).values()))
+            for platform in Platform
+        },
+        expired_tokens=expired_tokens,
+    )
@@ -1,9 +1,33 @@
-from typing import Any
+from enum import StrEnum
+from typing import Any, Self
 
-from pydantic import BaseModel, model_validator
+from pydantic import AwareDatetime, BaseModel, Field, model_validator
 
 from .repositories import Token, UserId
 
+BULK_SEND_MAX_RECIPIENTS = 1000
+
+
+class Platform(StrEnum):
+    """Push notification services."""
+
+    APNS = 'apns'
+    FCM = 'fcm'
+
+
+class SendOutcome(StrEnum):
+    """Result of sending a push to a single device token."""
+
+    SENT = 'sent'
+    # The token is invalid and should be removed from the storage
+    INVALID = 'invalid'
+    SKIPPED = 'skipped'
+    # The push failed for a transient reason and is scheduled to be sent again
+    RETRYING = 'retrying'
+    FAILED = 'failed'
+    # The push ran out of its time budget before it was sent
+    EXPIRED = 'expired'
+
 
 class TokenRequestSchema(BaseModel):
     """Schema for token requests."""
@@ -17,6 +41,8 @@ class SendPushSchema(BaseModel):
 
     guid: str | None = None
     status: str | None = 'initializing'
+    # The push is kept until then and sent by the scheduler, a past time sends it now
+    send_at: AwareDatetime | None = None
 
     @model_validator(mode='before')
     @classmethod
@@ -44,3 +70,58 @@ class SendPushByUserIdSchema(SendPushSchema):
     """A schema for push sending by user_id."""
 
     user_id: UserId
+
+
+class PushJobSchema(SendPushSchema):
+    """A push queued for sending to a user or to a token."""
+
+    platform: Platform
+    user_id: UserId | None = None
+    token: Token | None = None
+    # Number of retries already made
+    attempt: int = 0
+    # The job is dropped if it's still unsent then, e.g. a ringing push after the call
+    expires_at: AwareDatetime | None = None
+
+
+class SendPushBulkSchema(SendPushSchema):
+    """A schema for push sending to many users and tokens at once."""
+
+    user_ids: list[UserId] = Field(default_factory=list, max_length=BULK_SEND_MAX_RECIPIENTS)
+    tokens: list[Token] = Field(default_factory=list, max_length=BULK_SEND_MAX_RECIPIENTS)
+
+    @model_validator(mode='after')
+    def check_recipients(self) -> Self:
+        """Require at least one recipient."""
+        if not self.user_ids and not self.tokens:
+            msg = 'Either user_ids or tokens must be specified'
+            raise ValueError(msg)
+        return self
+
+
+class SendOutcomeCountsSchema(BaseModel):
+    """Number of user's tokens per send outcome."""
+
+    sent: int = 0
+    invalid: int = 0
+    skipped: int = 0
+    retrying: int = 0
+    failed: int = 0
+    expired: int = 0
+
+
+class SendPushBulkResultSchema(BaseModel):
+    """Per-recipient results of a bulk send."""
+
+    users: dict[UserId, SendOutcomeCountsSchema]
+    tokens: dict[Token, SendOutcome]
+    # User's tokens the push ran out of its time budget for
+    expired_tokens: dict[UserId, list[Token]] = Field(default_factory=dict)
+
+
+class SendPushByUserIdResultSchema(BaseModel):
+    """Results of a send to the user's tokens of all platforms."""
+
+    platforms: dict[Platform, SendOutcomeCountsSchema]
+    # Tokens the push ran out of its time budget for
+    expired_tokens: dict[Platform, list[Token]] = Field(default_factory=dict)
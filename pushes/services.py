@@ -0,0 +1,772 @@
+import asyncio
+from collections import Counter
+from collections.abc import Awaitable, Callable, Iterable, Sequence
+from datetime import UTC, datetime, timedelta
+from functools import lru_cache, partial
+
+from redis.exceptions import RedisError
+
+from integrations import apns
+from integrations import firebase as fb
+from integrations.access_tokens import SingleFlightLock
+from integrations.cache import CacheRepository, LayeredCacheRepository, LocalCacheRepository, RedisCacheRepository
+from integrations.circuit_breaker import CircuitBreaker, RedisCircuitSync
+from integrations.http import apns_connections, fcm_connections
+from integrations.idempotency import IdempotencyKeys, LocalIdempotencyKeys, RedisIdempotencyKeys
+from integrations.metrics import current_route, pushes, stage_seconds, superseded_pushes
+from integrations.rate_limits import LocalRateLimiter, RateLimiter, RedisRateLimiter
+from integrations.redis import connection as redis_con
+from project_base.config import get_settings
+from project_base.loggers import logger
+
+from .coalescing import Debouncer
+from .deadlines import DeadlineExceededError, deadline_budget, within_deadline
+from .delayed import DelayedJobScheduler, DelayedQueue
+from .dispatch import DispatchQueue
+from .pruning import StaleTokenPruner
+from .repositories import (
+    APNS_OWNERS_KEY,
+    APNS_TOKEN_METADATA_KEYS,
+    APNS_TOKENS_KEY_PATTERN,
+    FCM_OWNERS_KEY,
+    FCM_TOKEN_METADATA_KEYS,
+    FCM_TOKENS_KEY_PATTERN,
+    MirroredTokenRepository,
+    RedisTokenMetadataRepository,
+    RedisTokenRepository,
+    Token,
+    TokenRepository,
+    UserId,
+)
+from .retries import get_retry_policy
+from .schemas import (
+    Platform,
+    PushJobSchema,
+    SendOutcome,
+    SendOutcomeCountsSchema,
+    SendPushBulkResultSchema,
+    SendPushBulkSchema,
+    SendPushByUserIdSchema,
+    SendPushSchema,
+)
+from .throttling import DeviceThrottle, ThrottledError
+
+settings = get_settings()
+
+APNS_TOPIC = 'com.archetype.wellifize.dev.voip'
+# VoIP pushes must be delivered immediately
+APNS_PRIORITY = 10
+
+# Called with a token and a transient error, returns whether the push will be retried
+ErrorHandler = Callable[[Token, Exception], Awaitable[bool]]
+# Called with a token before sending to it, returns whether to send the push
+Throttle = Callable[[Token], Awaitable[bool]]
+
+# Outcomes of pushes that weren't sent and may be requested again
+_UNSENT_OUTCOMES = frozenset({SendOutcome.FAILED, SendOutcome.EXPIRED})
+
+
+class StorageUnavailableError(Exception):
+    """No Redis storage was initialized."""
+
+
+@lru_cache
+def get_cache_storage() -> CacheRepository:
+    """Return the storage for provider access tokens.
+
+    With Redis, tokens are shared by all workers and kept in a near cache of each one.
+    """
+    if redis_con is None:
+        return LocalCacheRepository()
+
+    local_ttl = timedelta(seconds=settings.NEAR_CACHE_TTL_SECS)
+    return LayeredCacheRepository(LocalCacheRepository(), RedisCacheRepository(redis_con), local_ttl=local_ttl)
+
+
+@lru_cache
+def get_apns_client() -> apns.AsyncAPNSClient:
+    """Return an APNS client configured from the settings."""
+    apns_creds = apns.TokenCredentials(
+        get_cache_storage(),
+        settings.APNS_AUTH_KEY,
+        settings.APNS_AUTH_KEY_ID,
+        settings.APNS_TEAM_ID,
+        lock=SingleFlightLock(apns.TokenCredentials.ACCESS_TOKEN_CACHE_KEY, redis_con),
+    )
+    return apns.AsyncAPNSClient(
+        logger,
+        apns_creds,
+        connections=apns_connections,
+        use_sandbox=settings.APNS_USE_SANDBOX,
+        breaker=get_circuit_breaker(Platform.APNS),
+    )
+
+
+@lru_cache
+def get_firebase() -> fb.AsyncFireBase:
+    """Return a FireBase client configured from the settings."""
+    lock = SingleFlightLock(fb.AsyncFireBase.ACCESS_TOKEN_KEY, redis_con)
+    breaker = get_circuit_breaker(Platform.FCM)
+    return fb.AsyncFireBase(get_cache_storage(), logger, connections=fcm_connections, lock=lock, breaker=breaker)
+
+
+@lru_cache
+def get_circuit_breaker(platform: Platform) -> CircuitBreaker | None:
+    """Return the circuit breaker of the provider, None if it's disabled."""
+    if not settings.CIRCUIT_BREAKER_ENABLED:
+        return None
+
+    return CircuitBreaker(
+        platform,
+        logger,
+        window=timedelta(seconds=settings.CIRCUIT_BREAKER_WINDOW_SECS),
+        min_calls=settings.CIRCUIT_BREAKER_MIN_CALLS,
+        failure_rate=settings.CIRCUIT_BREAKER_FAILURE_RATE,
+        open_for=timedelta(seconds=settings.CIRCUIT_BREAKER_OPEN_SECS),
+        probes=settings.CIRCUIT_BREAKER_PROBES,
+    )
+
+
+def get_tokens_repository(platform: Platform) -> TokenRepository:
+    """Return the storage of device tokens of the platform."""
+    if redis_con is None:
+        raise StorageUnavailableError
+
+    if settings.TOKEN_METADATA_ENABLED:
+        return get_token_metadata_repository(platform)
+    if platform == Platform.APNS:
+        repo = RedisTokenRepository(redis_con, APNS_TOKENS_KEY_PATTERN, APNS_OWNERS_KEY)
+    else:
+        repo = RedisTokenRepository(redis_con, FCM_TOKENS_KEY_PATTERN, FCM_OWNERS_KEY)
+    if settings.TOKEN_METADATA_MIGRATING:
+        return MirroredTokenRepository(repo, get_token_metadata_repository(platform))
+    return repo
+
+
+@lru_cache
+def get_token_metadata_repository(platform: Platform) -> RedisTokenMetadataRepository:
+    """Return the storage of device tokens of the platform with their metadata."""
+    if redis_con is None:
+        raise StorageUnavailableError
+
+    if platform == Platform.APNS:
+        environment = 'sandbox' if settings.APNS_USE_SANDBOX else 'production'
+        return RedisTokenMetadataRepository(redis_con, *APNS_TOKEN_METADATA_KEYS, environment=environment)
+    return RedisTokenMetadataRepository(redis_con, *FCM_TOKEN_METADATA_KEYS)
+
+
+@lru_cache
+def get_dispatch_queue() -> DispatchQueue:
+    """Return the queue of pushes sent by workers."""
+    if redis_con is None:
+        raise StorageUnavailableError
+
+    return DispatchQueue(redis_con, settings.DISPATCH_STREAM, max_len=settings.DISPATCH_STREAM_MAX_LEN)
+
+
+@lru_cache
+def get_retry_queue() -> DelayedQueue:
+    """Return the queue of pushes waiting for a retry."""
+    if redis_con is None:
+        raise StorageUnavailableError
+
+    return DelayedQueue(redis_con, settings.RETRY_QUEUE_KEY)
+
+
+@lru_cache
+def get_scheduled_queue() -> DelayedQueue:
+    """Return the queue of pushes requested for a later time."""
+    if redis_con is None:
+        raise StorageUnavailableError
+
+    return DelayedQueue(redis_con, settings.SCHEDULED_QUEUE_KEY)
+
+
+@lru_cache
+def get_sent_pushes() -> IdempotencyKeys:
+    """Return the keys of recently sent pushes, shared by all instances with Redis."""
+    ttl = timedelta(seconds=settings.IDEMPOTENCY_TTL_SECS)
+    if redis_con is None:
+        return LocalIdempotencyKeys(ttl)
+    return RedisIdempotencyKeys(redis_con, 'pushes:sent', ttl)
+
+
+@lru_cache
+def get_debouncer() -> Debouncer:
+    """Return the coalescing of call status updates, shared by instances with Redis."""
+    return Debouncer(timedelta(seconds=settings.COALESCE_WINDOW_SECS), redis_con, key_prefix='pushes:coalesce')
+
+
+@lru_cache
+def get_device_throttle(platform: Platform) -> DeviceThrottle:
+    """Return the per device rate limiting of pushes of the platform."""
+    rate, burst = settings.DEVICE_RATE_LIMIT_PER_SEC, settings.DEVICE_RATE_LIMIT_BURST
+    limiter: RateLimiter = LocalRateLimiter(rate, burst)
+    if redis_con is not None:
+        limiter = RedisRateLimiter(redis_con, f'rate-limit:{platform}', rate, burst)
+    return DeviceThrottle(limiter, max_delay=timedelta(seconds=settings.DEVICE_RATE_LIMIT_MAX_DELAY_SECS))
+
+
+def throttle_devices(platform: Platform, data: SendPushSchema) -> Throttle | None:
+    """Return the throttle of pushes about the call, None if it's disabled."""
+    if not settings.DEVICE_RATE_LIMIT_ENABLED:
+        return None
+    return partial(get_device_throttle(platform).wait, group=data.guid or '')
+
+
+async def wait_for_device(platform: Platform, token: Token, throttle: Throttle | None) -> bool:
+    """Wait for a free slot of the device, return False if the push was superseded.
+
+    Raise ThrottledError or DeadlineExceededError like DeviceThrottle.wait.
+    """
+    if throttle is None or await throttle(token):
+        return True
+    superseded_pushes.labels(platform, 'throttling').inc()
+    return False
+
+
+async def warm_up() -> None:
+    """Get provider tokens and connect to the providers ahead of the first push."""
+    apns_client, firebase_service = get_apns_client(), get_firebase()
+    results = await asyncio.gather(
+        asyncio.to_thread(apns_client.credentials.get_token),
+        asyncio.to_thread(firebase_service.access_token.get),
+        apns_connections.get(apns_client.server).connect(),
+        fcm_connections.get(firebase_service.FCM_SERVER).connect(),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error('Warm-up error', exc_info=result)
+
+
+def build_retry_scheduler() -> DelayedJobScheduler:
+    """Return the scheduler sending pushes whose retry is due."""
+    return DelayedJobScheduler(
+        get_retry_queue(),
+        logger,
+        deliver_queued,
+        batch_size=settings.RETRY_BATCH_SIZE,
+        poll_interval=timedelta(seconds=settings.RETRY_POLL_INTERVAL_SECS),
+        lease=timedelta(seconds=settings.DELAYED_LEASE_SECS),
+    )
+
+
+def build_push_scheduler() -> DelayedJobScheduler:
+    """Return the scheduler sending pushes requested for a time that is due."""
+    return DelayedJobScheduler(
+        get_scheduled_queue(),
+        logger,
+        deliver_queued,
+        batch_size=settings.SCHEDULED_BATCH_SIZE,
+        poll_interval=timedelta(seconds=settings.SCHEDULED_POLL_INTERVAL_SECS),
+        lease=timedelta(seconds=settings.DELAYED_LEASE_SECS),
+        max_rate=settings.SCHEDULED_PUSHES_PER_SEC,
+    )
+
+
+def build_circuit_sync() -> RedisCircuitSync:
+    """Return the loop sharing open provider circuits with other instances."""
+    if redis_con is None:
+        raise StorageUnavailableError
+
+    breakers = [breaker for platform in Platform if (breaker := get_circuit_breaker(platform)) is not None]
+    interval = timedelta(seconds=settings.CIRCUIT_BREAKER_SYNC_INTERVAL_SECS)
+    return RedisCircuitSync(redis_con, 'circuit', breakers, logger, interval=interval)
+
+
+def build_token_pruner() -> StaleTokenPruner:
+    """Return the loop deleting tokens of devices gone for good."""
+    return StaleTokenPruner(
+        [get_token_metadata_repository(platform) for platform in Platform],
+        logger,
+        max_age=timedelta(days=settings.TOKEN_STALE_AFTER_DAYS),
+        batch_size=settings.TOKEN_PRUNE_BATCH_SIZE,
+        interval=timedelta(seconds=settings.TOKEN_PRUNE_INTERVAL_SECS),
+    )
+
+
+def build_apns_payload(data: SendPushSchema) -> apns.Payload:
+    """Return the APNS payload for a call push."""
+    return apns.Payload(badge=1, custom={'guid': data.guid}, content_available=True)
+
+
+def build_fcm_data(data: SendPushSchema) -> dict[str, str | None]:
+    """Return the FCM data for a call push."""
+    return {'guid': data.guid, 'call_status': data.status, 'click_action': 'FLUTTER_NOTIFICATION_CLICK'}
+
+
+def prepare_apns(data: SendPushSchema) -> apns.PreparedNotification:
+    """Return the APNS call push ready to be sent to devices."""
+    return get_apns_client().prepare(
+        build_apns_payload(data), topic=APNS_TOPIC, expiration=0, priority=APNS_PRIORITY, collapse_id=data.guid
+    )
+
+
+def prepare_fcm(data: SendPushSchema) -> fb.PreparedMessage:
+    """Return the FCM call push ready to be sent to devices."""
+    return get_firebase().prepare_message(title=None, message=None, extra_data=build_fcm_data(data))
+
+
+async def send_apns(client: apns.AsyncAPNSClient, token: Token, notification: apns.PreparedNotification) -> None:
+    """Send an APNS push, retrying once with a fresh provider token.
+
+    Raise DeadlineExceededError if the push ran out of its time budget.
+    """
+    async with within_deadline():
+        try:
+            await client.send_prepared(token, notification)
+        except apns.ExpiredProviderTokenError:
+            await asyncio.to_thread(client.delete_access_token)
+            await client.send_prepared(token, notification)
+
+
+async def send_fcm(firebase_service: fb.AsyncFireBase, token: Token, message: fb.PreparedMessage) -> None:
+    """Send an FCM push, retrying once with a fresh access token.
+
+    Raise DeadlineExceededError if the push ran out of its time budget.
+    """
+    async with within_deadline():
+        try:
+            await firebase_service.send_prepared(token, message)
+        except fb.FireBaseTokenError:
+            await asyncio.to_thread(firebase_service.delete_access_token)
+            await firebase_service.send_prepared(token, message)
+
+
+async def send_apns_to_tokens(
+    client: apns.AsyncAPNSClient,
+    tokens: Iterable[Token],
+    notification: apns.PreparedNotification,
+    *,
+    on_error: ErrorHandler | None = None,
+    throttle: Throttle | None = None,
+) -> dict[Token, SendOutcome]:
+    """Send an APNS push to all tokens concurrently."""
+
+    async def send(token: Token) -> SendOutcome:  # noqa: PLR0911
+        try:
+            if not await wait_for_device(Platform.APNS, token, throttle):
+                return SendOutcome.SKIPPED
+            await send_apns(client, token, notification)
+        except DeadlineExceededError:
+            return SendOutcome.EXPIRED
+        except (apns.BadDeviceTokenError, apns.ExpiredTokenError):
+            return SendOutcome.INVALID
+        except apns.UnregisteredError:
+            return SendOutcome.SKIPPED
+        except (apns.TooManyRequestsError, ThrottledError) as err:
+            return await _handle_error(token, err, on_error, SendOutcome.SKIPPED)
+        except apns.APNSServiceError as err:
+            return await _handle_error(token, err, on_error, SendOutcome.FAILED)
+        return SendOutcome.SENT
+
+    outcomes = await _gather_bounded(send, tokens)
+    _count_pushes(Platform.APNS, outcomes)
+    return outcomes
+
+
+async def send_fcm_to_tokens(
+    firebase_service: fb.AsyncFireBase,
+    tokens: Iterable[Token],
+    message: fb.PreparedMessage,
+    *,
+    on_error: ErrorHandler | None = None,
+    throttle: Throttle | None = None,
+) -> dict[Token, SendOutcome]:
+    """Send an FCM push to all tokens concurrently."""
+
+    async def send(token: Token) -> SendOutcome:
+        try:
+            if not await wait_for_device(Platform.FCM, token, throttle):
+                return SendOutcome.SKIPPED
+            await send_fcm(firebase_service, token, message)
+        except DeadlineExceededError:
+            return SendOutcome.EXPIRED
+        except (fb.FireBaseInvalidRequestError, fb.FireBaseFCMTokenNotFoundError):
+            return SendOutcome.INVALID
+        except ThrottledError as err:
+            return await _handle_error(token, err, on_error, SendOutcome.SKIPPED)
+        except (fb.FireBaseServiceError, fb.FireBaseTokenError) as err:
+            return await _handle_error(token, err, on_error, SendOutcome.FAILED)
+        return SendOutcome.SENT
+
+    outcomes = await _gather_bounded(send, tokens)
+    _count_pushes(Platform.FCM, outcomes)
+    return outcomes
+
+
+async def send_to_tokens(
+    platform: Platform, tokens: Iterable[Token], data: SendPushSchema, *, on_error: ErrorHandler | None = None
+) -> dict[Token, SendOutcome]:
+    """Send a push to all tokens of the platform concurrently."""
+    throttle = throttle_devices(platform, data)
+    if platform == Platform.APNS:
+        return await send_apns_to_tokens(
+            get_apns_client(), tokens, prepare_apns(data), on_error=on_error, throttle=throttle
+        )
+    return await send_fcm_to_tokens(get_firebase(), tokens, prepare_fcm(data), on_error=on_error, throttle=throttle)
+
+
+async def send_to_token(platform: Platform, token: Token, data: SendPushSchema) -> bool:
+    """Send a push to a token of the platform, return False if it was superseded.
+
+    Provider errors are raised, as well as ThrottledError and DeadlineExceededError.
+    """
+    if not await wait_for_device(platform, token, throttle_devices(platform, data)):
+        return False
+    if platform == Platform.APNS:
+        await send_apns(get_apns_client(), token, prepare_apns(data))
+    else:
+        await send_fcm(get_firebase(), token, prepare_fcm(data))
+    return True
+
+
+async def deliver(job: PushJobSchema) -> dict[Token, SendOutcome]:
+    """Send a push to the job's token or to all tokens of its user.
+
+    Invalid tokens of the user are deleted, transient failures are retried later. Raise
+    DeadlineExceededError if the push ran out of its time budget looking up the tokens.
+    """
+    tokens: set[Token] = set()
+    if job.token is not None:
+        tokens = {job.token}
+    elif job.user_id is not None:
+        repo = get_tokens_repository(job.platform)
+        with stage_seconds.labels(job.platform, 'token_lookup').time():
+            async with within_deadline():
+                tokens = await asyncio.to_thread(repo.get_all_by_user_id, job.user_id)
+
+    return await _deliver_to_tokens(job, tokens)
+
+
+async def deliver_queued(job: PushJobSchema) -> dict[Token, SendOutcome]:
+    """Send a queued push or a retry with the time budget of a push request.
+
+    Jobs past their expiry or about a call whose status has changed since are dropped.
+    """
+    budget = timedelta(seconds=settings.PUSH_DEADLINE_SECS)
+    if job.expires_at is not None:
+        left = job.expires_at - datetime.now(UTC)
+        if left <= timedelta(0):
+            return _drop(job, SendOutcome.EXPIRED)
+        budget = min(budget, left) if budget else left
+    if await _outdated(job):
+        superseded_pushes.labels(job.platform, 'outdated').inc()
+        return _drop(job, SendOutcome.SKIPPED)
+
+    with deadline_budget(budget):
+        return await deliver(job)
+
+
+def with_expiry(job: PushJobSchema) -> PushJobSchema:
+    """Return the job expiring the max age of its status after it's due.
+
+    Jobs already having an expiry, e.g. retries, keep it.
+    """
+    if job.expires_at is not None:
+        return job
+    due_at = job.send_at or datetime.now(UTC)
+    return job.model_copy(update={'expires_at': due_at + _get_max_age(job.status)})
+
+
+async def deliver_to_user(
+    data: SendPushByUserIdSchema, platforms: Iterable[Platform] = tuple(Platform)
+) -> dict[Platform, dict[Token, SendOutcome]]:
+    """Send a push to the user's tokens of the platforms concurrently.
+
+    Tokens of all platforms are fetched in a single round trip. Raise
+    DeadlineExceededError if the push ran out of its time budget looking them up.
+    """
+    with stage_seconds.labels('all', 'token_lookup').time():
+        async with within_deadline():
+            tokens_by_platform = await asyncio.to_thread(get_user_tokens, data.user_id)
+
+    jobs = [
+        PushJobSchema(platform=platform, user_id=data.user_id, guid=data.guid, status=data.status)
+        for platform in platforms
+    ]
+    outcomes = await asyncio.gather(*(_deliver_to_tokens(job, tokens_by_platform[job.platform]) for job in jobs))
+    return {job.platform: job_outcomes for job, job_outcomes in zip(jobs, outcomes, strict=True)}
+
+
+def get_user_tokens(user_id: UserId) -> dict[Platform, set[Token]]:
+    """Get user tokens of all platforms in a single round trip."""
+    if redis_con is None:
+        raise StorageUnavailableError
+
+    platforms = (Platform.APNS, Platform.FCM)
+    pipe = redis_con.pipeline(transaction=False)
+    for platform in platforms:
+        get_tokens_repository(platform).queue_get_all_by_user_id(pipe, user_id)
+    return {platform: set(tokens) for platform, tokens in zip(platforms, pipe.execute(), strict=True)}
+
+
+def retry_later(job: PushJobSchema) -> ErrorHandler:
+    """Return an error handler scheduling a retry of the job for the failed token."""
+
+    async def schedule_retry(token: Token, err: Exception) -> bool:
+        policy = get_retry_policy(err)
+        if redis_con is None or policy is None:
+            return False
+
+        delay = policy.get_delay(job.attempt, getattr(err, 'retry_after', None))
+        if delay is None:
+            return False
+
+        retry_job = with_expiry(job).model_copy(update={'token': token, 'attempt': job.attempt + 1})
+        retry_at = datetime.now(UTC) + delay
+        if retry_job.expires_at is not None and retry_at >= retry_job.expires_at:
+            return False
+        try:
+            await asyncio.to_thread(get_retry_queue().add, retry_job, retry_at)
+        except RedisError:
+            logger.exception('Push retry scheduling error')
+            return False
+        return True
+
+    return schedule_retry
+
+
+def get_expired_tokens(outcomes: dict[Token, SendOutcome]) -> list[Token]:
+    """Return tokens the push ran out of its time budget for."""
+    return [token for token, outcome in outcomes.items() if outcome == SendOutcome.EXPIRED]
+
+
+async def update_tokens(
+    platform: Platform, tokens_repo: TokenRepository, outcomes_by_user: dict[UserId, dict[Token, SendOutcome]]
+) -> None:
+    """Delete tokens reported as invalid and record outcomes of the rest."""
+    invalid_tokens_by_user, results_by_user = {}, {}
+    for user_id, outcomes in outcomes_by_user.items():
+        if invalid_tokens := _invalid_tokens(outcomes):
+            invalid_tokens_by_user[user_id] = invalid_tokens
+        results_by_user[user_id] = {
+            token: outcome == SendOutcome.SENT
+            for token, outcome in outcomes.items()
+            if outcome in (SendOutcome.SENT, SendOutcome.FAILED)
+        }
+
+    with stage_seconds.labels(platform, 'cleanup').time():
+        if invalid_tokens_by_user:
+            await asyncio.to_thread(tokens_repo.unregister_many, invalid_tokens_by_user)
+        if any(results_by_user.values()):
+            await asyncio.to_thread(tokens_repo.record_outcomes, results_by_user)
+
+
+async def send_bulk(
+    platform: Platform,
+    tokens_repo: TokenRepository | None,
+    data: SendPushBulkSchema,
+    send_to_tokens: Callable[[Iterable[Token]], Awaitable[dict[Token, SendOutcome]]],
+) -> SendPushBulkResultSchema:
+    """Send a push to all tokens of the given users and to the explicit tokens at once.
+
+    Tokens of all users are fetched in one round trip and every token is sent to only
+    once, even if it's shared by several recipients. Recipients that got the push
+    recently are skipped, those it wasn't sent to are released, all of them if sending
+    fails, e.g. by running out of its deadline.
+    """
+    user_ids, tokens = await claim_sends(platform, data, user_ids=data.user_ids, tokens=data.tokens)
+
+    tokens_by_user: dict[UserId, set[Token]] = {}
+    try:
+        if tokens_repo is not None and user_ids:
+            with stage_seconds.labels(platform, 'token_lookup').time():
+                async with within_deadline():
+                    tokens_by_user = await asyncio.to_thread(tokens_repo.get_all_by_user_ids, user_ids)
+
+        outcomes = await send_to_tokens(set(tokens).union(*tokens_by_user.values()))
+
+        outcomes_by_user = {
+            user_id: {token: outcomes[token] for token in user_tokens}
+            for user_id, user_tokens in tokens_by_user.items()
+        }
+        if tokens_repo is not None and outcomes_by_user:
+            await update_tokens(platform, tokens_repo, outcomes_by_user)
+    except BaseException:
+        await release_sends(platform, data, user_ids=user_ids, tokens=tokens)
+        raise
+
+    users = {user_id: SendOutcomeCountsSchema() for user_id in data.user_ids}
+    for user_id, user_outcomes in outcomes_by_user.items():
+        users[user_id] = SendOutcomeCountsSchema.model_validate(Counter(user_outcomes.values()))
+    token_outcomes = {token: outcomes.get(token, SendOutcome.SKIPPED) for token in data.tokens}
+
+    await release_sends(
+        platform,
+        data,
+        user_ids=[user_id for user_id, counts in users.items() if counts.failed or counts.expired],
+        tokens=[token for token, outcome in token_outcomes.items() if outcome in _UNSENT_OUTCOMES],
+    )
+    expired_tokens = {
+        user_id: expired
+        for user_id, user_outcomes in outcomes_by_user.items()
+        if (expired := get_expired_tokens(user_outcomes))
+    }
+    return SendPushBulkResultSchema(users=users, tokens=token_outcomes, expired_tokens=expired_tokens)
+
+
+async def claim_sends(
+    platform: Platform, data: SendPushSchema, *, user_ids: Sequence[UserId] = (), tokens: Sequence[Token] = ()
+) -> tuple[list[UserId], list[Token]]:
+    """Mark the push as sent to the recipients, return those it wasn't sent to recently.
+
+    Pushes are told apart by the call guid and status, pushes without a guid are never
+    duplicates. Recipients are let through if Redis fails, a duplicate push is better
+    than a missed call. The status becomes the latest one of the call for those.
+    """
+    if settings.IDEMPOTENCY_ENABLED and data.guid is not None:
+        try:
+            claimed = await asyncio.to_thread(
+                get_sent_pushes().claim_many, _send_keys(platform, data, user_ids, tokens)
+            )
+        except RedisError:
+            logger.exception('Sent pushes lookup error')
+        else:
+            claimed_users, claimed_tokens = claimed[: len(user_ids)], claimed[len(user_ids) :]
+            user_ids = [user_id for user_id, is_new in zip(user_ids, claimed_users, strict=True) if is_new]
+            tokens = [token for token, is_new in zip(tokens, claimed_tokens, strict=True) if is_new]
+
+    await _note_status(platform, data, user_ids, tokens)
+    return list(user_ids), list(tokens)
+
+
+async def release_sends(
+    platform: Platform, data: SendPushSchema, *, user_ids: Sequence[UserId] = (), tokens: Sequence[Token] = ()
+) -> None:
+    """Forget sending the push to the recipients, so that a retried request sends it."""
+    if not settings.IDEMPOTENCY_ENABLED or data.guid is None or not (user_ids or tokens):
+        return
+
+    try:
+        await asyncio.to_thread(get_sent_pushes().release_many, _send_keys(platform, data, user_ids, tokens))
+    except RedisError:
+        logger.exception('Sent pushes release error')
+
+
+async def _handle_error(
+    token: Token, err: Exception, on_error: ErrorHandler | None, fallback: SendOutcome
+) -> SendOutcome:
+    """Pass a transient error to the handler, return fallback if it won't be retried."""
+    if on_error is not None and await on_error(token, err):
+        return SendOutcome.RETRYING
+    return fallback
+
+
+async def _deliver_to_tokens(job: PushJobSchema, tokens: set[Token]) -> dict[Token, SendOutcome]:
+    """Send the job's push to the tokens and clean up tokens of its user.
+
+    Pushes to all tokens of the user are dropped if a newer status of the call comes
+    within COALESCE_WINDOW_SECS.
+    """
+    if tokens and await _superseded(job):
+        superseded_pushes.labels(job.platform, 'coalescing').inc(len(tokens))
+        outcomes = dict.fromkeys(tokens, SendOutcome.SKIPPED)
+        _count_pushes(job.platform, outcomes)
+        return outcomes
+
+    outcomes = await send_to_tokens(job.platform, tokens, job, on_error=retry_later(job))
+
+    if job.user_id is not None:
+        await update_tokens(job.platform, get_tokens_repository(job.platform), {job.user_id: outcomes})
+    return outcomes
+
+
+async def _superseded(job: PushJobSchema) -> bool:
+    """Hold back a push to all tokens of a user, return whether a newer one came."""
+    if not settings.COALESCE_WINDOW_SECS or job.token is not None or job.user_id is None or not job.guid:
+        return False
+    try:
+        return not await get_debouncer().settle(f'{job.platform}:{job.user_id}:{job.guid}')
+    except RedisError:
+        logger.exception('Push coalescing error')
+        return False
+
+
+async def _note_status(
+    platform: Platform, data: SendPushSchema, user_ids: Sequence[UserId], tokens: Sequence[Token]
+) -> None:
+    """Remember the status as the latest one of the call for the recipients."""
+    if redis_con is None or data.guid is None or not (user_ids or tokens):
+        return
+
+    max_age = max([settings.PUSH_MAX_AGE_SECS, *settings.PUSH_MAX_AGE_SECS_BY_STATUS.values()])
+    # Kept until queued pushes of the call expire, those scheduled for later included
+    ttl = timedelta(seconds=max_age) + max((data.send_at or datetime.now(UTC)) - datetime.now(UTC), timedelta(0))
+    pipe = redis_con.pipeline(transaction=False)
+    for key in _status_keys(platform, data.guid, _recipients(user_ids, tokens)):
+        pipe.set(key, data.status or '', px=ttl)
+    try:
+        await asyncio.to_thread(pipe.execute)
+    except RedisError:
+        logger.exception('Push status saving error')
+
+
+async def _outdated(job: PushJobSchema) -> bool:
+    """Return whether a newer status of the call was requested for the recipient."""
+    if redis_con is None or job.guid is None:
+        return False
+
+    recipients = _recipients([job.user_id] if job.user_id else [], [job.token] if job.token else [])
+    try:
+        statuses = await asyncio.to_thread(redis_con.mget, _status_keys(job.platform, job.guid, recipients))
+    except RedisError:
+        logger.exception('Push status lookup error')
+        return False
+    return any(status is not None and status != (job.status or '') for status in statuses)  # type: ignore[union-attr]
+
+
+def _drop(job: PushJobSchema, outcome: SendOutcome) -> dict[Token, SendOutcome]:
+    """Return the outcome of a job that won't be sent."""
+    outcomes = {} if job.token is None else {job.token: outcome}
+    _count_pushes(job.platform, outcomes)
+    return outcomes
+
+
+def _get_max_age(status: str | None) -> timedelta:
+    """Return how long after they are due pushes with the status are still sent."""
+    return timedelta(seconds=settings.PUSH_MAX_AGE_SECS_BY_STATUS.get(status or '', settings.PUSH_MAX_AGE_SECS))
+
+
+def _count_pushes(platform: Platform, outcomes: dict[Token, SendOutcome]) -> None:
+    """Count pushes by outcome for the metrics."""
+    for outcome, count in Counter(outcomes.values()).items():
+        pushes.labels(platform, current_route.get(), outcome).inc(count)
+
+
+async def _gather_bounded(
+    send: Callable[[Token], Awaitable[SendOutcome]], tokens: Iterable[Token]
+) -> dict[Token, SendOutcome]:
+    """Run sends concurrently with at most PUSH_SEND_CONCURRENCY in flight."""
+    semaphore = asyncio.Semaphore(settings.PUSH_SEND_CONCURRENCY)
+
+    async def send_bounded(token: Token) -> SendOutcome:
+        async with semaphore:
+            return await send(token)
+
+    tokens = list(tokens)
+    outcomes = await asyncio.gather(*(send_bounded(token) for token in tokens))
+    return dict(zip(tokens, outcomes, strict=True))
+
+
+def _send_keys(
+    platform: Platform, data: SendPushSchema, user_ids: Sequence[UserId], tokens: Sequence[Token]
+) -> list[str]:
+    """Return idempotency keys of the push to each recipient, users first."""
+    return [f'{platform}:{recipient}:{data.guid}:{data.status}' for recipient in _recipients(user_ids, tokens)]
+
+
+def _status_keys(platform: Platform, guid: str, recipients: Iterable[str]) -> list[str]:
+    """Return keys of the latest status of the call for each recipient."""
+    return [f'pushes:status:{platform}:{recipient}:{guid}' for recipient in recipients]
+
+
+def _recipients(user_ids: Sequence[UserId], tokens: Sequence[Token]) -> list[str]:
+    """Return names of the recipients telling users and tokens apart, users first."""
+    return [f'user:{user_id}' for user_id in user_ids] + [f'token:{token}' for token in tokens]
+
+
+def _invalid_tokens(outcomes: dict[Token, SendOutcome]) -> list[Token]:
+    """Return tokens the provider reported as invalid."""
+    return [token for token, outcome in outcomes.items() if outcome == SendOutcome.INVALID]
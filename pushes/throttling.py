@@ -0,0 +1,67 @@
+import asyncio
+import itertools
+from datetime import timedelta
+
+from integrations.rate_limits import RateLimiter
+
+from .deadlines import DeadlineExceededError, get_remaining
+
+
+class ThrottledError(Exception):
+    """The device is over its rate limit for longer than a push may wait."""
+
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(f'Throttled for {retry_after:.1f}s')
+        # Seconds until the device has a free slot
+        self.retry_after = retry_after
+
+
+class DeviceThrottle:
+    """Holds back pushes to devices over their rate limit.
+
+    A push waiting for its slot is dropped once a newer push with the same group (a
+    call status update superseding the previous one) is made to the same device.
+    """
+
+    def __init__(self, limiter: RateLimiter, *, max_delay: timedelta) -> None:
+        self._limiter = limiter
+        self._max_delay = max_delay
+        # (token, group) -> sequence number of the latest push
+        self._latest: dict[tuple[str, str], int] = {}
+        self._sequence = itertools.count()
+
+    async def wait(self, token: str, group: str) -> bool:
+        """Wait for a free slot of the device, return False if the push was superseded.
+
+        Raise ThrottledError if the slot is further away than max_delay and
+        DeadlineExceededError if it comes after the deadline of the push. The slot is
+        only kept by pushes that are going to be sent.
+        """
+        max_delay = self._max_delay.total_seconds()
+        remaining = get_remaining()
+        limit = max_delay if remaining is None else min(max_delay, remaining)
+        key, number = (token, group), next(self._sequence)
+        self._latest[key] = number
+        try:
+            delay = await asyncio.to_thread(self._limiter.reserve, token, limit)
+            if delay > max_delay:
+                raise ThrottledError(delay)
+            if delay > limit:
+                raise DeadlineExceededError
+            try:
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                await asyncio.to_thread(self._limiter.release, token)
+                raise
+            if self._latest.get(key) != number:
+                await asyncio.to_thread(self._limiter.release, token)
+                return False
+            return True
+        finally:
+            self._forget(key, number)
+
+    def _forget(self, key: tuple[str, str], number: int) -> None:
+        """Stop tracking the push unless a newer one took its place."""
+        if self._latest.get(key) == number:
+            del self._latest[key]
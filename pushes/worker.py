@@ -0,0 +1,53 @@
+import asyncio
+import os
+import socket
+from datetime import timedelta
+
+from redis import asyncio as aioredis
+
+from integrations.http import connections as http_connections
+from project_base.config import get_settings
+from project_base.loggers import logger
+
+from . import services
+from .dispatch import DispatchWorker
+
+settings = get_settings()
+
+
+async def main() -> None:
+    """Send queued, retried and scheduled pushes, prune stale tokens."""
+    if settings.REDIS_URL is None:
+        msg = 'REDIS_URL is required to run the dispatch worker'
+        raise RuntimeError(msg)
+
+    connection = aioredis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+    worker = DispatchWorker(
+        connection,
+        logger,
+        services.deliver_queued,
+        stream=settings.DISPATCH_STREAM,
+        group=settings.DISPATCH_CONSUMER_GROUP,
+        consumer=f'{socket.gethostname()}-{os.getpid()}',
+        concurrency=settings.DISPATCH_WORKERS,
+        claim_idle=timedelta(seconds=settings.DISPATCH_CLAIM_IDLE_SECS),
+        max_deliveries=settings.DISPATCH_MAX_DELIVERIES,
+        dead_letter_stream=settings.DISPATCH_DEAD_LETTER_STREAM,
+    )
+
+    loops = [worker.run(), services.build_retry_scheduler().run(), services.build_push_scheduler().run()]
+    if settings.TOKEN_METADATA_ENABLED:
+        loops.append(services.build_token_pruner().run())
+    if settings.CIRCUIT_BREAKER_ENABLED and settings.CIRCUIT_BREAKER_SHARED:
+        loops.append(services.build_circuit_sync().run())
+
+    try:
+        await asyncio.gather(*loops)
+    finally:
+        for http_con in http_connections:
+            await http_con.close()
+        await connection.aclose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
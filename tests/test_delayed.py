@@ -0,0 +1,67 @@
+import asyncio
+import logging
+from datetime import UTC, datetime, timedelta
+
+import fakeredis
+import pytest
+
+from pushes.delayed import DelayedJobScheduler, DelayedQueue
+from pushes.repositories import UserId
+from pushes.schemas import Platform, PushJobSchema
+
+KEY = 'pushes:scheduled'
+
+
+@pytest.fixture
+def connection() -> fakeredis.FakeRedis:
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+def add_due(queue: DelayedQueue, count: int) -> None:
+    jobs = [PushJobSchema(platform=Platform.APNS, guid=f'guid-{i}', user_id=UserId(f'user-{i}')) for i in range(count)]
+    queue.add_many(jobs, datetime.now(UTC) - timedelta(seconds=1))
+
+
+def test_claimed_jobs_are_leased(connection: fakeredis.FakeRedis) -> None:
+    queue = DelayedQueue(connection, KEY)
+    add_due(queue, 2)
+
+    assert len(queue.claim_due(10, timedelta(minutes=1))) == 2
+    assert queue.claim_due(10, timedelta(minutes=1)) == []
+
+
+def test_claimed_jobs_are_queued_again_when_lease_ends(connection: fakeredis.FakeRedis) -> None:
+    queue = DelayedQueue(connection, KEY)
+    add_due(queue, 2)
+
+    assert len(queue.claim_due(10, timedelta(0))) == 2
+    assert len(queue.claim_due(10, timedelta(minutes=1))) == 2
+
+
+def test_scheduler_completes_handled_jobs_and_releases_the_rest(connection: fakeredis.FakeRedis) -> None:
+    queue = DelayedQueue(connection, KEY)
+    add_due(queue, 5)
+    handled: list[PushJobSchema] = []
+
+    async def handle(job: PushJobSchema) -> None:
+        handled.append(job)
+
+    async def main() -> None:
+        scheduler = DelayedJobScheduler(
+            queue,
+            logging.getLogger(__name__),
+            handle,
+            batch_size=5,
+            poll_interval=timedelta(seconds=1),
+            lease=timedelta(minutes=1),
+            max_rate=10,
+        )
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0.25)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(main())
+    assert 0 < len(handled) < 5
+    assert connection.zcard(f'{KEY}:processing') == 0
+    assert connection.zcard(KEY) == 5 - len(handled)
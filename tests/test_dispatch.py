@@ -0,0 +1,135 @@
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable
+from datetime import timedelta
+
+import fakeredis
+import pytest
+from fakeredis import aioredis
+
+from pushes.dispatch import DispatchQueue, DispatchWorker
+from pushes.repositories import UserId
+from pushes.schemas import Platform, PushJobSchema
+
+STREAM = 'pushes:queue'
+GROUP = 'senders'
+DEAD_LETTER_STREAM = 'pushes:dead-letters'
+
+
+@pytest.fixture
+def server() -> fakeredis.FakeServer:
+    return fakeredis.FakeServer()
+
+
+def enqueue(server: fakeredis.FakeServer, count: int) -> list[str]:
+    """Queue jobs for distinct users, return their guids."""
+    queue = DispatchQueue(fakeredis.FakeRedis(server=server, decode_responses=True), STREAM, max_len=1000)
+    for i in range(count):
+        queue.enqueue(PushJobSchema(platform=Platform.APNS, guid=f'guid-{i}', user_id=UserId(f'user-{i}')))
+    return [f'guid-{i}' for i in range(count)]
+
+
+async def run_worker(
+    server: fakeredis.FakeServer,
+    handle: Callable[[PushJobSchema], Awaitable[object]],
+    done: asyncio.Event,
+    *,
+    max_deliveries: int = 5,
+) -> int:
+    """Run a worker until done is set, return the number of jobs left pending."""
+    connection = aioredis.FakeRedis(server=server, decode_responses=True)
+    worker = DispatchWorker(
+        connection,
+        logging.getLogger(__name__),
+        handle,
+        stream=STREAM,
+        group=GROUP,
+        consumer='test',
+        concurrency=2,
+        claim_idle=timedelta(milliseconds=200),
+        max_deliveries=max_deliveries,
+        dead_letter_stream=DEAD_LETTER_STREAM,
+        block=timedelta(milliseconds=50),
+        idle_backoff=timedelta(milliseconds=10),
+    )
+    task = asyncio.create_task(worker.run())
+    try:
+        await asyncio.wait_for(done.wait(), timeout=5)
+        # Let the last handled job be acknowledged
+        await asyncio.sleep(0.05)
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    pending = await connection.xpending(STREAM, GROUP)
+    return pending['pending']
+
+
+def test_worker_delivers_and_acknowledges_jobs(server: fakeredis.FakeServer) -> None:
+    guids = enqueue(server, 5)
+    delivered: list[str] = []
+
+    async def main() -> int:
+        done = asyncio.Event()
+
+        async def handle(job: PushJobSchema) -> None:
+            delivered.append(str(job.guid))
+            if len(delivered) == len(guids):
+                done.set()
+
+        return await run_worker(server, handle, done)
+
+    assert asyncio.run(main()) == 0
+    assert sorted(delivered) == guids
+
+
+def test_worker_retries_failed_jobs(server: fakeredis.FakeServer) -> None:
+    enqueue(server, 1)
+    attempts = 0
+
+    async def main() -> int:
+        done = asyncio.Event()
+
+        async def handle(job: PushJobSchema) -> None:
+            nonlocal attempts
+            attempts += 1
+            if attempts == 1:
+                msg = 'provider unavailable'
+                raise RuntimeError(msg)
+            done.set()
+
+        return await run_worker(server, handle, done)
+
+    assert asyncio.run(main()) == 0
+    assert attempts == 2
+
+
+def test_worker_dead_letters_jobs_failing_too_often(server: fakeredis.FakeServer) -> None:
+    enqueue(server, 1)
+    attempts = 0
+
+    async def main() -> int:
+        done = asyncio.Event()
+
+        async def handle(job: PushJobSchema) -> None:
+            nonlocal attempts
+            attempts += 1
+            msg = 'provider unavailable'
+            raise RuntimeError(msg)
+
+        class DeadLetterHandler(logging.Handler):
+            def emit(self, record: logging.LogRecord) -> None:
+                if 'dead lettered' in record.getMessage():
+                    done.set()
+
+        handler = DeadLetterHandler()
+        logging.getLogger(__name__).addHandler(handler)
+        try:
+            return await run_worker(server, handle, done, max_deliveries=2)
+        finally:
+            logging.getLogger(__name__).removeHandler(handler)
+
+    assert asyncio.run(main()) == 0
+    assert attempts == 2
+    connection = fakeredis.FakeRedis(server=server, decode_responses=True)
+    [(_, fields)] = connection.xrange(DEAD_LETTER_STREAM)  # type: ignore[misc]
+    assert PushJobSchema.model_validate_json(fields['job']).guid == 'guid-0'
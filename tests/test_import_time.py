@@ -0,0 +1,14 @@
+import statistics
+
+from benchmarks.import_time import BUDGET_MS, find_eager_imports, get_environment, measure_import
+
+
+def test_provider_modules_are_imported_lazily() -> None:
+    assert find_eager_imports(get_environment()) == []
+
+
+def test_app_import_is_within_budget() -> None:
+    environment = get_environment()
+    total = statistics.median(measure_import(environment)[0] for _ in range(3))
+
+    assert total <= BUDGET_MS
@@ -0,0 +1,58 @@
+import fakeredis
+import pytest
+
+from pushes.repositories import (
+    FCM_OWNERS_KEY,
+    FCM_TOKEN_METADATA_KEYS,
+    FCM_TOKENS_KEY_PATTERN,
+    MirroredTokenRepository,
+    RedisTokenMetadataRepository,
+    RedisTokenRepository,
+    Token,
+    UserId,
+)
+
+ALICE, BOB = UserId('alice'), UserId('bob')
+FIRST, SECOND, THIRD = Token('first'), Token('second'), Token('third')
+
+
+@pytest.fixture
+def connection() -> fakeredis.FakeRedis:
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+def test_copy_keeps_changes_made_while_migrating(connection: fakeredis.FakeRedis) -> None:
+    source = RedisTokenRepository(connection, FCM_TOKENS_KEY_PATTERN, FCM_OWNERS_KEY)
+    target = RedisTokenMetadataRepository(connection, *FCM_TOKEN_METADATA_KEYS)
+    source.add_many(ALICE, [FIRST, SECOND, THIRD])
+    migrating = MirroredTokenRepository(source, target)
+
+    migrating.add(BOB, FIRST)
+    migrating.delete(ALICE, SECOND)
+    assert migrating.get_all_by_user_ids([ALICE, BOB]) == {ALICE: {THIRD}, BOB: {FIRST}}
+
+    assert target.copy_from(source.key_pattern, [ALICE, BOB]) == 1
+    assert target.copy_from(source.key_pattern, [ALICE, BOB]) == 0
+    assert target.get_all_by_user_ids([ALICE, BOB]) == {ALICE: {THIRD}, BOB: {FIRST}}
+
+
+def test_copy_keeps_tokens_the_target_has(connection: fakeredis.FakeRedis) -> None:
+    source = RedisTokenRepository(connection, FCM_TOKENS_KEY_PATTERN, FCM_OWNERS_KEY)
+    target = RedisTokenMetadataRepository(connection, *FCM_TOKEN_METADATA_KEYS)
+    source.add(ALICE, FIRST)
+    target.add(BOB, FIRST)
+    target.record_outcomes({BOB: {FIRST: True}})
+
+    assert target.copy_from(source.key_pattern, [ALICE]) == 0
+    assert target.get_all_by_user_ids([ALICE, BOB]) == {ALICE: set(), BOB: {FIRST}}
+    assert target.get_metadata(BOB)[FIRST].last_success_at is not None
+
+
+def test_registering_moves_token_to_the_new_user(connection: fakeredis.FakeRedis) -> None:
+    target = RedisTokenMetadataRepository(connection, *FCM_TOKEN_METADATA_KEYS)
+    target.add_many(ALICE, [FIRST, SECOND])
+
+    target.add(BOB, FIRST)
+    target.delete(ALICE, SECOND)
+
+    assert target.get_all_by_user_ids([ALICE, BOB]) == {ALICE: set(), BOB: {FIRST}}
@@ -0,0 +1,60 @@
+import asyncio
+from datetime import timedelta
+
+import fakeredis
+import pytest
+
+from integrations.rate_limits import LocalRateLimiter, RateLimiter, RedisRateLimiter
+from pushes.throttling import DeviceThrottle, ThrottledError
+
+
+@pytest.fixture(params=['local', 'redis'])
+def limiter(request: pytest.FixtureRequest) -> RateLimiter:
+    if request.param == 'local':
+        return LocalRateLimiter(1, 3)
+    return RedisRateLimiter(fakeredis.FakeRedis(decode_responses=True), 'rate-limit', 1, 3)
+
+
+def test_refused_slots_are_not_taken(limiter: RateLimiter) -> None:
+    assert [limiter.reserve('token', 0) for _ in range(3)] == [0, 0, 0]
+
+    delays = [limiter.reserve('token', 0) for _ in range(30)]
+
+    assert all(0.9 < delay <= 1 for delay in delays)
+    assert limiter.reserve('token', 1) <= 1
+
+
+def test_released_slots_are_free_again(limiter: RateLimiter) -> None:
+    for _ in range(3):
+        limiter.reserve('token', 0)
+
+    limiter.release('token')
+
+    assert limiter.reserve('token', 0) == 0
+
+
+def test_throttled_pushes_keep_no_slot() -> None:
+    limiter = LocalRateLimiter(1, 1)
+    throttle = DeviceThrottle(limiter, max_delay=timedelta(0))
+
+    async def send_many() -> None:
+        assert await throttle.wait('token', 'guid')
+        for _ in range(30):
+            with pytest.raises(ThrottledError):
+                await throttle.wait('token', 'guid')
+
+    asyncio.run(send_many())
+    assert limiter.reserve('token', 1) <= 1
+
+
+def test_superseded_pushes_give_their_slot_back() -> None:
+    limiter = LocalRateLimiter(10, 1)
+    throttle = DeviceThrottle(limiter, max_delay=timedelta(seconds=1))
+
+    async def supersede() -> list[bool]:
+        first = asyncio.create_task(throttle.wait('token', 'guid'))
+        await asyncio.sleep(0.01)
+        return [await first, *await asyncio.gather(throttle.wait('token', 'guid'), throttle.wait('token', 'guid'))]
+
+    assert asyncio.run(supersede()) == [True, False, True]
+    assert limiter.reserve('token', 1) == 0
@@ -0,0 +1,36 @@
+import fakeredis
+import pytest
+
+from pushes.repositories import FCM_OWNERS_KEY, FCM_TOKENS_KEY_PATTERN, RedisTokenRepository, Token, UserId
+
+ALICE, BOB, CAROL = UserId('alice'), UserId('bob'), UserId('carol')
+FIRST, SECOND = Token('first'), Token('second')
+
+
+@pytest.fixture
+def connection() -> fakeredis.FakeRedis:
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+def test_reconcile_keeps_indexed_tokens_with_their_owner(connection: fakeredis.FakeRedis) -> None:
+    repo = RedisTokenRepository(connection, FCM_TOKENS_KEY_PATTERN, FCM_OWNERS_KEY)
+    connection.sadd(FCM_TOKENS_KEY_PATTERN.format(user_id=ALICE), FIRST)
+    repo.add(BOB, FIRST)
+
+    assert repo.reconcile_owners([ALICE, BOB]) == (1, 0)
+    assert repo.get_all_by_user_ids([ALICE, BOB]) == {ALICE: set(), BOB: {FIRST}}
+
+
+def test_reconcile_leaves_unindexed_shared_tokens(connection: fakeredis.FakeRedis) -> None:
+    repo = RedisTokenRepository(connection, FCM_TOKENS_KEY_PATTERN, FCM_OWNERS_KEY)
+    for user_id in (ALICE, BOB, CAROL):
+        connection.sadd(FCM_TOKENS_KEY_PATTERN.format(user_id=user_id), FIRST)
+    connection.sadd(FCM_TOKENS_KEY_PATTERN.format(user_id=ALICE), SECOND)
+
+    assert repo.reconcile_owners([ALICE]) == (0, 0)
+    assert repo.reconcile_owners([BOB, CAROL]) == (0, 2)
+    assert repo.get_all_by_user_ids([ALICE, BOB, CAROL]) == {ALICE: {FIRST, SECOND}, BOB: {FIRST}, CAROL: {FIRST}}
+
+    repo.add(CAROL, FIRST)
+    assert repo.reconcile_owners([ALICE, BOB, CAROL]) == (2, 0)
+    assert repo.get_all_by_user_ids([ALICE, BOB, CAROL]) == {ALICE: {SECOND}, BOB: set(), CAROL: {FIRST}}